@@ -1,7 +1,6 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
+from bar_counts import extract_bar_count, stated_bar_count
 import pandas as pd
-import re
 import sys
 
 #model_name = "google/gemma-3-27b-it"
@@ -12,50 +11,6 @@ if len(sys.argv) > 1 and sys.argv[1].startswith('--'):
     n = int(sys.argv[1][2:])
     df = df.head(n)
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
-
-def extract_bar_count(pred_raw):
-    """
-    Extract the bar count number from the model's response.
-    The model should output a number representing the number of bars.
-    """
-    if pred_raw is None:
-        return ""
-
-    text = pred_raw.strip()
-
-    # Try to find a number in the response
-    # Look for patterns like "8", "8 bars", "The answer is 8", etc.
-    
-    # 1) Look for "X bars" or "X bar" format
-    m = re.search(r"\b(\d+)\s+bar", text, re.IGNORECASE)
-    if m:
-        return m.group(1)
-    
-    # 2) Look for "answer is X" or "is X" format
-    m = re.search(r"(?:answer|count|number|bars?)\s+(?:is|are|:)?\s*(\d+)", text, re.IGNORECASE)
-    if m:
-        return m.group(1)
-    
-    # 3) Look for standalone number (prefer numbers that are reasonable for bar counts, e.g., 1-100)
-    m = re.search(r"\b([1-9]\d?|100)\b", text)
-    if m:
-        num = int(m.group(1))
-        if 1 <= num <= 100:  # Reasonable range for bar counts
-            return str(num)
-    
-    # 4) Fallback: any number
-    m = re.search(r"\b(\d+)\b", text)
-    if m:
-        return m.group(1)
-    
-    # 5) No number found
-    return ""
-
 
 predictions = []
 raw_responses = []
@@ -75,14 +30,10 @@ Task:
 
 Answer:"""
 
+    saving = None
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        raw_response = response.choices[0].message.content
+        # With LLM_STREAM=1 generation stops once the answer states "N bars"
+        raw_response, saving = llm.complete_until(prompt, model_name, stated_bar_count, temperature=0)
         pred = extract_bar_count(raw_response)
         raw_responses.append(raw_response)
 
@@ -97,7 +48,7 @@ Answer:"""
     if str(pred) == str(row["target"]):
         correct += 1
 
-    print(f"[{i}] GT={row['target']} | Pred={pred}")
+    print(f"[{i}] GT={row['target']} | Pred={pred}{llm.describe_saving(saving)}")
 
 # Save results to CSV
 results_df = pd.DataFrame({
@@ -0,0 +1,54 @@
+import re
+
+# Local parser for bar count answers (bar_count_baseline.py) and the matching stream stop
+
+# "16 bars", "1 bar": the first one in the answer is the count extract_bar_count reads
+STATED_BARS = re.compile(r"\b(\d+)\s+bar", re.IGNORECASE)
+
+
+def extract_bar_count(pred_raw):
+    """
+    Extract the bar count number from the model's response.
+    The model should output a number representing the number of bars.
+    """
+    if pred_raw is None:
+        return ""
+
+    text = pred_raw.strip()
+
+    # Try to find a number in the response
+    # Look for patterns like "8", "8 bars", "The answer is 8", etc.
+    
+    # 1) Look for "X bars" or "X bar" format
+    m = STATED_BARS.search(text)
+    if m:
+        return m.group(1)
+    
+    # 2) Look for "answer is X" or "is X" format
+    m = re.search(r"(?:answer|count|number|bars?)\s+(?:is|are|:)?\s*(\d+)", text, re.IGNORECASE)
+    if m:
+        return m.group(1)
+    
+    # 3) Look for standalone number (prefer numbers that are reasonable for bar counts, e.g., 1-100)
+    m = re.search(r"\b([1-9]\d?|100)\b", text)
+    if m:
+        num = int(m.group(1))
+        if 1 <= num <= 100:  # Reasonable range for bar counts
+            return str(num)
+    
+    # 4) Fallback: any number
+    m = re.search(r"\b(\d+)\b", text)
+    if m:
+        return m.group(1)
+    
+    # 5) No number found
+    return ""
+
+
+def stated_bar_count(text):
+    """
+    The first "N bars" of a partial answer, else "". extract_bar_count reads
+    the same number from any continuation, so the stream can stop there.
+    """
+    m = STATED_BARS.search(text)
+    return m.group(1) if m else ""
@@ -0,0 +1,362 @@
+import argparse
+import asyncio
+import os
+import json
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import llm_client as llm
+from llm_batching import batching_client, chat_template
+from llm_scheduler import RequestScheduler, scheduled_client
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# vLLM prefix caching works on blocks of this many tokens
+PREFIX_BLOCK_SIZE = 16
+
+# Short single-turn calls like the emotion analysts / format checker
+BENCH_MODEL = "google/gemma-3-27b-it"
+BENCH_PROMPT = """Categories:
+0: Q1 (happy)  1: Q2 (angry)  2: Q3 (sad)  3: Q4 (relaxed)
+
+Sample {i}: X:1
+K:C
+M:4/4
+CDEF GABc|
+
+Answer with ONE digit:"""
+
+
+def bench_requests(num_calls):
+    return [{"model": llm.MODEL_OVERRIDE or BENCH_MODEL,
+             "messages": [{"role": "user", "content": BENCH_PROMPT.format(i=i)}],
+             "temperature": 0,
+             "max_tokens": 4,
+             "stop": ["\n"]} for i in range(num_calls)]
+
+
+def build_client(batched, is_async, window_ms, max_batch):
+    scheduler = RequestScheduler(max_limit=max(64, max_batch))
+    raw_client = llm.backend_client(is_async, scheduler)
+    if batched:
+        return batching_client(raw_client, scheduler, window_ms=window_ms, max_batch=max_batch), scheduler
+    return scheduled_client(raw_client, scheduler), scheduler
+
+
+def run_sync(client, requests, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda request: client.chat.completions.create(**request), requests))
+
+
+async def run_async(client, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(request):
+        async with semaphore:
+            return await client.chat.completions.create(**request)
+
+    return await asyncio.gather(*(one(request) for request in requests))
+
+
+def bench_batching(num_calls, concurrency, window_ms, max_batch, is_async):
+    """Requests/sec with one HTTP request per call vs. micro-batched /v1/completions requests."""
+    requests = bench_requests(num_calls)
+    results = {}
+    for batched in (False, True):
+        client, scheduler = build_client(batched, is_async, window_ms, max_batch)
+        start = time.perf_counter()
+        if is_async:
+            asyncio.run(run_async(client, requests, concurrency))
+        else:
+            run_sync(client, requests, concurrency)
+        elapsed = time.perf_counter() - start
+
+        label = "micro-batched" if batched else "one call per request"
+        results[label] = num_calls / elapsed
+        print(f"{label:>22}: {num_calls / elapsed:8.1f} calls/s ({num_calls} calls in {elapsed:.2f}s, "
+              f"{scheduler.requests} HTTP requests)")
+        if batched:
+            print(f"{'':>22}  {client.batcher.report()}")
+
+    print(f"Speedup: {results['micro-batched'] / results['one call per request']:.2f}x")
+    return results
+
+
+def load_prompt_builders(rev=None):
+    """multi_agent_system from the working tree, or as of a git revision (for before/after comparisons)."""
+    if rev is None:
+        import multi_agent_system
+        return multi_agent_system
+    source = subprocess.run(["git", "show", f"{rev}:multi_agent_system.py"], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    module = types.ModuleType(f"multi_agent_system@{rev}")
+    exec(compile(source, f"multi_agent_system.py@{rev}", "exec"), module.__dict__)
+    return module
+
+
+def pipeline_prompts(mas, num_samples):
+    """
+    (role, prompt) pairs in the order the multi-agent pipeline sends them:
+    emotion questions (validator, controller, arousal, valence, combiner) and
+    metadata questions (validator, controller, ABC expert, evaluator).
+    Generated inputs (analyses, arousal/valence results) are placeholders.
+    """
+    prompts = []
+    emotion_df = pd.read_csv(os.path.join(REPO_DIR, "data", "Emotion_Recognition_cleaned.csv")).head(num_samples)
+    for i, user_prompt in enumerate(emotion_df["prompt"]):
+        abc_score = mas.extract_abc_from_prompt(user_prompt)
+        prompts += [
+            ("validator", mas.input_validator_prompt(user_prompt, abc_score, True)),
+            ("controller", mas.controller_prompt(user_prompt)),
+            ("arousal", mas.build_arousal_classifier_prompt(abc_score)),
+            ("valence", mas.build_valence_classifier_prompt(abc_score)),
+            ("combiner", mas.build_emotion_combiner_prompt(abc_score, f"Arousal: HIGH\nReason: sample {i}",
+                                                           f"Valence: LOW\nReason: sample {i}")),
+        ]
+    metadata_df = pd.read_csv(os.path.join(REPO_DIR, "data", "Metadata_QA_cleaned.csv")).head(num_samples)
+    for i, user_prompt in enumerate(metadata_df["prompt"]):
+        abc_score = mas.extract_abc_from_prompt(user_prompt)
+        prompts += [
+            ("validator", mas.input_validator_prompt(user_prompt, abc_score, True)),
+            ("controller", mas.controller_prompt(user_prompt)),
+            ("abc_expert", mas.abc_expert_prompt(abc_score)),
+            ("evaluator", mas.evaluator_prompt(f"analysis {i} " * 200, user_prompt)),
+        ]
+    return prompts
+
+
+def approx_tokenize(text):
+    """Rough word-piece split (a word with its leading space, or a punctuation mark)."""
+    return re.findall(r"\s?\w+|\s?[^\w\s]|\s+", text)
+
+
+def simulate_prefix_cache(prompts, tokenize, block_size=PREFIX_BLOCK_SIZE):
+    """
+    Replay prompts against an unbounded block-level prefix cache (as vLLM's
+    automatic prefix caching: a block is reused if it and every block before
+    it were seen). Returns {role: [cached tokens, prompt tokens, calls]}.
+    """
+    seen = set()
+    per_role = defaultdict(lambda: [0, 0, 0])
+    for role, prompt in prompts:
+        tokens = tokenize(prompt)
+        block_hash = None
+        cached = 0
+        hit = True
+        for start in range(0, len(tokens) - block_size + 1, block_size):
+            block_hash = hash((block_hash, tuple(tokens[start:start + block_size])))
+            if hit and block_hash in seen:
+                cached += block_size
+            else:
+                hit = False
+                seen.add(block_hash)
+        per_role[role][0] += cached
+        per_role[role][1] += len(tokens)
+        per_role[role][2] += 1
+    return per_role
+
+
+def measure_ttft(prompts, model):
+    """Mean time to first token per role (streamed, max_tokens=1, response cache bypassed)."""
+    scheduler = RequestScheduler()
+    client = scheduled_client(llm.backend_client(False, scheduler), scheduler)
+    ttft = defaultdict(list)
+    for role, prompt in prompts:
+        start = time.perf_counter()
+        stream = client.chat.completions.create(model=llm.MODEL_OVERRIDE or model,
+                                                messages=[{"role": "user", "content": prompt}],
+                                                temperature=0, max_tokens=1, stream=True)
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    break
+        finally:
+            stream.close()
+        ttft[role].append((time.perf_counter() - start) * 1000)
+    return {role: sum(times) / len(times) for role, times in ttft.items()}
+
+
+def bench_prefix(num_samples, rev, with_ttft, tokenizer_name):
+    """Share of prompt tokens that the prefix cache can reuse, per role (and TTFT with --ttft)."""
+    mas = load_prompt_builders(rev)
+    prompts = pipeline_prompts(mas, num_samples)
+
+    if tokenizer_name:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        tokenize = lambda text: tokenizer.apply_chat_template([{"role": "user", "content": text}], tokenize=True,
+                                                              add_generation_prompt=True)
+    else:
+        template = chat_template(mas.model_name) or "{content}"
+        tokenize = lambda text: approx_tokenize(template.format(content=text.strip()))
+
+    per_role = simulate_prefix_cache(prompts, tokenize)
+    ttft = measure_ttft(prompts, mas.model_name) if with_ttft else {}
+
+    print(f"Prompt layout: {rev or 'working tree'} ({num_samples} emotion + {num_samples} metadata samples, "
+          f"{'tokenizer ' + tokenizer_name if tokenizer_name else 'approximate tokens'}, blocks of {PREFIX_BLOCK_SIZE})")
+    print(f"{'role':<12}{'calls':>7}{'tokens/call':>13}{'cacheable':>11}" + (f"{'TTFT ms':>10}" if ttft else ""))
+    total_cached = total_tokens = 0
+    for role, (cached, tokens, calls) in per_role.items():
+        total_cached += cached
+        total_tokens += tokens
+        line = f"{role:<12}{calls:>7}{tokens / calls:>13.0f}{cached / tokens:>10.1%}"
+        if ttft:
+            line += f"{ttft[role]:>10.0f}"
+        print(line)
+    print(f"{'total':<12}{len(prompts):>7}{total_tokens / len(prompts):>13.0f}{total_cached / total_tokens:>10.1%}")
+    return per_role, ttft
+
+
+# Scripts run by `benchmark.py scripts`: name -> (script, arguments). Each one
+# runs in a scratch directory whose data/ holds the first N rows of SCRIPT_DATA.
+SCRIPT_TARGETS = {
+    "multi_agent_system": ("multi_agent_system.py", ["data/Emotion_Recognition_cleaned.csv", "--concurrency", "{concurrency}"]),
+    "multi_agent_system_metadata": ("multi_agent_system.py", ["data/Metadata_QA_cleaned.csv", "--concurrency", "{concurrency}"]),
+    "multi_agent_test_emotion": ("multi_agent_test_emotion.py", ["data/Emotion_Recognition_cleaned.csv"]),
+    "emotion_recognition_agent": ("emotion_recognition_agent.py", []),
+    "emotion_recognition_agent_2": ("emotion_recognition_agent_2.py", []),
+    "emotion_recognition_agent_2_logprobs": ("emotion_recognition_agent_2.py", ["--logprobs"]),
+    "emotion_recognition_baseline": ("emotion_recognition_baseline.py", []),
+    "emotion_baseline": ("emotion_baseline.py", ["data/Emotion_Recognition_cleaned.csv"]),
+    "metadata_QA_baseline": ("metadata_QA_baseline.py", []),
+    "bar_count_baseline": ("bar_count_baseline.py", []),
+}
+SCRIPT_DATA = ("Emotion_Recognition_cleaned.csv", "Metadata_QA_cleaned.csv", "Bar_Count_Estimation.csv")
+
+
+def server_stats(base_url):
+    with urllib.request.urlopen(base_url.rsplit("/v1", 1)[0] + "/stats") as response:
+        return json.load(response)
+
+
+def prepare_workdir(workdir, num_samples):
+    os.makedirs(os.path.join(workdir, "data"))
+    for name in SCRIPT_DATA:
+        df = pd.read_csv(os.path.join(REPO_DIR, "data", name)).head(num_samples)
+        df.to_csv(os.path.join(workdir, "data", name), index=False)
+
+
+def run_script(name, base_url, num_samples, concurrency, extra_env, log_dir):
+    """Run one target against the server. Returns its measurements."""
+    script, arguments = SCRIPT_TARGETS[name]
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    prepare_workdir(workdir, num_samples)
+    env = {**os.environ, "LLM_BACKEND": "local", "LLM_BASE_URL": base_url, "LLM_API_KEY": "EMPTY",
+           "LLM_CACHE": "0", "LLM_CACHE_PATH": os.path.join(workdir, "cache.sqlite"),
+           "LLM_TELEMETRY_PATH": os.path.join(workdir, "calls.jsonl"), "PYTHONUNBUFFERED": "1", **extra_env}
+    command = [sys.executable, os.path.join(REPO_DIR, script)] + [a.format(concurrency=concurrency) for a in arguments]
+
+    before = server_stats(base_url)
+    cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with open(os.path.join(log_dir, f"{name}.log"), "w", encoding="utf-8") as log:
+        returncode = subprocess.run(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    elapsed = time.perf_counter() - start
+    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    after = server_stats(base_url)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    calls = {key: after[key] - before[key] for key in after}
+    return {
+        "script": name,
+        "returncode": returncode,
+        "samples": num_samples,
+        "seconds": elapsed,
+        "samples_per_s": num_samples / elapsed,
+        "requests_per_sample": calls["requests"] / num_samples,
+        "prompts_per_sample": calls["prompts"] / num_samples,
+        "errors": calls["errors"],
+        "cpu_ms_per_sample": ((cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime))
+                             * 1000 / num_samples,
+    }
+
+
+def bench_scripts(targets, num_samples, concurrency, base_url, server_options, extra_env):
+    """
+    Run the pipeline scripts against a mock server (started here unless
+    base_url is given) and report samples/s, LLM requests and prompts per
+    sample, and client CPU time per sample.
+    """
+    from mock_server import MockBackend, MockServer
+
+    server = None
+    if base_url is None:
+        server = MockServer(MockBackend(**server_options)).start()
+        base_url = server.base_url
+        print(f"Mock server on {base_url} ({', '.join(f'{k}={v}' for k, v in server_options.items())})")
+    log_dir = tempfile.mkdtemp(prefix="bench-logs-")
+
+    results = []
+    print(f"{'script':<38}{'exit':>5}{'samples/s':>11}{'req/sample':>12}{'prompts/sample':>16}{'errors':>8}{'CPU ms/sample':>15}")
+    try:
+        for name in targets:
+            r = run_script(name, base_url, num_samples, concurrency, extra_env, log_dir)
+            results.append(r)
+            print(f"{name:<38}{r['returncode']:>5}{r['samples_per_s']:>11.2f}{r['requests_per_sample']:>12.1f}"
+                  f"{r['prompts_per_sample']:>16.1f}{r['errors']:>8}{r['cpu_ms_per_sample']:>15.0f}")
+    finally:
+        if server is not None:
+            server.stop()
+    print(f"Script output: {log_dir}")
+    return results
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the LLM gateway (cache disabled)")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batching_parser = subparsers.add_parser("batching", help="Micro-batching vs. one call per request")
+    batching_parser.add_argument("--calls", type=int, default=512, help="Number of calls (default 512)")
+    batching_parser.add_argument("--concurrency", type=int, default=64, help="Concurrent callers (default 64)")
+    batching_parser.add_argument("--window-ms", type=float, default=5.0, help="Batch window (default 5 ms)")
+    batching_parser.add_argument("--max-batch", type=int, default=32, help="Maximum batch size (default 32)")
+    batching_parser.add_argument("--async", dest="is_async", action="store_true", help="Use asyncio callers instead of threads")
+
+    prefix_parser = subparsers.add_parser("prefix", help="Prefix-cache reuse of the pipeline prompts, per role")
+    prefix_parser.add_argument("--samples", type=int, default=20, help="Emotion and metadata samples each (default 20)")
+    prefix_parser.add_argument("--rev", help="Use the prompt builders of this git revision (e.g. to compare with an older layout)")
+    prefix_parser.add_argument("--ttft", action="store_true", help="Also measure time to first token on the backend")
+    prefix_parser.add_argument("--tokenizer", help="Hugging Face tokenizer for exact token counts (needs transformers)")
+
+    scripts_parser = subparsers.add_parser("scripts", help="Run the pipeline scripts against a local mock server")
+    scripts_parser.add_argument("targets", nargs="*", default=list(SCRIPT_TARGETS),
+                                help=f"Scripts to run (default: all of {', '.join(SCRIPT_TARGETS)})")
+    scripts_parser.add_argument("--samples", type=int, default=20, help="Samples per script (default 20)")
+    scripts_parser.add_argument("--concurrency", type=int, default=8, help="--concurrency of multi_agent_system (default 8)")
+    scripts_parser.add_argument("--base-url", help="Use a running server (e.g. mock_server.py) instead of starting one")
+    scripts_parser.add_argument("--latency", default="lognormal:300,0.5", help="Mock latency distribution (see mock_server.py)")
+    scripts_parser.add_argument("--token-ms", type=float, default=5.0, help="Mock decode time per token (default 5 ms)")
+    scripts_parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests that fail")
+    scripts_parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                                help="Extra environment for the scripts, e.g. --env LLM_CACHE=1 --env LLM_MICRO_BATCH=1")
+    args = parser.parse_args()
+
+    if llm.BACKEND == "fake":
+        # Model the HTTP + queueing overhead of a small request
+        os.environ.setdefault("LLM_FAKE_LATENCY_MS", "50")
+    print(f"Backend: {llm.BACKEND}")
+
+    if args.benchmark == "batching":
+        bench_batching(args.calls, args.concurrency, args.window_ms, args.max_batch, args.is_async)
+    elif args.benchmark == "prefix":
+        bench_prefix(args.samples, args.rev, args.ttft, args.tokenizer)
+    elif args.benchmark == "scripts":
+        unknown = [t for t in args.targets if t not in SCRIPT_TARGETS]
+        if unknown:
+            parser.error(f"Unknown scripts: {', '.join(unknown)}")
+        bench_scripts(args.targets, args.samples, args.concurrency, args.base_url,
+                      {"latency": args.latency, "token_ms": args.token_ms, "error_rate": args.error_rate},
+                      dict(item.split("=", 1) for item in args.env))
@@ -1,5 +1,4 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
 import pandas as pd
 import re
 import sys
@@ -7,11 +6,6 @@ import sys
 model_name = "google/gemma-3-27b-it"
 #model_name = "meta-llama/Meta-Llama-3.1-70B-Instruct"
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
 # Emotion recognition categories
 category_text = """Categories:
 0: Q1 (happy   - high valence, high arousal)
@@ -22,17 +16,7 @@ category_text = """Categories:
 
 def call_llm(prompt, max_tokens=128, temperature=0.0):
     """Helper function to call LLM."""
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error calling LLM: {e}")
-        return ""
+    return llm.call_llm(prompt, model_name, temperature=temperature, max_tokens=max_tokens)
 
 def extract_abc_from_prompt(user_prompt):
     """Extract ABC score from user prompt."""
@@ -0,0 +1,23 @@
+import re
+
+
+
+# Local parser for analyst answers in the emotion recognition scripts; the LLM
+# format checker is only asked when it fails
+def parse_label(text):
+    """
+    Label 0-3 read from an answer such as "LABEL: 2", "**Label** = 2", "Label: Q3",
+    "Q3 (sad)" or a bare "2"; "" if the answer has no label or is ambiguous.
+    """
+    if not text:
+        return ""
+    text = re.sub(r"[*_`#]", "", str(text)).upper()
+    to_label = lambda token: str(int(token[1]) - 1) if token.startswith("Q") else token
+    m = re.search(r"\bLABEL\b\s*(?:IS\s*)?[:=-]?\s*(Q[1-4]|[0-3])\b", text)
+    if m:
+        return to_label(m.group(1))
+    # Otherwise the answer must start with the label and every label it mentions must agree
+    labels = {to_label(token) for token in re.findall(r"\b(Q[1-4]|[0-3])\b", text)}
+    if len(labels) == 1 and re.match(r"\s*\(?(Q[1-4]|[0-3])\b", text):
+        return labels.pop()
+    return ""
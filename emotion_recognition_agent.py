@@ -1,5 +1,5 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
+from emotion_labels import parse_label
 import pandas as pd
 import re
 import sys
@@ -12,11 +12,6 @@ if len(sys.argv) > 1 and sys.argv[1].startswith('--'):
     n = int(sys.argv[1][2:])
     df = df.head(n)
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
 num_analysts = 3
 num_fewshot = 6
 
@@ -42,19 +37,11 @@ Correct label: {r['solution']}"""
 
 fewshot_block = build_fewshot(df, num_fewshot)
 
-def call_llm(prompt, max_tokens=8, temperature=0.0):
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stop=["\n"]
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error calling LLM: {e}")
-        return ""
+def call_llm(prompt, max_tokens=8, temperature=0.0, **params):
+    return llm.call_llm(prompt, model_name, temperature=temperature, max_tokens=max_tokens, stop=["\n"], **params)
+
+# Guided decoding (LLM_GUIDED=1) restricts the categorical answers to these
+LABELS = ("0", "1", "2", "3")
 
 
 analyst_instruction = f"""You are an emotion classifier for musical scores written in ABC notation.
@@ -80,9 +67,12 @@ Score:
 
 Your answer (ONLY one number 0/1/2/3):"""
 
-def analyst_answer_once(prompt):
+@llm.stage("analysts")
+def analyst_answers_all(prompt, k=num_analysts):
+    """All k analyst answers for one score: one n-sample request if supported, else k parallel requests."""
     analyst_prompt = build_analyst_prompt(prompt)
-    return call_llm(analyst_prompt, max_tokens=4, temperature=0.5)
+    return llm.sample(analyst_prompt, model_name, k, max_tokens=4, temperature=0.5, stop=["\n"],
+                      **llm.guided(choices=LABELS))
 
 
 format_checker_instruction = f"""You are a strict format checker.
@@ -100,6 +90,7 @@ Your response must be EITHER:
 - A single digit 0/1/2/3
 - Or the word INVALID"""
 
+@llm.stage("format_checker")
 def format_checker_llm(original_answer):
     check_prompt = f"""{format_checker_instruction}
 
@@ -107,7 +98,7 @@ Original answer:
 {original_answer}
 
 Your response (ONLY 0/1/2/3 or INVALID):"""
-    return call_llm(check_prompt, max_tokens=4, temperature=0.0)
+    return call_llm(check_prompt, max_tokens=4, temperature=0.0, **llm.guided(choices=LABELS + ("INVALID",)))
 
 
 def extract_option_index(text, num_options=4):
@@ -160,9 +151,10 @@ Now, choose the SINGLE best label for this score.
 
 Your answer (ONLY one number 0/1/2/3):"""
 
+@llm.stage("content_checker")
 def content_checker_llm(prompt, analyst_answers, clean_labels):
     judge_prompt = build_judge_prompt(prompt, analyst_answers, clean_labels)
-    return call_llm(judge_prompt, max_tokens=4, temperature=0.0)
+    return call_llm(judge_prompt, max_tokens=4, temperature=0.0, **llm.guided(choices=LABELS))
 
 
 predictions_single = []
@@ -176,66 +168,75 @@ correct_single = 0
 correct_majority = 0
 correct_agent = 0
 
+# Answers parsed, and how many of them needed the LLM format checker
+parsed_answers = 0
+format_checker_calls = 0
+
 for i, row in df.iterrows():
 
     prompt = row["prompt"]
 
+    # The sample's values are appended once, after the try, so a failed call
+    # cannot leave the result columns with different lengths
+    analyst_answers = []
+    format_checks = []
+    single_label = majority_label = final_label = judge_answer = ""
+
     try:
-        analyst_answers = []
         clean_labels = []
 
-        for k in range(num_analysts):
-            ans = analyst_answer_once(prompt)
+        for ans in analyst_answers_all(prompt, num_analysts):
             analyst_answers.append(ans)
 
-            fmt = format_checker_llm(ans)
-            raw_format_checks.append(fmt)
-
-            if fmt.strip().upper() == "INVALID":
-                lab = extract_option_index(ans)
+            lab = parse_label(ans)
+            if lab:
+                fmt = lab
             else:
-                lab = extract_option_index(fmt)
+                fmt = format_checker_llm(ans)
+                format_checker_calls += 1
+                if fmt.strip().upper() == "INVALID":
+                    lab = extract_option_index(ans)
+                else:
+                    lab = extract_option_index(fmt)
+            parsed_answers += 1
+            format_checks.append(fmt)
             clean_labels.append(lab)
 
-        raw_analyst_answers.append(analyst_answers)
-
         single_label = clean_labels[0] if clean_labels and clean_labels[0] in ["0", "1", "2", "3"] else ""
-        predictions_single.append(single_label)
-
-        if str(single_label) == str(row["solution"]):
-            correct_single += 1
 
         valid_labels = [l for l in clean_labels if l in ["0", "1", "2", "3"]]
         if valid_labels:
             majority_label = Counter(valid_labels).most_common(1)[0][0]
         else:
             majority_label = ""
-        predictions_majority.append(majority_label)
-
-        if str(majority_label) == str(row["solution"]):
-            correct_majority += 1
 
         judge_answer = content_checker_llm(prompt, analyst_answers, clean_labels)
-        raw_judge_answers.append(judge_answer)
 
         final_label = extract_option_index(judge_answer)
         if not final_label and valid_labels:
             final_label = majority_label
 
-        predictions_agent.append(final_label)
-
-        if str(final_label) == str(row["solution"]):
-            correct_agent += 1
-
         print(f"[{i}] GT={row['solution']} | single={single_label} | majority={majority_label} | agent={final_label}")
 
     except Exception as e:
         print("Error at sample", i, e)
-        predictions_single.append("")
-        predictions_majority.append("")
-        predictions_agent.append("")
-        raw_analyst_answers.append([])
-        raw_judge_answers.append("")
+        analyst_answers = []
+        format_checks = []
+        single_label = majority_label = final_label = judge_answer = ""
+
+    predictions_single.append(single_label)
+    predictions_majority.append(majority_label)
+    predictions_agent.append(final_label)
+    raw_analyst_answers.append(analyst_answers)
+    raw_format_checks.extend(format_checks)
+    raw_judge_answers.append(judge_answer)
+
+    if str(single_label) == str(row["solution"]):
+        correct_single += 1
+    if str(majority_label) == str(row["solution"]):
+        correct_majority += 1
+    if str(final_label) == str(row["solution"]):
+        correct_agent += 1
 
 results_df = pd.DataFrame({
     'index': df.index,
@@ -257,3 +258,6 @@ print(f"Model: {model_name}")
 print(f"Single LLM accuracy: {accuracy_single:.4f}")
 print(f"Majority vote accuracy: {accuracy_majority:.4f}")
 print(f"Multi-agent accuracy: {accuracy_agent:.4f}")
+if parsed_answers:
+    print(f"Format checker fallback: {format_checker_calls}/{parsed_answers} analyst answers "
+          f"({format_checker_calls / parsed_answers:.1%}) needed the LLM, the rest were parsed locally")
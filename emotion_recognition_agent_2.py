@@ -1,6 +1,8 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
+from emotion_labels import parse_label
 import pandas as pd
+import math
+import os
 import re
 import sys
 from collections import Counter
@@ -9,14 +11,12 @@ from collections import Counter
 model_name = "google/gemma-3-27b-it"
 df = pd.read_csv("data/Emotion_Recognition_cleaned.csv")
 
-if len(sys.argv) > 1 and sys.argv[1].startswith('--'):
-    n = int(sys.argv[1][2:])
-    df = df.head(n)
-
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
+# --N: first N samples; --logprobs: one logprob request per score instead of the
+# analyst / format checker / judge pipeline; --compare: run both and compare them
+mode = "logprobs" if "--logprobs" in sys.argv else "compare" if "--compare" in sys.argv else "voting"
+for arg in sys.argv[1:]:
+    if arg.startswith('--') and arg[2:].isdigit():
+        df = df.head(int(arg[2:]))
 
 num_analysts = 3
 num_fewshot = 6
@@ -43,19 +43,13 @@ Correct label: {r['solution']}"""
 
 fewshot_block = build_fewshot(df, num_fewshot)
 
-def call_llm(prompt, max_tokens=8, temperature=0.0):
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stop=["\n"]
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error calling LLM: {e}")
-        return ""
+def call_llm(prompt, max_tokens=8, temperature=0.0, **params):
+    return llm.call_llm(prompt, model_name, temperature=temperature, max_tokens=max_tokens, stop=["\n"], **params)
+
+# Guided decoding (LLM_GUIDED=1) restricts the categorical answers to these
+LABELS = ("0", "1", "2", "3")
+# Only the first line is generated (stop="\n")
+ANALYST_LABEL_REGEX = r"LABEL: [0-3]"
 
 
 # CHANGED: 要求 analyst 输出 LABEL + REASON
@@ -87,11 +81,14 @@ Score:
 Remember: follow the LABEL / REASON format exactly.
 """
 
-def analyst_answer_once(prompt):
+@llm.stage("analysts")
+def analyst_answers_all(prompt, k=num_analysts):
+    """All k analyst answers for one score: one n-sample request if supported, else k parallel requests."""
     analyst_prompt = build_analyst_prompt(prompt)
     # CHANGED: 解释会长一点，给多点 token
     # Use higher temperature (0.7) to encourage diversity in analyst opinions for voting
-    return call_llm(analyst_prompt, max_tokens=128, temperature=0.7)
+    return llm.sample(analyst_prompt, model_name, k, max_tokens=128, temperature=0.7, stop=["\n"],
+                      **llm.guided(regex=ANALYST_LABEL_REGEX))
 
 
 # CHANGED: prompt 里提到 LABEL 格式，逻辑不变
@@ -113,6 +110,7 @@ Your response must be EITHER:
 - A single digit 0/1/2/3
 - Or the word INVALID"""
 
+@llm.stage("format_checker")
 def format_checker_llm(original_answer):
     check_prompt = f"""{format_checker_instruction}
 
@@ -120,7 +118,7 @@ Original answer:
 {original_answer}
 
 Your response (ONLY 0/1/2/3 or INVALID):"""
-    return call_llm(check_prompt, max_tokens=4, temperature=0.0)
+    return call_llm(check_prompt, max_tokens=4, temperature=0.0, **llm.guided(choices=LABELS + ("INVALID",)))
 
 
 def extract_option_index(text, num_options=4):
@@ -133,6 +131,7 @@ def extract_option_index(text, num_options=4):
             return idx
     return ""
 
+
 # NEW: 从 analyst 的回答中抽取 REASON 文本
 def extract_reason(text: str) -> str:
     if not text:
@@ -189,9 +188,68 @@ Now, choose the SINGLE best label for this score.
 
 Your answer (ONLY one number 0/1/2/3):"""
 
+@llm.stage("content_checker")
 def content_checker_llm(prompt, analyst_answers, clean_labels, analyst_reasons):
     judge_prompt = build_judge_prompt(prompt, analyst_answers, clean_labels, analyst_reasons)
-    return call_llm(judge_prompt, max_tokens=4, temperature=0.0)
+    return call_llm(judge_prompt, max_tokens=4, temperature=0.0, **llm.guided(choices=LABELS))
+
+
+# Logprob mode: one request per score asks for the label token only and reads the
+# probability of every label from its top_logprobs
+logprob_instruction = f"""You are an emotion classifier for musical scores written in ABC notation.
+
+Decide which ONE of the following 4 categories the input score belongs to.
+
+{category_text}
+
+Here are some examples of how scores are labeled:
+{fewshot_block}
+"""
+
+def build_logprob_prompt(prompt):
+    return f"""{logprob_instruction}
+
+Now classify the following score:
+
+Score:
+{prompt}
+
+Answer with ONLY the label number (0, 1, 2, or 3):"""
+
+# Not guided: guided decoding masks the other tokens, so the top_logprobs it
+# returns are not the model's distribution over the labels
+@llm.stage("label_logprobs")
+def label_distribution(prompt):
+    return llm.label_distribution(build_logprob_prompt(prompt), model_name, LABELS)
+
+
+# Temperature applied to the label logprobs before renormalizing (EMOTION_LOGPROB_TEMPERATURE);
+# each run prints the temperature that would have calibrated its confidences best
+logprob_temperature = float(os.environ.get("EMOTION_LOGPROB_TEMPERATURE", 1.0))
+
+def label_probabilities(logprobs, temperature=1.0):
+    """Probability of each label, renormalized over the labels (0 for labels missing from top_logprobs)."""
+    top = max(logprobs.values())
+    weights = {label: math.exp((value - top) / temperature) for label, value in logprobs.items()}
+    total = sum(weights.values())
+    return {label: weights.get(label, 0.0) / total for label in LABELS}
+
+def expected_calibration_error(confidences, correct, bins=10):
+    """Mean |accuracy - confidence| over equal-width confidence bins, weighted by bin size."""
+    error = 0.0
+    for b in range(bins):
+        members = [k for k, c in enumerate(confidences) if b / bins < c <= (b + 1) / bins or (b == 0 and c == 0)]
+        if members:
+            accuracy = sum(correct[k] for k in members) / len(members)
+            confidence = sum(confidences[k] for k in members) / len(members)
+            error += len(members) / len(confidences) * abs(accuracy - confidence)
+    return error
+
+def fit_temperature(logprobs_list, truths):
+    """Temperature in 0.25-5 that minimizes the negative log-likelihood of the ground-truth labels."""
+    def nll(temperature):
+        return -sum(math.log(max(label_probabilities(lp, temperature).get(t, 0.0), 1e-6)) for lp, t in zip(logprobs_list, truths))
+    return min((0.25 + 0.05 * k for k in range(96)), key=nll)
 
 
 predictions_single = []
@@ -206,96 +264,175 @@ correct_single = 0
 correct_majority = 0
 correct_agent = 0
 
+# Answers parsed, and how many of them needed the LLM format checker
+parsed_answers = 0
+format_checker_calls = 0
+
+# Logprob mode results; LLM requests per mode
+predictions_logprob = []
+logprob_confidences = []
+raw_logprobs = []
+correct_logprob = 0
+voting_calls = 0
+logprob_calls = 0
+
 for i, row in df.iterrows():
 
     prompt = row["prompt"]
 
+    if mode != "voting":
+        try:
+            text, logprobs = label_distribution(prompt)
+            logprob_calls += 1
+            if logprobs:
+                probs = label_probabilities(logprobs, logprob_temperature)
+                logprob_label = max(probs, key=probs.get)
+                confidence = probs[logprob_label]
+            else:
+                # No logprobs from the endpoint: the greedy answer without a confidence
+                logprob_label = parse_label(text)
+                confidence = None
+        except Exception as e:
+            print("Error at sample", i, e)
+            logprob_label, confidence, logprobs = "", None, None
+        predictions_logprob.append(logprob_label)
+        logprob_confidences.append(confidence)
+        raw_logprobs.append(logprobs)
+        if str(logprob_label) == str(row["solution"]):
+            correct_logprob += 1
+        confidence_str = f" (p={confidence:.2f})" if confidence is not None else ""
+        print(f"[{i}] GT={row['solution']} | logprob={logprob_label}{confidence_str}")
+
+    if mode == "logprobs":
+        continue
+
+    # The sample's values are appended once, after the try, so a failed call
+    # cannot leave the result columns with different lengths
+    analyst_answers = []
+    analyst_reasons = []  # NEW: 当前样本的 reasons
+    format_checks = []  # 当前样本的 format checks
+    single_label = majority_label = final_label = judge_answer = ""
+
     try:
-        analyst_answers = []
         clean_labels = []
-        analyst_reasons = []  # NEW: 当前样本的 reasons
-        format_checks = []  # 当前样本的 format checks
 
-        for k in range(num_analysts):
-            ans = analyst_answer_once(prompt)
+        answers = analyst_answers_all(prompt, num_analysts)
+        voting_calls += answers.requests
+        for ans in answers:
             analyst_answers.append(ans)
 
-            fmt = format_checker_llm(ans)
-            format_checks.append(fmt)
-
-            if fmt.strip().upper() == "INVALID":
-                lab = extract_option_index(ans)
+            lab = parse_label(ans)
+            if lab:
+                fmt = lab
             else:
-                lab = extract_option_index(fmt)
+                fmt = format_checker_llm(ans)
+                format_checker_calls += 1
+                voting_calls += 1
+                if fmt.strip().upper() == "INVALID":
+                    lab = extract_option_index(ans)
+                else:
+                    lab = extract_option_index(fmt)
+            parsed_answers += 1
+            format_checks.append(fmt)
             clean_labels.append(lab)
 
             # NEW: 提取理由
             reason = extract_reason(ans)
             analyst_reasons.append(reason)
 
-        raw_analyst_answers.append(analyst_answers)
-        analyst_reasons_all.append(analyst_reasons)
-
         single_label = clean_labels[0] if clean_labels and clean_labels[0] in ["0", "1", "2", "3"] else ""
-        predictions_single.append(single_label)
-
-        if str(single_label) == str(row["solution"]):
-            correct_single += 1
 
         valid_labels = [l for l in clean_labels if l in ["0", "1", "2", "3"]]
         if valid_labels:
             majority_label = Counter(valid_labels).most_common(1)[0][0]
         else:
             majority_label = ""
-        predictions_majority.append(majority_label)
-
-        if str(majority_label) == str(row["solution"]):
-            correct_majority += 1
 
         # CHANGED: 传入 analyst_reasons
         judge_answer = content_checker_llm(prompt, analyst_answers, clean_labels, analyst_reasons)
-        raw_judge_answers.append(judge_answer)
+        voting_calls += 1
 
         final_label = extract_option_index(judge_answer)
         if not final_label and valid_labels:
             final_label = majority_label
 
-        predictions_agent.append(final_label)
-
-        if str(final_label) == str(row["solution"]):
-            correct_agent += 1
-
         print(f"[{i}] GT={row['solution']} | single={single_label} | majority={majority_label} | agent={final_label}")
 
     except Exception as e:
         print("Error at sample", i, e)
-        predictions_single.append("")
-        predictions_majority.append("")
-        predictions_agent.append("")
-        raw_analyst_answers.append([])
-        raw_format_checks.append([])
-        raw_judge_answers.append("")
-        analyst_reasons_all.append([])
-
-results_df = pd.DataFrame({
+        analyst_answers = []
+        analyst_reasons = []
+        format_checks = []
+        single_label = majority_label = final_label = judge_answer = ""
+
+    predictions_single.append(single_label)
+    predictions_majority.append(majority_label)
+    predictions_agent.append(final_label)
+    raw_analyst_answers.append(analyst_answers)
+    raw_format_checks.append(format_checks)
+    analyst_reasons_all.append(analyst_reasons)
+    raw_judge_answers.append(judge_answer)
+
+    if str(single_label) == str(row["solution"]):
+        correct_single += 1
+    if str(majority_label) == str(row["solution"]):
+        correct_majority += 1
+    if str(final_label) == str(row["solution"]):
+        correct_agent += 1
+
+results = {
     'index': df.index,
     'ground_truth': df['solution'].values,
-    'prediction_single': predictions_single,
-    'prediction_majority': predictions_majority,
-    'prediction_agent': predictions_agent,
-    'raw_analyst_answers': raw_analyst_answers,
-    'raw_format_checks': raw_format_checks,
-    'analyst_reasons': analyst_reasons_all,     # NEW: 存每个样本的 reason 列表
-    'raw_judge_answer': raw_judge_answers
-})
+}
+if mode != "logprobs":
+    results.update({
+        'prediction_single': predictions_single,
+        'prediction_majority': predictions_majority,
+        'prediction_agent': predictions_agent,
+        'raw_analyst_answers': raw_analyst_answers,
+        'raw_format_checks': raw_format_checks,
+        'analyst_reasons': analyst_reasons_all,     # NEW: 存每个样本的 reason 列表
+        'raw_judge_answer': raw_judge_answers
+    })
+if mode != "voting":
+    results.update({
+        'prediction_logprob': predictions_logprob,
+        'logprob_confidence': logprob_confidences,
+        'label_logprobs': raw_logprobs
+    })
+results_df = pd.DataFrame(results)
 results_df.to_csv('emotion_recognition_agent_results.csv', index=False)
 
-accuracy_single = correct_single / len(df)
-accuracy_majority = correct_majority / len(df)
-accuracy_agent = correct_agent / len(df)
-
 print("\n===========================")
 print(f"Model: {model_name}")
-print(f"Single LLM accuracy: {accuracy_single:.4f}")
-print(f"Majority vote accuracy: {accuracy_majority:.4f}")
-print(f"Multi-agent accuracy: {accuracy_agent:.4f}")
+if mode != "logprobs":
+    accuracy_single = correct_single / len(df)
+    accuracy_majority = correct_majority / len(df)
+    accuracy_agent = correct_agent / len(df)
+
+    print(f"Single LLM accuracy: {accuracy_single:.4f}")
+    print(f"Majority vote accuracy: {accuracy_majority:.4f}")
+    print(f"Multi-agent accuracy: {accuracy_agent:.4f}")
+    if parsed_answers:
+        print(f"Format checker fallback: {format_checker_calls}/{parsed_answers} analyst answers "
+              f"({format_checker_calls / parsed_answers:.1%}) needed the LLM, the rest were parsed locally")
+if mode != "voting":
+    print(f"Logprob accuracy: {correct_logprob / len(df):.4f}")
+    scored = [(c, str(p) == str(t)) for c, p, t in zip(logprob_confidences, predictions_logprob, df['solution'])
+              if c is not None]
+    if scored:
+        confidences = [c for c, _ in scored]
+        correct = [ok for _, ok in scored]
+        brier = sum((c - ok) ** 2 for c, ok in scored) / len(scored)
+        print(f"Logprob confidence (temperature {logprob_temperature:g}): mean {sum(confidences) / len(confidences):.3f}, "
+              f"ECE {expected_calibration_error(confidences, correct):.3f}, Brier {brier:.3f} "
+              f"({len(scored)}/{len(df)} samples with logprobs)")
+        fitted = [(lp, str(t)) for lp, t in zip(raw_logprobs, df['solution']) if lp]
+        temperature = fit_temperature([lp for lp, _ in fitted], [t for _, t in fitted])
+        print(f"Best-fit temperature on this run: {temperature:.2f} (set EMOTION_LOGPROB_TEMPERATURE to calibrate)")
+    else:
+        print("Logprob confidence: the endpoint returned no logprobs, predictions are the greedy answers")
+if mode == "compare":
+    print(f"LLM calls per sample: voting pipeline {voting_calls / len(df):.2f}, logprob {logprob_calls / len(df):.2f}")
+    agreement = sum(str(a) == str(b) for a, b in zip(predictions_agent, predictions_logprob)) / len(df)
+    print(f"Logprob prediction agrees with the multi-agent prediction on {agreement:.1%} of samples")
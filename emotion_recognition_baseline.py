@@ -1,5 +1,4 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
 import pandas as pd
 from scipy.stats import kendalltau
 import re
@@ -14,11 +13,6 @@ if len(sys.argv) > 1 and sys.argv[1].startswith('--'):
     n = int(sys.argv[1][2:])
     df = df.head(n)
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
 
 def extract_option_index(pred_raw, num_options=10):
 
@@ -63,14 +57,10 @@ for i, row in df.iterrows():
 
     prompt = row["prompt"] 
 
+    saving = None
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        raw_response = response.choices[0].message.content
+        # With LLM_STREAM=1 generation stops once the answer starts with a number and a delimiter ("2.", "2)")
+        raw_response, saving = llm.complete_until(prompt, model_name, llm.leading_number, temperature=0)
         pred = extract_option_index(raw_response)
         raw_responses.append(raw_response)
 
@@ -85,7 +75,7 @@ for i, row in df.iterrows():
     if str(pred) == str(row["solution"]):
         correct += 1
 
-    print(f"[{i}] GT={row['solution']} | Pred={pred}")
+    print(f"[{i}] GT={row['solution']} | Pred={pred}{llm.describe_saving(saving)}")
 
 # Save results to CSV
 results_df = pd.DataFrame({
@@ -2,6 +2,13 @@ import globus_sdk
 from globus_sdk.login_flows import LocalServerLoginFlowManager # Needed to access globus_sdk.gare
 import os.path
 import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock
+    fcntl = None
 
 # Globus UserApp name
 APP_NAME = "inference_app"
@@ -16,6 +23,15 @@ GATEWAY_SCOPE = f"https://auth.globus.org/scopes/{GATEWAY_CLIENT_ID}/action_all"
 # Path where access and refresh tokens are stored
 TOKENS_PATH = f"{os.path.expanduser('~')}/.globus/app/{AUTH_CLIENT_ID}/{APP_NAME}/tokens.json"
 
+# Lock file used to serialize token refreshes between parallel worker processes
+TOKENS_LOCK_PATH = f"{TOKENS_PATH}.lock"
+
+# Refresh the access token this many seconds before it expires
+REFRESH_MARGIN_SECONDS = 10 * 60
+
+# Wait before retrying a failed background refresh
+REFRESH_RETRY_SECONDS = 60
+
 # Allowed identity provider domains
 ALLOWED_DOMAINS = ["anl.gov", "alcf.anl.gov", "uchicago.edu"]
 
@@ -60,6 +76,123 @@ def get_auth_object(force=False):
     return auth
 
 
+# Exclusive lock on the token file shared by all processes of this user
+@contextmanager
+def tokens_file_lock():
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(TOKENS_LOCK_PATH), exist_ok=True)
+    with open(TOKENS_LOCK_PATH, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class TokenManager:
+    """
+    Keeps the access token and its expiration time in memory.
+
+    The Globus UserApp is only built when the token has to be (re)loaded.
+    Once a listener is subscribed (e.g. the shared OpenAI clients), a background
+    thread refreshes the token ahead of expiry and hands the new token to every
+    listener, so long batch runs never stall on an expired token. Refreshes are
+    serialized across processes with a file lock: a worker that waited for the
+    lock picks up the token another worker just stored in tokens.json.
+    """
+
+    def __init__(self, refresh_margin=REFRESH_MARGIN_SECONDS):
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def _needs_refresh(self):
+        return self.access_token is None or time.time() >= self.expires_at - self.refresh_margin
+
+    def _refresh(self, force=False):
+        # Called with self._lock held
+        with tokens_file_lock():
+            # Reads tokens.json, so a token refreshed by another process is reused
+            auth = get_auth_object()
+            if not force:
+                auth.ensure_valid_token()
+            if force or auth.expires_at - time.time() < self.refresh_margin:
+                # Rejected by the server, or still close to expiry: exchange the
+                # refresh token for a new access token now
+                auth.handle_missing_authorization()
+                auth.ensure_valid_token()
+            self.access_token = auth.access_token
+            self.expires_at = auth.expires_at
+
+    def get_token(self):
+        """Return a valid access token, refreshing it first if it is about to expire."""
+        with self._lock:
+            if self._needs_refresh():
+                self._refresh()
+            return self.access_token
+
+    def force_refresh(self):
+        """
+        Fetch a new access token now (e.g. after a 401), even if the stored one
+        has not expired, and notify listeners.
+        """
+        with self._lock:
+            self.access_token = None
+            self._refresh(force=True)
+            token = self.access_token
+        self._notify(token)
+        return token
+
+    def subscribe(self, listener):
+        """
+        Call listener(new_token) after every refresh and start the background refresher.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+        self._start_refresher()
+
+    def _notify(self, token):
+        for listener in list(self._listeners):
+            listener(token)
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            wait = max(self.expires_at - self.refresh_margin - time.time(), 0)
+            if self._stop.wait(wait):
+                return
+            try:
+                with self._lock:
+                    refreshed = self._needs_refresh()
+                    if refreshed:
+                        self._refresh()
+                    token = self.access_token
+                if refreshed:
+                    self._notify(token)
+            except Exception as e:
+                print(f"Background token refresh failed: {e}")
+                self._stop.wait(REFRESH_RETRY_SECONDS)
+
+    def stop(self):
+        self._stop.set()
+
+
+# Process-wide token manager
+token_manager = TokenManager()
+
+
 # Get access token
 def get_access_token():
     """
@@ -67,16 +200,9 @@ def get_access_token():
     and return the valid access token. If there is no token stored
     in the home directory, or if the refresh token is expired following
     6 months of inactivity, an authentication will be triggered.
+    The token is kept in memory by the shared TokenManager.
     """
-
-    # Get authorizer object and authenticate if need be
-    auth = get_auth_object()
-
-    # Make sure the stored access token if valid, and refresh otherwise
-    auth.ensure_valid_token()
-
-    # Return the access token
-    return auth.access_token
+    return token_manager.get_token()
 
 
 # Get time until token expiration
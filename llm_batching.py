@@ -0,0 +1,318 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from openai import BadRequestError, NotFoundError
+from openai.types.chat import ChatCompletion
+
+from llm_scheduler import is_async_client
+
+# Collect calls for this long before sending a batch (milliseconds)
+DEFAULT_WINDOW_MS = 5.0
+
+# Send a batch as soon as it holds this many prompts
+DEFAULT_MAX_BATCH = 32
+
+# Request fields a /v1/completions batch can carry (shared by every prompt in the batch)
+BATCHABLE_FIELDS = ("model", "messages", "temperature", "max_tokens", "stop", "top_p", "seed")
+
+# Chat templates for models served by the endpoint, keyed by a model name fragment.
+# BOS is left out: the server adds it when tokenizing a completion prompt.
+CHAT_TEMPLATES = {
+    "gemma": "<start_of_turn>user\n{content}<end_of_turn>\n<start_of_turn>model\n",
+    "llama-3": ("<|start_header_id|>system<|end_header_id|>\n\n"
+                "Cutting Knowledge Date: December 2023\nToday Date: 26 Jul 2024\n\n<|eot_id|>"
+                "<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>"
+                "<|start_header_id|>assistant<|end_header_id|>\n\n"),
+}
+
+
+def micro_batching_from_env():
+    """Micro-batching is off unless LLM_MICRO_BATCH is set to 1/on/true/yes."""
+    return os.environ.get("LLM_MICRO_BATCH", "0").strip().lower() in ("1", "on", "true", "yes")
+
+
+def chat_template(model):
+    """Template for a model name, or None if prompts for it cannot be rendered client-side."""
+    model = model.lower()
+    for fragment, template in CHAT_TEMPLATES.items():
+        if fragment in model:
+            return template
+    return None
+
+
+def batch_key(request):
+    """
+    Return (key, prompt) for a request that can join a completion batch, else (None, None).
+    Requests share a batch only if all their sampling parameters match.
+    """
+    if any(field not in BATCHABLE_FIELDS for field in request):
+        return None, None
+    messages = request.get("messages") or []
+    if len(messages) != 1 or messages[0].get("role") != "user" or not isinstance(messages[0].get("content"), str):
+        return None, None
+    template = chat_template(request.get("model", ""))
+    if template is None:
+        return None, None
+    params = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in request.items() if k != "messages"))
+    return params, template.format(content=messages[0]["content"].strip())
+
+
+def apportion(total, weights):
+    """Split an integer total in proportion to weights (the rounding remainder goes to the first)."""
+    if not weights:
+        return []
+    if not sum(weights):
+        weights = [1] * len(weights)
+    shares = [total * w // sum(weights) for w in weights]
+    shares[0] += total - sum(shares)
+    return shares
+
+
+def split_usage(usage, prompts, choices):
+    """
+    Per-prompt usage dicts for one batch response (None if it has no usage):
+    prompt tokens in proportion to prompt length, completion tokens to answer length.
+    """
+    if usage is None:
+        return [None] * len(choices)
+    prompt_tokens = apportion(usage.prompt_tokens, [len(prompt) for prompt in prompts[:len(choices)]])
+    completion_tokens = apportion(usage.completion_tokens, [len(choice.text or "") for choice in choices])
+    return [{"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+            for p, c in zip(prompt_tokens, completion_tokens)]
+
+
+def to_chat_completion(response, choice, usage=None):
+    """Turn one choice of a text completion into the ChatCompletion the caller asked for."""
+    return ChatCompletion.model_validate({
+        "id": response.id,
+        "object": "chat.completion",
+        "created": response.created,
+        "model": response.model,
+        "choices": [{
+            "index": 0,
+            "finish_reason": choice.finish_reason or "stop",
+            "message": {"role": "assistant", "content": choice.text}
+        }],
+        "usage": usage
+    })
+
+
+class _BatchingUnsupported(Exception):
+    """The endpoint rejected the batch request: callers fall back to chat requests."""
+
+
+class _Batch:
+    def __init__(self, params):
+        self.params = dict(params)
+        self.prompts = []
+        self.futures = []
+
+
+class MicroBatcher:
+    """
+    Shared batching state and statistics for one client.
+
+    Calls with the same sampling parameters that arrive within window_ms are
+    sent as one /v1/completions request with a list of prompts (chat template
+    applied here). The first caller of a batch waits out the window and sends
+    it; a caller that fills the batch to max_batch sends it at once. Every
+    caller gets back its own ChatCompletion.
+    """
+
+    def __init__(self, window_ms=DEFAULT_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.enabled = True
+        self.batches = 0
+        self.batched_calls = 0
+        self.single_calls = 0
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def join(self, request, future):
+        """
+        Add a request to the open batch for its parameters.
+        Returns (batch, leader, full) or None if the request cannot be batched.
+        """
+        if not self.enabled:
+            return None
+        key, prompt = batch_key(request)
+        if key is None:
+            return None
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch(key)
+            batch.prompts.append(prompt)
+            batch.futures.append(future)
+            full = len(batch.prompts) >= self.max_batch
+            if full:
+                del self._open[key]
+        return batch, leader, full
+
+    def close(self, batch):
+        """Close the batch if it is still open. Returns True if the caller must send it."""
+        with self._lock:
+            for key, open_batch in self._open.items():
+                if open_batch is batch:
+                    del self._open[key]
+                    return True
+        return False
+
+    def deliver(self, batch, response):
+        with self._lock:
+            self.batches += 1
+            self.batched_calls += len(batch.prompts)
+        choices = sorted(response.choices, key=lambda c: c.index)
+        usages = split_usage(response.usage, batch.prompts, choices)
+        for i, future in enumerate(batch.futures):
+            # A caller that was cancelled no longer waits for its answer
+            if future.done():
+                continue
+            if i < len(choices):
+                future.set_result(to_chat_completion(response, choices[i], usages[i]))
+            else:
+                future.set_exception(_BatchingUnsupported(f"batch returned {len(choices)} of {len(batch.futures)} prompts"))
+
+    def fail(self, batch, error):
+        if isinstance(error, (BadRequestError, NotFoundError)):
+            print(f"Endpoint rejected a completion batch, sending chat requests instead: {error}")
+            self.enabled = False
+            error = _BatchingUnsupported(str(error))
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def report(self):
+        calls = self.batched_calls + self.single_calls
+        mean = self.batched_calls / self.batches if self.batches else 0.0
+        return (f"Micro-batching: {self.batched_calls}/{calls} calls sent in {self.batches} batches "
+                f"(mean batch size {mean:.1f}), {self.single_calls} sent alone")
+
+
+class BatchingCompletions:
+    """
+    Drop-in for client.chat.completions: batchable calls go through the
+    micro-batcher, the rest are sent as chat requests. Both kinds of request
+    run through the scheduler.
+    """
+
+    def __init__(self, client, scheduler, batcher):
+        self._client = client
+        self._scheduler = scheduler
+        self._batcher = batcher
+
+    def _send(self, batch):
+        try:
+            response = self._scheduler.run(lambda: self._client.completions.create(prompt=batch.prompts, **batch.params))
+        except Exception as e:
+            self._batcher.fail(batch, e)
+        else:
+            self._batcher.deliver(batch, response)
+
+    def _create_single(self, request):
+        with self._batcher._lock:
+            self._batcher.single_calls += 1
+        return self._scheduler.run(lambda: self._client.chat.completions.create(**request),
+                                   stream=bool(request.get("stream")))
+
+    def create(self, **request):
+        future = Future()
+        joined = self._batcher.join(request, future)
+        if joined is None:
+            return self._create_single(request)
+        batch, leader, full = joined
+        if full:
+            self._send(batch)
+        elif leader:
+            time.sleep(self._batcher.window)
+            if self._batcher.close(batch):
+                self._send(batch)
+        try:
+            return future.result()
+        except _BatchingUnsupported:
+            return self._create_single(request)
+
+
+class AsyncBatchingCompletions(BatchingCompletions):
+    """Async version of BatchingCompletions (the batch window is an asyncio sleep)."""
+
+    async def _send(self, batch):
+        try:
+            response = await self._scheduler.arun(lambda: self._client.completions.create(prompt=batch.prompts, **batch.params))
+        except Exception as e:
+            self._batcher.fail(batch, e)
+        else:
+            self._batcher.deliver(batch, response)
+
+    def _abandon(self, batch):
+        """The sending caller was cancelled: the other callers of the batch send their own requests."""
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(_BatchingUnsupported("the caller sending the batch was cancelled"))
+
+    async def _create_single(self, request):
+        with self._batcher._lock:
+            self._batcher.single_calls += 1
+        return await self._scheduler.arun(lambda: self._client.chat.completions.create(**request),
+                                          stream=bool(request.get("stream")))
+
+    async def create(self, **request):
+        future = asyncio.get_running_loop().create_future()
+        joined = self._batcher.join(request, future)
+        if joined is None:
+            return await self._create_single(request)
+        batch, leader, full = joined
+        sending = full
+        try:
+            if full:
+                await self._send(batch)
+            elif leader:
+                await asyncio.sleep(self._batcher.window)
+                sending = self._batcher.close(batch)
+                if sending:
+                    await self._send(batch)
+        except asyncio.CancelledError:
+            # Cancelled while waiting out the window or sending: the other callers send their own requests
+            future.cancel()
+            if sending or self._batcher.close(batch):
+                self._abandon(batch)
+            raise
+        try:
+            return await future
+        except _BatchingUnsupported:
+            return await self._create_single(request)
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class BatchingClient:
+    """Wraps an OpenAI / AsyncOpenAI client so that small chat requests are micro-batched."""
+
+    def __init__(self, client, scheduler, batcher, is_async=False):
+        self._client = client
+        self.batcher = batcher
+        completions_cls = AsyncBatchingCompletions if is_async else BatchingCompletions
+        self.chat = _Chat(completions_cls(client, scheduler, batcher))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def batching_client(client, scheduler, window_ms=None, max_batch=None):
+    """
+    Wrap a sync or async OpenAI client with a micro-batcher (LLM_BATCH_WINDOW_MS,
+    LLM_BATCH_MAX). Takes the place of llm_scheduler.scheduled_client.
+    """
+    batcher = MicroBatcher(
+        window_ms=window_ms if window_ms is not None else float(os.environ.get("LLM_BATCH_WINDOW_MS", DEFAULT_WINDOW_MS)),
+        max_batch=max_batch if max_batch is not None else int(os.environ.get("LLM_BATCH_MAX", DEFAULT_MAX_BATCH))
+    )
+    return BatchingClient(client, scheduler, batcher, is_async=is_async_client(client))
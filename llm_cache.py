@@ -0,0 +1,448 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import atexit
+
+from openai.types.chat import ChatCompletion
+
+import llm_telemetry as telemetry
+from llm_scheduler import is_async_client
+
+# Location of the shared cache database (one file for every script)
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache", "responses.sqlite")
+
+# Eviction limits
+DEFAULT_MAX_MB = 512
+DEFAULT_MAX_AGE_DAYS = 30
+
+# Run eviction after this many new entries
+EVICT_EVERY = 200
+
+# Most ABC analyses kept on disk (least recently used ones are dropped first)
+DEFAULT_MAX_ANALYSES = 20000
+
+# Request fields that never change the generated text
+IGNORED_FIELDS = ("timeout", "extra_headers", "stream")
+
+
+def cache_enabled_from_env():
+    """The cache is on unless LLM_CACHE is set to 0/off/false/no."""
+    return os.environ.get("LLM_CACHE", "1").strip().lower() not in ("0", "off", "false", "no")
+
+
+def request_key(request):
+    """
+    Content hash of a chat completion request: model, messages, temperature,
+    max_tokens, stop, seed, n and any other generation parameter.
+    """
+    fields = {k: v for k, v in request.items() if k not in IGNORED_FIELDS and v is not None}
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(request):
+    """Greedy (temperature 0) or seeded requests always produce the same answer."""
+    return (request.get("temperature") or 0) == 0 or request.get("seed") is not None
+
+
+class ResponseCache:
+    """
+    On-disk LLM response cache (SQLite in WAL mode, safe for several processes).
+
+    Deterministic requests are stored under their request hash. Sampled requests
+    (temperature > 0, no seed) get one slot per repetition within a run, so the
+    k-th identical analyst call of a rerun replays the k-th sample of the first
+    run instead of collapsing every vote onto the same answer.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_mb=DEFAULT_MAX_MB, max_age_days=DEFAULT_MAX_AGE_DAYS, enabled=True):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sample_slots = {}
+        self._stores_since_evict = 0
+
+        if self.enabled:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = self._conn()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+            conn.commit()
+            self.evict()
+
+    def _conn(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def slot_key(self, request):
+        """Cache key for this request, including the sample slot for sampled requests."""
+        key = request_key(request)
+        if is_deterministic(request):
+            return key
+        with self._lock:
+            slot = self._sample_slots.get(key, 0)
+            self._sample_slots[key] = slot + 1
+        return f"{key}:{slot}"
+
+    def get(self, key, count_miss=True):
+        """Return the stored response JSON, or None on a miss."""
+        conn = self._conn()
+        row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.max_age_seconds:
+            if count_miss:
+                with self._lock:
+                    self.misses += 1
+            return None
+        conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        conn.commit()
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def put(self, key, value, model=None):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, value, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, value, len(value), now, now)
+        )
+        conn.commit()
+        with self._lock:
+            self.stores += 1
+            self._stores_since_evict += 1
+            run_evict = self._stores_since_evict >= EVICT_EVERY
+            if run_evict:
+                self._stores_since_evict = 0
+        if run_evict:
+            self.evict()
+
+    def evict(self):
+        """Drop entries older than max_age, then least recently used ones until under max size."""
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            freed = 0
+            stale_keys = []
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+                stale_keys.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            removed += len(stale_keys)
+        conn.commit()
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM responses")
+        conn.commit()
+
+    def summary(self):
+        """Number of entries and total stored bytes."""
+        return self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f"LLM cache: {self.hits} hits / {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.stores} stored, {self.evictions} evicted")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Shared process-wide cache configured from the environment (LLM_CACHE, LLM_CACHE_PATH, ...)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                path=os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                max_mb=float(os.environ.get("LLM_CACHE_MAX_MB", DEFAULT_MAX_MB)),
+                max_age_days=float(os.environ.get("LLM_CACHE_MAX_AGE_DAYS", DEFAULT_MAX_AGE_DAYS)),
+                enabled=cache_enabled_from_env()
+            )
+            atexit.register(_print_report)
+        return _cache
+
+
+def _print_report():
+    if _cache is not None and _cache.enabled and (_cache.hits or _cache.misses):
+        print(_cache.report())
+
+
+def normalize_score(score):
+    """Normalize an ABC score for lookup: unify newlines, strip each line, drop blank lines."""
+    lines = [line.strip() for line in str(score).replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    return "\n".join(line for line in lines if line)
+
+
+class AnalysisStore:
+    """
+    One ABC expert analysis per (normalized score, expert model), shared by every
+    question and task that refers to the same score. Analyses are kept in memory
+    for the run and persisted next to the response cache (unless LLM_CACHE=0).
+    Stored analyses expire with the response cache's max age, and at most
+    max_entries are kept (least recently used ones are evicted first).
+    """
+
+    def __init__(self, cache, max_entries=DEFAULT_MAX_ANALYSES):
+        self._cache = cache
+        self.max_entries = max_entries
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._async_locks = {}
+        self._saves_since_evict = 0
+
+        self.generated = 0
+        self.reused = 0
+        self.evictions = 0
+
+        if self._cache.enabled:
+            conn = self._cache._conn()
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    analysis TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL
+                )
+            """)
+            # Tables written before eviction existed have no last_used column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(analyses)")]
+            if "last_used" not in columns:
+                conn.execute("ALTER TABLE analyses ADD COLUMN last_used REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_analyses_last_used ON analyses(last_used)")
+            conn.commit()
+            self.evict()
+
+    def key(self, score, model):
+        payload = json.dumps([model, normalize_score(score)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        analysis = self._memory.get(key)
+        if analysis is None and self._cache.enabled:
+            conn = self._cache._conn()
+            now = time.time()
+            row = conn.execute("SELECT analysis FROM analyses WHERE key = ? AND created_at >= ?",
+                               (key, now - self._cache.max_age_seconds)).fetchone()
+            if row is not None:
+                analysis = self._memory[key] = row[0]
+                conn.execute("UPDATE analyses SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+        return analysis
+
+    def _save(self, key, model, analysis):
+        self._memory[key] = analysis
+        if self._cache.enabled:
+            now = time.time()
+            conn = self._cache._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, model, analysis, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, analysis, now, now)
+            )
+            conn.commit()
+            with self._lock:
+                self._saves_since_evict += 1
+                run_evict = self._saves_since_evict >= EVICT_EVERY
+                if run_evict:
+                    self._saves_since_evict = 0
+            if run_evict:
+                self.evict()
+
+    def evict(self):
+        """Drop analyses older than the cache's max age, then least recently used ones beyond max_entries."""
+        conn = self._cache._conn()
+        removed = conn.execute("DELETE FROM analyses WHERE created_at < ?",
+                               (time.time() - self._cache.max_age_seconds,)).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        if count > self.max_entries:
+            removed += conn.execute(
+                "DELETE FROM analyses WHERE key IN "
+                "(SELECT key FROM analyses ORDER BY COALESCE(last_used, created_at) ASC LIMIT ?)",
+                (count - self.max_entries,)
+            ).rowcount
+        conn.commit()
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    def _record(self, key, model, analysis, generated):
+        with self._lock:
+            if generated:
+                self.generated += 1
+            else:
+                self.reused += 1
+        if generated and analysis:
+            self._save(key, model, analysis)
+
+    def get_or_create(self, score, model, produce):
+        """Return the stored analysis of `score`, calling produce(score) only the first time."""
+        key = self.key(score, model)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Concurrent requests for the same score wait for the first one
+        with key_lock:
+            analysis = self._lookup(key)
+            generated = analysis is None
+            if generated:
+                analysis = produce(score)
+            self._record(key, model, analysis, generated)
+            if analysis:
+                # Later requests find the analysis in memory without the lock
+                with self._lock:
+                    self._key_locks.pop(key, None)
+            return analysis
+
+    async def aget_or_create(self, score, model, produce):
+        """Async version of get_or_create; produce is a coroutine function."""
+        key = self.key(score, model)
+        # asyncio locks belong to one event loop
+        lock_key = (id(asyncio.get_running_loop()), key)
+        key_lock = self._async_locks.setdefault(lock_key, asyncio.Lock())
+        async with key_lock:
+            analysis = self._lookup(key)
+            generated = analysis is None
+            if generated:
+                analysis = await produce(score)
+            self._record(key, model, analysis, generated)
+            if analysis:
+                self._async_locks.pop(lock_key, None)
+            return analysis
+
+    def report(self):
+        return (f"ABC expert: {self.generated} analyses generated, {self.reused} reused "
+                f"({self.reused} expert calls saved)" + (f", {self.evictions} evicted" if self.evictions else ""))
+
+
+_analysis_store = None
+
+
+def get_analysis_store():
+    """Shared process-wide ABC analysis store."""
+    global _analysis_store
+    cache = get_cache()
+    with _cache_lock:
+        if _analysis_store is None:
+            _analysis_store = AnalysisStore(
+                cache, max_entries=int(os.environ.get("LLM_ANALYSIS_MAX_ENTRIES", DEFAULT_MAX_ANALYSES)))
+        return _analysis_store
+
+
+class CachedCompletions:
+    """Drop-in for client.chat.completions that serves repeated requests from the cache."""
+
+    def __init__(self, completions, cache):
+        self._completions = completions
+        self._cache = cache
+
+    def create(self, **request):
+        if not self._cache.enabled or request.get("stream"):
+            return self._completions.create(**request)
+        key = self._cache.slot_key(request)
+        cached = self._cache.get(key)
+        telemetry.note(cache="miss" if cached is None else "hit")
+        if cached is not None:
+            return ChatCompletion.model_validate_json(cached)
+        response = self._completions.create(**request)
+        self._cache.put(key, response.model_dump_json(), request.get("model"))
+        return response
+
+
+class AsyncCachedCompletions(CachedCompletions):
+    """Async version of CachedCompletions."""
+
+    async def create(self, **request):
+        if not self._cache.enabled or request.get("stream"):
+            return await self._completions.create(**request)
+        key = self._cache.slot_key(request)
+        cached = self._cache.get(key)
+        telemetry.note(cache="miss" if cached is None else "hit")
+        if cached is not None:
+            return ChatCompletion.model_validate_json(cached)
+        response = await self._completions.create(**request)
+        self._cache.put(key, response.model_dump_json(), request.get("model"))
+        return response
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class CachedClient:
+    """
+    Wraps an OpenAI / AsyncOpenAI client so that chat.completions.create goes
+    through the shared response cache. Every other attribute is passed through.
+    """
+
+    def __init__(self, client, cache=None, is_async=False):
+        self._client = client
+        completions_cls = AsyncCachedCompletions if is_async else CachedCompletions
+        self.chat = _Chat(completions_cls(client.chat.completions, cache or get_cache()))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def cached_client(client, cache=None):
+    """Wrap a sync or async OpenAI client with the shared response cache."""
+    return CachedClient(client, cache, is_async=is_async_client(client))
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or maintain the shared LLM response cache")
+    parser.add_argument("action", choices=["stats", "evict", "clear"])
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if not cache.enabled:
+        print("LLM cache is disabled (LLM_CACHE=0)")
+    elif args.action == "stats":
+        entries, size = cache.summary()
+        print(f"{cache.path}: {entries} entries, {size / 1024 / 1024:.2f} MB")
+    elif args.action == "evict":
+        print(f"Evicted {cache.evict()} entries")
+    elif args.action == "clear":
+        cache.clear()
+        print("Cache cleared")
@@ -0,0 +1,884 @@
+# LLM gateway shared by all scripts.
+#
+# Every request goes through one place:
+#
+#     call_llm / complete / chat / sample  (+ *_async)
+#         -> per-call telemetry: stage, tokens, queue time, latency (llm_telemetry)
+#         -> response cache (llm_cache)
+#         -> in-flight coalescing of identical deterministic calls (llm_coalescing)
+#         -> request scheduler: in-flight limit, retries (llm_scheduler)
+#         -> backend client (one shared connection pool per sync / async client)
+#
+# The backend is chosen with LLM_BACKEND:
+#     alcf   ALCF inference endpoint with Globus token (default)
+#     local  any OpenAI-compatible server, e.g. a local vLLM:
+#            LLM_BASE_URL (default http://localhost:8000/v1), LLM_API_KEY (default EMPTY)
+#     fake   in-process fake that answers without any network I/O
+#            (LLM_FAKE_RESPONSE, LLM_FAKE_LATENCY_MS, or set_fake_responder())
+#
+# LLM_COALESCE=0 turns off coalescing (on by default).
+#
+# Calls are labelled with the pipeline stage they belong to (llm.stage("controller"),
+# as a decorator or a with-block) and logged to .llm_telemetry/calls.jsonl
+# (LLM_TELEMETRY=0 to turn off); a per-stage summary is printed at exit.
+# LLM_TRACE=1 also records stages, llm.span(...) blocks and LLM calls as spans
+# per sample (llm.trace_sample(i)) and writes a Chrome trace at exit (llm_tracing).
+#
+# LLM_MICRO_BATCH=1 sends small concurrent calls as multi-prompt /v1/completions
+# requests (llm_batching).
+#
+# LLM_STREAM=1 streams the calls made with complete_until and closes the stream
+# as soon as the caller has its answer.
+#
+# LLM_GUIDED=1 constrains categorical answers (labels, HIGH/LOW, option indices)
+# with vLLM guided decoding where the call site passes **llm.guided(...); it is
+# switched off automatically on endpoints that reject it.
+#
+# complete_json asks for JSON-schema constrained output (response_format) and
+# falls back to parsing the text when the endpoint does not support it.
+#
+# label_distribution reads the probability of each label from the logprobs of
+# a one-token answer, falling back to the answer text without logprobs.
+#
+# LLM_MODEL overrides the model name hard-coded in the scripts, e.g. when the
+# local server serves a different model.
+import asyncio
+import atexit
+import contextvars
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import BadRequestError
+
+import llm_telemetry as telemetry
+from llm_scheduler import RetriesExhaustedError
+from llm_telemetry import stage
+from llm_tracing import span, trace_sample
+
+# ALCF inference endpoint (OpenAI-compatible vLLM server)
+BASE_URL = "https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
+LOCAL_BASE_URL = "http://localhost:8000/v1"
+
+BACKENDS = ("alcf", "local", "fake")
+BACKEND = os.environ.get("LLM_BACKEND", "alcf").lower()
+MODEL_OVERRIDE = os.environ.get("LLM_MODEL")
+STREAM_EARLY_STOP = os.environ.get("LLM_STREAM", "0").strip().lower() in ("1", "on", "true", "yes")
+
+# Shared clients, created on first use
+_client = None
+_async_client = None
+_lock = threading.Lock()
+
+
+# ---- Fake backend
+
+def _default_fake_responder(request):
+    return os.environ.get("LLM_FAKE_RESPONSE", "0")
+
+_fake_responder = _default_fake_responder
+
+
+def set_fake_responder(responder):
+    """Use responder(request_kwargs) -> str to answer requests on the fake backend."""
+    global _fake_responder
+    _fake_responder = responder or _default_fake_responder
+
+
+def _fake_latency():
+    return float(os.environ.get("LLM_FAKE_LATENCY_MS", 0)) / 1000
+
+
+def _fake_completion(request):
+    from openai.types.chat import ChatCompletion
+
+    n = request.get("n") or 1
+    content = _fake_responder(request)
+    return ChatCompletion.model_validate({
+        "id": "fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "fake"),
+        "choices": [
+            {"index": i, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+            for i in range(n)
+        ],
+        "usage": _fake_usage(request, [content] * n)
+    })
+
+
+def _fake_usage(request, outputs):
+    # Word counts stand in for tokens
+    prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+    completion_tokens = sum(len(str(text).split()) for text in outputs)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _fake_text_completion(request):
+    from openai.types import Completion
+
+    prompts = request["prompt"] if isinstance(request["prompt"], list) else [request["prompt"]]
+    return Completion.model_validate({
+        "id": "fake",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": request.get("model", "fake"),
+        "choices": [
+            {"index": i, "finish_reason": "stop", "logprobs": None, "text": _fake_responder({**request, "prompt": prompt})}
+            for i, prompt in enumerate(prompts)
+        ]
+    })
+
+
+def _fake_chunks(request):
+    from openai.types.chat import ChatCompletionChunk
+
+    content = _fake_responder(request)
+    for piece in re.findall(r"\s*\S+|\s+", content):
+        yield ChatCompletionChunk.model_validate({
+            "id": "fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": piece}}]
+        })
+
+
+def _fake_token_latency():
+    return float(os.environ.get("LLM_FAKE_TOKEN_MS", 0)) / 1000
+
+
+class _FakeStream:
+    """Streams the fake answer one word per chunk, LLM_FAKE_TOKEN_MS apart."""
+
+    def __init__(self, request):
+        self._chunks = _fake_chunks(request)
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            time.sleep(_fake_token_latency())
+            yield chunk
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(_fake_token_latency())
+            yield chunk
+
+    def close(self):
+        self._chunks.close()
+
+
+class _AsyncFakeStream(_FakeStream):
+    async def close(self):
+        self._chunks.close()
+
+
+class _FakeCompletions:
+    def __init__(self, build):
+        self._build = build
+
+    def create(self, **request):
+        time.sleep(_fake_latency())
+        if request.get("stream"):
+            return _FakeStream(request)
+        return self._build(request)
+
+
+class _AsyncFakeCompletions(_FakeCompletions):
+    async def create(self, **request):
+        await asyncio.sleep(_fake_latency())
+        if request.get("stream"):
+            return _AsyncFakeStream(request)
+        return self._build(request)
+
+
+class _FakeChat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class FakeClient:
+    """
+    In-process stand-in for OpenAI / AsyncOpenAI (chat.completions.create and
+    completions.create). Every request takes LLM_FAKE_LATENCY_MS, however many
+    prompts it carries.
+    """
+
+    def __init__(self, is_async=False):
+        completions_cls = _AsyncFakeCompletions if is_async else _FakeCompletions
+        self.chat = _FakeChat(completions_cls(_fake_completion))
+        self.completions = completions_cls(_fake_text_completion)
+
+
+# ---- Client construction
+
+def backend_client(is_async=False, scheduler=None):
+    """
+    Build a raw (Async)OpenAI client for the configured backend, with the
+    client's own retry loop disabled (the request scheduler retries).
+
+    On the ALCF backend the access token is kept up to date: the token manager
+    refreshes ahead of expiry and pushes the new token to the live client, and
+    a 401 seen by the scheduler forces a refresh.
+    """
+    if BACKEND not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND {BACKEND!r}, expected one of {', '.join(BACKENDS)}")
+
+    if BACKEND == "fake":
+        return FakeClient(is_async)
+
+    from openai import AsyncOpenAI, OpenAI
+    client_cls = AsyncOpenAI if is_async else OpenAI
+
+    if BACKEND == "local":
+        return client_cls(api_key=os.environ.get("LLM_API_KEY", "EMPTY"),
+                          base_url=os.environ.get("LLM_BASE_URL", LOCAL_BASE_URL),
+                          max_retries=0)
+
+    from inference_auth_token import token_manager
+
+    raw_client = client_cls(api_key=token_manager.get_token(), base_url=BASE_URL, max_retries=0)
+
+    def update_token(token):
+        raw_client.api_key = token
+
+    token_manager.subscribe(update_token)
+    if scheduler is not None and scheduler.on_unauthorized is None:
+        scheduler.on_unauthorized = token_manager.force_refresh
+    return raw_client
+
+
+def _new_client(is_async):
+    """
+    Build the backend client and wrap it with the request scheduler (in-flight
+    limit, retries with backoff), the micro-batcher if LLM_MICRO_BATCH is set,
+    the in-flight request coalescer and the response cache.
+    """
+    from llm_batching import batching_client, micro_batching_from_env
+    from llm_cache import cached_client
+    from llm_coalescing import coalescing_client
+    from llm_scheduler import get_scheduler, scheduled_client
+
+    scheduler = get_scheduler()
+    raw_client = backend_client(is_async, scheduler)
+    if micro_batching_from_env():
+        wrapped = batching_client(raw_client, scheduler)
+        atexit.register(lambda: print(wrapped.batcher.report()))
+    else:
+        wrapped = scheduled_client(raw_client, scheduler)
+    return cached_client(coalescing_client(wrapped))
+
+
+def get_client():
+    """
+    Return the shared OpenAI client, creating it on first use.
+    Authentication (Globus token lookup / refresh / login) happens here,
+    not when a script or helper module is imported.
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = _new_client(is_async=False)
+        return _client
+
+
+def get_async_client():
+    """Return the shared AsyncOpenAI client, creating it on first use."""
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = _new_client(is_async=True)
+        return _async_client
+
+
+class LazyClient:
+    """
+    Module-level stand-in for a client: `client.chat.completions.create(...)`
+    builds the shared client on the first attribute access.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+client = LazyClient(get_client)
+async_client = LazyClient(get_async_client)
+
+
+# ---- Request API
+
+def _request(prompt, model, params):
+    messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+    request = {"model": MODEL_OVERRIDE or model, "messages": messages}
+    # Leave out unset options (e.g. stop=None) so requests stay identical for the cache
+    request.update({k: v for k, v in params.items() if v is not None})
+    return request
+
+
+def response_text(response):
+    """Text of the first choice, stripped ("" if the model returned no content)."""
+    content = response.choices[0].message.content
+    if content is None:
+        print("Warning: LLM returned None content")
+        return ""
+    return content.strip()
+
+
+# ---- Guided decoding
+
+def _rejects_param(error, *names):
+    """
+    True if error is a 400 response about one of the request parameters names,
+    as opposed to one about this particular request (e.g. a prompt longer than
+    the context window). Only the former switches an optional feature off.
+    """
+    if not isinstance(error, BadRequestError):
+        return False
+    if getattr(error, "param", None) in names:
+        return True
+    message = str(error).lower()
+    return any(re.search(rf"(?<![a-z_]){re.escape(name)}(?![a-z_])", message) for name in names)
+
+
+# LLM_GUIDED=1 constrains categorical answers with vLLM guided decoding
+# (guided_choice / guided_regex in extra_body), see guided(). Switched off
+# automatically when the endpoint rejects it; the answers are then free text.
+use_guided_decoding = os.environ.get("LLM_GUIDED", "0").strip().lower() in ("1", "on", "true", "yes")
+
+GUIDED_FIELDS = ("guided_choice", "guided_regex", "guided_json")
+
+_guided_lock = threading.Lock()
+
+
+def guided(choices=None, regex=None):
+    """
+    Request params that constrain the answer to one of choices or to regex,
+    to be passed on with **: {} when guided decoding is off. The caller's
+    parser still handles free text from endpoints without the option.
+    """
+    if not use_guided_decoding:
+        return {}
+    if choices is not None:
+        return {"extra_body": {"guided_choice": [str(c) for c in choices]}}
+    return {"extra_body": {"guided_regex": regex}}
+
+
+def _is_guided(request):
+    return any(field in (request.get("extra_body") or {}) for field in GUIDED_FIELDS)
+
+
+def _without_guided(request):
+    extra_body = {k: v for k, v in request["extra_body"].items() if k not in GUIDED_FIELDS}
+    request = {k: v for k, v in request.items() if k != "extra_body"}
+    if extra_body:
+        request["extra_body"] = extra_body
+    return request
+
+
+def _guided_rejected(error, request):
+    """True if the request failed because the endpoint does not support guided decoding (which is then switched off)."""
+    global use_guided_decoding
+    if not _is_guided(request) or not _rejects_param(error, *GUIDED_FIELDS):
+        return False
+    with _guided_lock:
+        if use_guided_decoding:
+            print(f"Endpoint rejected guided decoding, falling back to free-text answers: {error}")
+            use_guided_decoding = False
+    return True
+
+
+def chat(prompt, model, **params):
+    """
+    Send one chat completion request and return the raw response.
+    prompt is a user message string or a full messages list; params are passed
+    to the API (temperature, max_tokens, stop, n, ...). Errors are raised.
+    """
+    request = _request(prompt, model, params)
+    with telemetry.get_telemetry().track(request["model"]) as record:
+        try:
+            response = client.chat.completions.create(**request)
+        except BadRequestError as e:
+            if not _guided_rejected(e, request):
+                raise
+            response = client.chat.completions.create(**_without_guided(request))
+        record.set_usage(response)
+    return response
+
+
+async def chat_async(prompt, model, **params):
+    """Async version of chat."""
+    request = _request(prompt, model, params)
+    with telemetry.get_telemetry().track(request["model"]) as record:
+        try:
+            response = await async_client.chat.completions.create(**request)
+        except BadRequestError as e:
+            if not _guided_rejected(e, request):
+                raise
+            response = await async_client.chat.completions.create(**_without_guided(request))
+        record.set_usage(response)
+    return response
+
+
+def complete(prompt, model, **params):
+    """Return the answer text. Errors are raised."""
+    return response_text(chat(prompt, model, **params))
+
+
+async def complete_async(prompt, model, **params):
+    """Async version of complete."""
+    return response_text(await chat_async(prompt, model, **params))
+
+
+def call_llm(prompt, model, **params):
+    """
+    Return the answer text, or "" if the request fails (the error is printed).
+    RetriesExhaustedError is raised: an endpoint that is still unavailable
+    after every retry fails the sample instead of scoring an empty answer.
+    """
+    try:
+        return complete(prompt, model, **params)
+    except RetriesExhaustedError:
+        raise
+    except Exception as e:
+        print(f"Error calling LLM: {e}")
+        return ""
+
+
+async def call_llm_async(prompt, model, **params):
+    """Async version of call_llm."""
+    try:
+        return await complete_async(prompt, model, **params)
+    except RetriesExhaustedError:
+        raise
+    except Exception as e:
+        print(f"Error calling LLM: {e}")
+        return ""
+
+
+# ---- Streaming with early stop
+
+StreamSaving = namedtuple("StreamSaving", "tokens stopped_early tokens_saved ms_saved")
+
+
+class StreamStats:
+    """
+    Tokens and time saved by closing streams early.
+
+    Savings are counted against the request's max_tokens, so they are an upper
+    bound (the model might have finished sooner); calls without max_tokens are
+    counted separately. Time saved = tokens saved x measured decode time per
+    token (moving average over all streamed calls).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.stopped_early = 0
+        self.tokens = 0
+        self.tokens_saved = 0
+        self.unbudgeted = 0
+        self.token_ms = None
+        self._lock = threading.Lock()
+
+    def record(self, tokens, stopped_early, budget, token_ms):
+        with self._lock:
+            if self.calls == 0:
+                atexit.register(lambda: print(self.report()))
+            if token_ms is not None:
+                # Moving average of the decode time per token
+                self.token_ms = token_ms if self.token_ms is None else 0.9 * self.token_ms + 0.1 * token_ms
+            self.calls += 1
+            self.tokens += tokens
+            tokens_saved = ms_saved = 0
+            if stopped_early:
+                self.stopped_early += 1
+                if budget is None:
+                    self.unbudgeted += 1
+                else:
+                    tokens_saved = max(budget - tokens, 0)
+                    ms_saved = tokens_saved * (self.token_ms or 0.0)
+                    self.tokens_saved += tokens_saved
+            return StreamSaving(tokens, stopped_early, tokens_saved, ms_saved)
+
+    def report(self):
+        per_call = lambda total: total / self.calls if self.calls else 0.0
+        ms_saved = self.tokens_saved * (self.token_ms or 0.0)
+        return (f"Streaming: {self.stopped_early}/{self.calls} calls stopped early, {self.tokens} tokens generated; "
+                f"saved up to {self.tokens_saved} tokens ({per_call(self.tokens_saved):.1f}/call) and "
+                f"~{ms_saved:.0f} ms ({per_call(ms_saved):.0f} ms/call)"
+                + (f"; {self.unbudgeted} early stops without max_tokens not counted" if self.unbudgeted else ""))
+
+
+stream_stats = StreamStats()
+
+
+def describe_saving(saving):
+    """Short per-sample note for a StreamSaving ("" if the call was not streamed)."""
+    if saving is None:
+        return ""
+    if not saving.stopped_early:
+        return f" | stream: {saving.tokens} tok, not stopped early"
+    if saving.tokens_saved == 0 and saving.ms_saved == 0:
+        return f" | stream: {saving.tokens} tok, stopped early"
+    return f" | stream: {saving.tokens} tok, saved <={saving.tokens_saved} tok / ~{saving.ms_saved:.0f} ms"
+
+
+# The number an answer starts with: "2.", "2)", "2:", "**2**." or "Answer: 2" followed by a
+# line break; a number such as "3/4 time", "2 beats" or "2.5" does not count
+LEADING_NUMBER = re.compile(r"\s*(?:\*\*)?(?:answer\s*[:：]?\s*)?(?:\*\*)?(\d+)(?:\*\*)?[ \t]*[.):\n](?=\D)", re.I)
+
+
+def leading_number(text):
+    """
+    The number an answer starts with, once a delimiter and another character
+    follow it, else "". Used to stop streams.
+    """
+    m = LEADING_NUMBER.match(text)
+    return m.group(1) if m else ""
+
+
+def _early_stop_key(request, done):
+    from llm_cache import get_cache
+
+    cache = get_cache()
+    if not cache.enabled:
+        return cache, None
+    return cache, cache.slot_key({**request, "early_stop": f"{done.__module__}.{done.__qualname__}"})
+
+
+def _cached_text(cache, key, request):
+    """A cached early-stopped answer, or a cached full answer to the same deterministic request."""
+    if key is None:
+        return None
+    from openai.types.chat import ChatCompletion
+    from llm_cache import is_deterministic, request_key
+
+    cached = None
+    if is_deterministic(request):
+        cached = cache.get(request_key(request), count_miss=False)
+    if cached is None:
+        cached = cache.get(key)
+    return response_text(ChatCompletion.model_validate_json(cached)) if cached is not None else None
+
+
+def _store_text(cache, key, request, text):
+    if key is None:
+        return
+    from openai.types.chat import ChatCompletion
+
+    response = ChatCompletion.model_validate({
+        "id": "stream",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}]
+    })
+    cache.put(key, response.model_dump_json(), request["model"])
+
+
+def _stream_step(state, chunk, done, record):
+    """Add one streamed chunk to state. Returns True once done(text so far) is satisfied."""
+    if not chunk.choices or not chunk.choices[0].delta.content:
+        return False
+    now = time.perf_counter()
+    if state["first"] is None:
+        state["first"] = now
+        record.first_token()
+    state["last"] = now
+    state["tokens"] += 1
+    state["text"] += chunk.choices[0].delta.content
+    return bool(done(state["text"]))
+
+
+def _finish_stream(state, stopped, request, record):
+    tokens = state["tokens"]
+    record.completion_tokens = tokens
+    token_ms = (state["last"] - state["first"]) * 1000 / (tokens - 1) if tokens > 1 else None
+    saving = stream_stats.record(tokens, stopped, request.get("max_tokens"), token_ms)
+    return state["text"].strip(), saving
+
+
+def complete_until(prompt, model, done, **params):
+    """
+    Return (text, saving). With LLM_STREAM=1 the answer is streamed and the
+    stream is closed as soon as done(text_so_far) is true; saving is a
+    StreamSaving (None when the answer came from the cache or streaming is off).
+    Errors are raised.
+    """
+    if not STREAM_EARLY_STOP:
+        return complete(prompt, model, **params), None
+    request = _request(prompt, model, params)
+    with telemetry.get_telemetry().track(request["model"], streamed=True) as record:
+        cache, key = _early_stop_key(request, done)
+        text = _cached_text(cache, key, request)
+        if text is not None:
+            record.cache = "hit"
+            return text, None
+        record.cache = "off" if key is None else "miss"
+
+        state = {"text": "", "tokens": 0, "first": None, "last": None}
+        stopped = False
+        stream = client.chat.completions.create(**request, stream=True)
+        try:
+            for chunk in stream:
+                if _stream_step(state, chunk, done, record):
+                    stopped = True
+                    break
+        finally:
+            stream.close()
+        text, saving = _finish_stream(state, stopped, request, record)
+        _store_text(cache, key, request, text)
+    return text, saving
+
+
+async def complete_until_async(prompt, model, done, **params):
+    """Async version of complete_until."""
+    if not STREAM_EARLY_STOP:
+        return await complete_async(prompt, model, **params), None
+    request = _request(prompt, model, params)
+    with telemetry.get_telemetry().track(request["model"], streamed=True) as record:
+        cache, key = _early_stop_key(request, done)
+        text = _cached_text(cache, key, request)
+        if text is not None:
+            record.cache = "hit"
+            return text, None
+        record.cache = "off" if key is None else "miss"
+
+        state = {"text": "", "tokens": 0, "first": None, "last": None}
+        stopped = False
+        stream = await async_client.chat.completions.create(**request, stream=True)
+        try:
+            async for chunk in stream:
+                if _stream_step(state, chunk, done, record):
+                    stopped = True
+                    break
+        finally:
+            await stream.close()
+        text, saving = _finish_stream(state, stopped, request, record)
+        _store_text(cache, key, request, text)
+    return text, saving
+
+
+# Ask for all samples of a prompt in one request (n=k, shared prefill).
+# Switched off automatically when the endpoint rejects or ignores `n`.
+use_n_sampling = True
+
+
+def _n_choices(response, n):
+    """Return the n sampled answers, or None if the endpoint ignored `n`."""
+    global use_n_sampling
+    answers = [(c.message.content or "").strip() for c in sorted(response.choices, key=lambda c: c.index)]
+    if len(answers) < n:
+        print(f"Endpoint returned {len(answers)} of {n} samples, falling back to separate requests")
+        use_n_sampling = False
+        return None
+    return answers
+
+
+def _n_sampling_failed(error, n):
+    """Switch n-sampling off if the endpoint rejects `n`; any other error only sends this call as separate requests."""
+    global use_n_sampling
+    if isinstance(error, RetriesExhaustedError):
+        raise error
+    if _rejects_param(error, "n"):
+        print(f"Endpoint rejected n={n}, falling back to separate requests: {error}")
+        use_n_sampling = False
+    else:
+        print(f"Error calling LLM: {error}")
+
+
+# Threads for separate sample requests; the scheduler still limits how many are in flight
+MAX_SAMPLE_WORKERS = 16
+
+
+class Samples(list):
+    """The answers returned by sample(); requests is the number of requests sent for them."""
+
+    def __init__(self, answers, requests):
+        super().__init__(answers)
+        self.requests = requests
+
+
+def sample(prompt, model, n, **params):
+    """
+    Return n sampled answers for the same prompt (failed samples are "").
+    Uses one n-sample request when the endpoint supports it, otherwise n
+    separate requests in parallel; a rejected n-sample request also counts
+    in the Samples.requests of the result.
+    """
+    requests = 0
+    if n <= 0:
+        return Samples([], requests)
+    if use_n_sampling and n > 1:
+        requests += 1
+        try:
+            answers = _n_choices(chat(prompt, model, n=n, **params), n)
+        except Exception as e:
+            _n_sampling_failed(e, n)
+            answers = None
+        if answers is not None:
+            return Samples(answers, requests)
+    # Each worker runs in a copy of the caller's context, so its calls keep the caller's stage
+    contexts = [contextvars.copy_context() for k in range(n)]
+    with ThreadPoolExecutor(max_workers=min(n, MAX_SAMPLE_WORKERS)) as pool:
+        answers = list(pool.map(lambda context: context.run(call_llm, prompt, model, **params), contexts))
+    return Samples(answers, requests + n)
+
+
+async def sample_async(prompt, model, n, **params):
+    """Async version of sample."""
+    requests = 0
+    if n <= 0:
+        return Samples([], requests)
+    if use_n_sampling and n > 1:
+        requests += 1
+        try:
+            answers = _n_choices(await chat_async(prompt, model, n=n, **params), n)
+        except Exception as e:
+            _n_sampling_failed(e, n)
+            answers = None
+        if answers is not None:
+            return Samples(answers, requests)
+    answers = await asyncio.gather(*(call_llm_async(prompt, model, **params) for k in range(n)))
+    return Samples(answers, requests + n)
+
+
+# ---- Structured (JSON) output
+
+# Constrain JSON answers with response_format={"type": "json_schema"} (guided
+# decoding on vLLM). Switched off automatically when the endpoint rejects it.
+use_json_schema = True
+
+
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+
+
+def parse_json_object(text):
+    """The JSON object in text (also inside ``` fences or surrounding prose), or None."""
+    candidates = [text]
+    match = re.search(r"\{.*\}", text, re.S)
+    if match:
+        candidates.append(match.group(0))
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+
+def _json_schema_failed(error):
+    """Switch JSON-schema output off if the endpoint rejects response_format; any other error is raised."""
+    global use_json_schema
+    if not _rejects_param(error, "response_format", "json_schema", "guided_json"):
+        raise error
+    print(f"Endpoint rejected response_format=json_schema, falling back to parsing the text: {error}")
+    use_json_schema = False
+
+
+def complete_json(prompt, model, schema, name="response", **params):
+    """
+    Return the answer as a dict, or None if it holds no JSON object. The
+    answer is constrained to schema when the endpoint supports JSON-schema
+    output; otherwise the prompt must ask for the JSON itself. Errors are raised.
+    """
+    if use_json_schema:
+        try:
+            return parse_json_object(complete(prompt, model, response_format=json_schema_format(name, schema), **params))
+        except Exception as e:
+            _json_schema_failed(e)
+    return parse_json_object(complete(prompt, model, **params))
+
+
+async def complete_json_async(prompt, model, schema, name="response", **params):
+    """Async version of complete_json."""
+    if use_json_schema:
+        try:
+            text = await complete_async(prompt, model, response_format=json_schema_format(name, schema), **params)
+            return parse_json_object(text)
+        except Exception as e:
+            _json_schema_failed(e)
+    return parse_json_object(await complete_async(prompt, model, **params))
+
+
+
+# ---- Label probabilities (logprobs)
+
+# Read the label distribution from top_logprobs of the first answer token.
+# Switched off automatically when the endpoint rejects logprobs.
+use_logprobs = True
+
+
+def label_logprobs(response, labels):
+    """
+    {label: log-probability} of the labels among the top_logprobs of the first
+    answer token, or None if the response has no logprobs.
+    """
+    logprobs = response.choices[0].logprobs
+    if logprobs is None or not logprobs.content:
+        return None
+    found = {}
+    for candidate in logprobs.content[0].top_logprobs or []:
+        # Tokens with and without a leading space are the same label
+        token = candidate.token.strip()
+        if token in labels:
+            found[token] = found.get(token, 0.0) + math.exp(candidate.logprob)
+    return {label: math.log(p) for label, p in found.items()} or None
+
+
+def _logprobs_failed(error):
+    """Switch logprobs off if the endpoint rejects logprobs; any other error is raised."""
+    global use_logprobs
+    if not _rejects_param(error, "logprobs", "top_logprobs"):
+        raise error
+    print(f"Endpoint rejected logprobs, falling back to the answer text: {error}")
+    use_logprobs = False
+
+
+def label_distribution(prompt, model, labels, top_logprobs=10, **params):
+    """
+    Ask for one answer token and return (text, {label: log-probability}).
+    The distribution is None when the endpoint gives no logprobs; the caller
+    then has only the greedy answer text.
+    """
+    params = {"max_tokens": 1, "temperature": 0.0, **params}
+    if use_logprobs:
+        try:
+            response = chat(prompt, model, logprobs=True, top_logprobs=top_logprobs, **params)
+            return response_text(response), label_logprobs(response, labels)
+        except Exception as e:
+            _logprobs_failed(e)
+    return response_text(chat(prompt, model, **params)), None
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+    import importlib
+
+    parser = argparse.ArgumentParser(description="Measure the import cost of modules that use the shared client")
+    parser.add_argument("modules", nargs="+", help="Module names, e.g. multi_agent_system multi_agent_test_emotion")
+    args = parser.parse_args()
+
+    # The timed modules import llm_client as its own module, not this __main__
+    shared = importlib.import_module("llm_client")
+    for name in args.modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        elapsed = time.perf_counter() - start
+        created = shared._client is not None or shared._async_client is not None
+        print(f"import {name}: {elapsed * 1000:.1f} ms (client created: {created})")
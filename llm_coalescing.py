@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import os
+import threading
+from concurrent.futures import Future
+
+import llm_telemetry as telemetry
+from llm_cache import is_deterministic, request_key
+from llm_scheduler import is_async_client
+
+
+def coalescing_enabled_from_env():
+    """Coalescing is on unless LLM_COALESCE is set to 0/off/false/no."""
+    return os.environ.get("LLM_COALESCE", "1").strip().lower() not in ("0", "off", "false", "no")
+
+
+def coalesce_key(request):
+    """
+    Key under which identical requests share one in-flight call, or None.
+    Only deterministic (temperature 0 or seeded), non-streaming requests are
+    coalesced: a sampled request must stay an independent draw.
+    """
+    if request.get("stream") or not is_deterministic(request):
+        return None
+    return request_key(request)
+
+
+class RequestCoalescer:
+    """
+    Tracks the deterministic requests in flight. A request identical to one
+    already in flight waits for that call's response instead of sending its
+    own, so each duplicate is charged only once.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.sent = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def join(self, key, start):
+        """
+        Return (future, leader): the future of the call in flight for key, or a
+        new one from start() if there is none (the caller is then the leader
+        and must call finish(key) once the call is done).
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._in_flight[key] = start()
+            self.sent += 1
+            return future, True
+
+    def finish(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def report(self):
+        calls = self.sent + self.coalesced
+        return (f"Coalescing: {self.coalesced}/{calls} deterministic calls joined an identical request "
+                f"in flight ({self.sent} sent)")
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_coalescer():
+    """Shared process-wide coalescer (LLM_COALESCE)."""
+    global _coalescer
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = RequestCoalescer(enabled=coalescing_enabled_from_env())
+            atexit.register(_print_report)
+        return _coalescer
+
+
+def _print_report():
+    if _coalescer is not None and _coalescer.coalesced:
+        print(_coalescer.report())
+
+
+class CoalescingCompletions:
+    """Drop-in for client.chat.completions that shares identical in-flight deterministic calls."""
+
+    def __init__(self, completions, coalescer):
+        self._completions = completions
+        self._coalescer = coalescer
+
+    def create(self, **request):
+        key = coalesce_key(request) if self._coalescer.enabled else None
+        if key is None:
+            return self._completions.create(**request)
+        future, leader = self._coalescer.join(key, Future)
+        if not leader:
+            telemetry.note(cache="coalesced")
+            # Every caller gets its own response object
+            return future.result().model_copy(deep=True)
+        try:
+            response = self._completions.create(**request)
+        except BaseException as e:
+            self._coalescer.finish(key)
+            future.set_exception(e)
+            raise
+        self._coalescer.finish(key)
+        future.set_result(response)
+        return response
+
+
+class AsyncCoalescingCompletions(CoalescingCompletions):
+    """
+    Async version of CoalescingCompletions. The shared call runs as its own
+    task, so cancelling one of the waiting callers does not cancel it for the
+    others.
+    """
+
+    async def create(self, **request):
+        key = coalesce_key(request) if self._coalescer.enabled else None
+        if key is None:
+            return await self._completions.create(**request)
+        loop = asyncio.get_running_loop()
+        # Futures belong to one event loop
+        loop_key = (id(loop), key)
+        task, leader = self._coalescer.join(loop_key, lambda: loop.create_task(self._completions.create(**request)))
+        if leader:
+            task.add_done_callback(lambda _: self._coalescer.finish(loop_key))
+            return await asyncio.shield(task)
+        telemetry.note(cache="coalesced")
+        response = await asyncio.shield(task)
+        return response.model_copy(deep=True)
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class CoalescingClient:
+    """Wraps an OpenAI / AsyncOpenAI client so that identical deterministic calls in flight are sent once."""
+
+    def __init__(self, client, coalescer=None, is_async=False):
+        self._client = client
+        self.coalescer = coalescer or get_coalescer()
+        completions_cls = AsyncCoalescingCompletions if is_async else CoalescingCompletions
+        self.chat = _Chat(completions_cls(client.chat.completions, self.coalescer))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def coalescing_client(client, coalescer=None):
+    """Wrap a sync or async OpenAI client with the shared request coalescer."""
+    return CoalescingClient(client, coalescer, is_async=is_async_client(client))
@@ -0,0 +1,434 @@
+import asyncio
+import atexit
+import inspect
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AuthenticationError,
+    RateLimitError,
+)
+
+import llm_telemetry as telemetry
+
+# Retry policy
+DEFAULT_MAX_RETRIES = 6
+BASE_DELAY_SECONDS = 1.0
+MAX_DELAY_SECONDS = 60.0
+
+# In-flight limit (AIMD: additive increase, multiplicative decrease)
+DEFAULT_INITIAL_LIMIT = 16
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 64
+THROTTLE_DECREASE = 0.5   # on 429 / 503
+SLOW_DECREASE = 0.9       # on a request slower than the latency target
+
+# Requests slower than this (seconds) are treated as a congestion signal
+DEFAULT_LATENCY_TARGET = 60.0
+
+# HTTP status codes worth retrying
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+
+class RetriesExhaustedError(Exception):
+    """A request kept failing with transient errors after every retry."""
+
+    def __init__(self, attempts, last_error):
+        super().__init__(f"LLM request failed after {attempts} attempts: {last_error}")
+        self.attempts = attempts
+        self.last_error = last_error
+
+
+def _status_code(error):
+    return error.status_code if isinstance(error, APIStatusError) else None
+
+
+def _retry_after(error):
+    """Seconds requested by the server's Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    Bounds the number of LLM requests in flight and retries transient failures.
+
+    - 429 / 503 responses and timeouts halve the in-flight limit (throttle events);
+      each success raises it by about one request per round trip.
+    - Requests slower than latency_target shrink the limit slightly.
+    - Transient failures (429, 5xx, timeouts, connection errors) are retried with
+      jittered exponential backoff, honoring Retry-After. A 401 refreshes the
+      token once (on_unauthorized). Other errors are raised immediately.
+    - After max_retries, RetriesExhaustedError is raised so that the caller
+      records an error instead of silently scoring an empty answer.
+
+    The same scheduler serves threads (run) and asyncio tasks (arun).
+    """
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, initial_limit=DEFAULT_INITIAL_LIMIT,
+                 min_limit=DEFAULT_MIN_LIMIT, max_limit=DEFAULT_MAX_LIMIT,
+                 latency_target=DEFAULT_LATENCY_TARGET, on_unauthorized=None):
+        self.max_retries = max_retries
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.latency_target = latency_target
+        self.on_unauthorized = on_unauthorized
+
+        self.requests = 0
+        self.retries = 0
+        self.throttle_events = 0
+        self.timeouts = 0
+        self.slow_requests = 0
+        self.failures = 0
+        self.lowest_limit = self.limit
+        self.highest_limit = self.limit
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+
+    # ---- in-flight slots
+
+    def _has_slot(self):
+        return self._in_flight < max(int(self.limit), self.min_limit)
+
+    def _wake_waiters(self):
+        # Called with self._lock held: hand free slots to waiting requests in FIFO order
+        while self._waiters and self._has_slot():
+            wake = self._waiters.popleft()
+            self._in_flight += 1
+            wake()
+
+    def _acquire(self):
+        with self._lock:
+            if self._has_slot() and not self._waiters:
+                self._in_flight += 1
+                return
+            event = threading.Event()
+            self._waiters.append(event.set)
+        event.wait()
+
+    async def _acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._has_slot() and not self._waiters:
+                self._in_flight += 1
+                return
+            future = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(self._grant, future)
+
+            self._waiters.append(wake)
+        await future
+
+    def _grant(self, future):
+        if future.cancelled():
+            # The waiting task went away: give the slot back
+            self._release()
+        else:
+            future.set_result(None)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._wake_waiters()
+
+    # ---- AIMD limit
+
+    def _set_limit(self, limit):
+        # Called with self._lock held
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        self.lowest_limit = min(self.lowest_limit, self.limit)
+        self.highest_limit = max(self.highest_limit, self.limit)
+
+    def _on_success(self, latency):
+        with self._lock:
+            self.requests += 1
+            if self.latency_target and latency > self.latency_target:
+                self.slow_requests += 1
+                self._set_limit(self.limit * SLOW_DECREASE)
+            else:
+                self._set_limit(self.limit + 1.0 / self.limit)
+            self._wake_waiters()
+
+    def _on_failure(self, error, attempt, refreshed_auth):
+        """
+        Record a failed attempt. Returns the delay before retrying, or None if
+        the error must be raised.
+        """
+        status = _status_code(error)
+        with self._lock:
+            if isinstance(error, APITimeoutError):
+                self.timeouts += 1
+                self._set_limit(self.limit * THROTTLE_DECREASE)
+            elif isinstance(error, RateLimitError) or status in THROTTLE_STATUS:
+                self.throttle_events += 1
+                self._set_limit(self.limit * THROTTLE_DECREASE)
+
+        if isinstance(error, AuthenticationError):
+            # The caller refreshes the token (on_unauthorized) and retries at once
+            if self.on_unauthorized is None or refreshed_auth:
+                return None
+            return 0.0
+
+        transient = isinstance(error, (APITimeoutError, APIConnectionError)) or status in RETRY_STATUS
+        if not transient or attempt >= self.max_retries:
+            return None
+
+        delay = min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)  # jitter
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _give_up(self, error, attempt):
+        with self._lock:
+            self.failures += 1
+        transient = isinstance(error, (APITimeoutError, APIConnectionError)) or _status_code(error) in RETRY_STATUS
+        if transient:
+            raise RetriesExhaustedError(attempt + 1, error) from error
+        raise error
+
+    def _finish(self, start, ok=True):
+        self._release()
+        if ok:
+            self._on_success(time.perf_counter() - start)
+
+    # ---- public API
+
+    def run(self, request, stream=False):
+        """
+        Run request() (a blocking LLM call) under the in-flight limit, retrying transient errors.
+        With stream=True the result is a response stream, which keeps its slot until it is closed.
+        """
+        attempt = 0
+        refreshed_auth = False
+        while True:
+            waited = time.perf_counter()
+            self._acquire()
+            start = time.perf_counter()
+            telemetry.add_queue_time(start - waited)
+            try:
+                result = request()
+            except Exception as e:
+                self._release()
+                delay = self._on_failure(e, attempt, refreshed_auth)
+                if delay is None:
+                    self._give_up(e, attempt)
+                if isinstance(e, AuthenticationError):
+                    self.on_unauthorized()
+                    refreshed_auth = True
+                with self._lock:
+                    self.retries += 1
+                telemetry.add_retry()
+                attempt += 1
+                time.sleep(delay)
+                continue
+            if stream:
+                return HeldStream(result, lambda ok: self._finish(start, ok))
+            self._finish(start)
+            return result
+
+    async def arun(self, request, stream=False):
+        """Async version of run; request() returns an awaitable."""
+        attempt = 0
+        refreshed_auth = False
+        while True:
+            waited = time.perf_counter()
+            await self._acquire_async()
+            start = time.perf_counter()
+            telemetry.add_queue_time(start - waited)
+            try:
+                result = await request()
+            except Exception as e:
+                self._release()
+                delay = self._on_failure(e, attempt, refreshed_auth)
+                if delay is None:
+                    self._give_up(e, attempt)
+                if isinstance(e, AuthenticationError):
+                    # The token refresh blocks: keep it off the event loop
+                    await asyncio.to_thread(self.on_unauthorized)
+                    refreshed_auth = True
+                with self._lock:
+                    self.retries += 1
+                telemetry.add_retry()
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled while waiting for the response
+                self._release()
+                raise
+            if stream:
+                return AsyncHeldStream(result, lambda ok: self._finish(start, ok))
+            self._finish(start)
+            return result
+
+    def report(self):
+        return (f"LLM scheduler: {self.requests} requests, {self.retries} retries, "
+                f"{self.throttle_events} throttle events (429/503), {self.timeouts} timeouts, "
+                f"{self.slow_requests} slow, {self.failures} failed; in-flight limit {self.limit:.1f} "
+                f"(range {self.lowest_limit:.1f}-{self.highest_limit:.1f})")
+
+
+class HeldStream:
+    """
+    A response stream that keeps its scheduler slot until it is closed or read
+    to the end, so the in-flight count covers the whole generation.
+    """
+
+    # Defaults for __del__ / __getattr__ on an instance whose __init__ did not run
+    _stream = None
+    _finished = True
+
+    def __init__(self, stream, finish):
+        self._stream = stream
+        self._finish = finish
+        self._finished = False
+        self._failed = False
+
+    def _done(self):
+        if not self._finished:
+            self._finished = True
+            self._finish(not self._failed)
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except Exception:
+            self._failed = True
+            raise
+        finally:
+            self._done()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # A stream dropped without close() must not leak its slot
+        self._done()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class AsyncHeldStream(HeldStream):
+    """Async version of HeldStream."""
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception:
+            self._failed = True
+            raise
+        finally:
+            self._done()
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._done()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Shared process-wide scheduler configured from the environment (LLM_MAX_RETRIES, LLM_MAX_CONCURRENCY, ...)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(
+                max_retries=int(os.environ.get("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+                initial_limit=int(os.environ.get("LLM_INITIAL_CONCURRENCY", DEFAULT_INITIAL_LIMIT)),
+                max_limit=int(os.environ.get("LLM_MAX_CONCURRENCY", DEFAULT_MAX_LIMIT)),
+                latency_target=float(os.environ.get("LLM_LATENCY_TARGET", DEFAULT_LATENCY_TARGET))
+            )
+            atexit.register(_print_report)
+        return _scheduler
+
+
+def _print_report():
+    if _scheduler is not None and (_scheduler.requests or _scheduler.failures):
+        print(_scheduler.report())
+
+
+class ScheduledCompletions:
+    """Drop-in for client.chat.completions that runs every request through the scheduler."""
+
+    def __init__(self, completions, scheduler):
+        self._completions = completions
+        self._scheduler = scheduler
+
+    def create(self, **request):
+        return self._scheduler.run(lambda: self._completions.create(**request), stream=bool(request.get("stream")))
+
+
+class AsyncScheduledCompletions(ScheduledCompletions):
+    """Async version of ScheduledCompletions."""
+
+    async def create(self, **request):
+        return await self._scheduler.arun(lambda: self._completions.create(**request), stream=bool(request.get("stream")))
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class ScheduledClient:
+    """Wraps an OpenAI / AsyncOpenAI client so that chat.completions.create goes through the scheduler."""
+
+    def __init__(self, client, scheduler=None, is_async=False):
+        self._client = client
+        completions_cls = AsyncScheduledCompletions if is_async else ScheduledCompletions
+        self.chat = _Chat(completions_cls(client.chat.completions, scheduler or get_scheduler()))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def is_async_client(client):
+    """
+    True for AsyncOpenAI (and wrappers of it). The SDK decorates create(), so
+    look through the decorator for the coroutine function.
+    """
+    return inspect.iscoroutinefunction(inspect.unwrap(client.chat.completions.create))
+
+
+def scheduled_client(client, scheduler=None):
+    """Wrap a sync or async OpenAI client with the shared request scheduler."""
+    return ScheduledClient(client, scheduler, is_async=is_async_client(client))
@@ -0,0 +1,276 @@
+import atexit
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import llm_tracing as tracing
+from llm_tracing import RUN_ID
+
+# Location of the per-call log (one JSON record per line, appended by every run)
+DEFAULT_TELEMETRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_telemetry", "calls.jsonl")
+
+# Stage of calls made outside any stage(...)
+DEFAULT_STAGE = "other"
+
+PERCENTILES = (50, 95, 99)
+
+_stage = contextvars.ContextVar("llm_stage", default=DEFAULT_STAGE)
+_current = contextvars.ContextVar("llm_call", default=None)
+
+
+def telemetry_enabled_from_env():
+    """Telemetry is on unless LLM_TELEMETRY is set to 0/off/false/no."""
+    return os.environ.get("LLM_TELEMETRY", "1").strip().lower() not in ("0", "off", "false", "no")
+
+
+class stage(tracing.span):
+    """
+    Label the LLM calls made inside a block or function with a pipeline stage
+    ("controller", "abc_expert", ...). Works as a context manager and as a
+    decorator for plain and async functions; the innermost stage wins. The
+    block is also traced as a span (LLM_TRACE=1).
+    """
+
+    def _open(self):
+        return super()._open(), _stage.set(self.name)
+
+    def _close(self, state):
+        span_state, token = state
+        _stage.reset(token)
+        super()._close(span_state)
+
+    def __enter__(self):
+        super().__enter__()
+        return self
+
+
+def current_stage():
+    return _stage.get()
+
+
+class CallRecord:
+    """
+    Telemetry of one gateway call. The client layers fill in what they know
+    (cache status, queue time) through note(); the gateway adds the timings
+    and token usage when the call returns.
+    """
+
+    def __init__(self, model, streamed=False):
+        self.stage = current_stage()
+        self.model = model
+        self.streamed = streamed
+        self.cache = "off"
+        self.queue_ms = 0.0
+        self.retries = 0
+        self.ttft_ms = None
+        # "stream": first chunk of a streamed call; "response": whole response of a
+        # non-streamed call (the first token arrives with it)
+        self.ttft_source = None
+        self.latency_ms = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.status = "ok"
+        self.error = None
+        self._start = time.perf_counter()
+
+    def first_token(self):
+        """Called by the streaming path when the first content chunk arrives."""
+        if self.ttft_ms is None:
+            self.ttft_ms = (time.perf_counter() - self._start) * 1000
+            self.ttft_source = "stream"
+
+    def set_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_tokens
+            self.completion_tokens = usage.completion_tokens
+
+    def as_dict(self):
+        return {
+            "run": RUN_ID,
+            "time": round(time.time(), 3),
+            "stage": self.stage,
+            "model": self.model,
+            "cache": self.cache,
+            "streamed": self.streamed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "queue_ms": round(self.queue_ms, 2),
+            "retries": self.retries,
+            "ttft_ms": None if self.ttft_ms is None else round(self.ttft_ms, 2),
+            "ttft_source": self.ttft_source,
+            "latency_ms": None if self.latency_ms is None else round(self.latency_ms, 2),
+            "status": self.status,
+            "error": self.error,
+        }
+
+
+def note(**fields):
+    """Set fields on the record of the call in progress (no-op outside a tracked call)."""
+    record = _current.get()
+    if record is not None:
+        for name, value in fields.items():
+            setattr(record, name, value)
+
+
+def add_queue_time(seconds):
+    record = _current.get()
+    if record is not None:
+        record.queue_ms += seconds * 1000
+
+
+def add_retry():
+    record = _current.get()
+    if record is not None:
+        record.retries += 1
+
+
+class Telemetry:
+    """
+    Per-call JSONL log. Every gateway call appends one record (stage, model,
+    prompt / completion tokens, queue time, time to first token for streamed
+    calls, total latency, cache status) and keeps it in memory for the
+    end-of-run summary.
+    """
+
+    def __init__(self, path=DEFAULT_TELEMETRY_PATH, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.records = []
+        self._lock = threading.Lock()
+        self._file = None
+
+    @contextmanager
+    def track(self, model, streamed=False):
+        """Track the call made inside the block; yields its CallRecord."""
+        record = CallRecord(model, streamed)
+        token = _current.set(record)
+        with tracing.span(f"llm:{record.stage}") as span:
+            try:
+                yield record
+            except BaseException as e:
+                record.status = "error"
+                record.error = type(e).__name__
+                raise
+            finally:
+                _current.reset(token)
+                record.latency_ms = (time.perf_counter() - record._start) * 1000
+                if record.ttft_ms is None and record.status == "ok":
+                    record.ttft_ms = record.latency_ms
+                    record.ttft_source = "response"
+                self._write(record)
+                if span is not None:
+                    span.set(**{k: v for k, v in record.as_dict().items() if k not in ("run", "time", "stage")})
+
+    def _write(self, record):
+        if not self.enabled:
+            return
+        fields = record.as_dict()
+        line = json.dumps(fields, ensure_ascii=False)
+        with self._lock:
+            self.records.append(fields)
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """Shared process-wide telemetry configured from the environment (LLM_TELEMETRY, LLM_TELEMETRY_PATH)."""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = Telemetry(path=os.environ.get("LLM_TELEMETRY_PATH", DEFAULT_TELEMETRY_PATH),
+                                   enabled=telemetry_enabled_from_env())
+            atexit.register(_print_summary)
+        return _telemetry
+
+
+def _print_summary():
+    if _telemetry is not None and _telemetry.records:
+        print(summarize(_telemetry.records))
+        print(f"(per-call records: {_telemetry.path}, run {RUN_ID})")
+
+
+# ---- Summary
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _sent(record):
+    # Calls answered by the cache or by an identical call in flight cost nothing
+    return record["cache"] not in ("hit", "coalesced")
+
+
+def summarize(records):
+    """Latency percentiles and tokens per stage, as a printable table."""
+    by_stage = defaultdict(list)
+    for record in records:
+        by_stage[record["stage"]].append(record)
+
+    header = (f"{'stage':<18}{'calls':>6}{'sent':>6}{'err':>5}"
+              + "".join(f"{'p' + str(p) + ' ms':>10}" for p in PERCENTILES)
+              + f"{'queue p95':>10}{'ttft p50':>10}{'prompt tok':>12}{'compl tok':>11}")
+    lines = ["LLM telemetry (latency of every call, tokens of calls actually sent; "
+             "ttft of non-streamed calls is their full response time):", header]
+    totals = [0, 0, 0, 0, 0]
+    for name, calls in sorted(by_stage.items(), key=lambda item: -sum(r["latency_ms"] or 0 for r in item[1])):
+        latencies = [r["latency_ms"] for r in calls if r["latency_ms"] is not None]
+        queue = [r["queue_ms"] for r in calls]
+        ttft = [r["ttft_ms"] for r in calls if r["ttft_ms"] is not None]
+        sent = [r for r in calls if _sent(r)]
+        errors = sum(r["status"] == "error" for r in calls)
+        prompt_tokens = sum(r["prompt_tokens"] or 0 for r in sent)
+        completion_tokens = sum(r["completion_tokens"] or 0 for r in sent)
+        line = f"{name:<18}{len(calls):>6}{len(sent):>6}{errors:>5}"
+        line += "".join(f"{percentile(latencies, p):>10.0f}" if latencies else f"{'-':>10}" for p in PERCENTILES)
+        line += f"{percentile(queue, 95):>10.0f}" if queue else f"{'-':>10}"
+        line += f"{percentile(ttft, 50):>10.0f}" if ttft else f"{'-':>10}"
+        line += f"{prompt_tokens:>12}{completion_tokens:>11}"
+        lines.append(line)
+        for i, value in enumerate((len(calls), len(sent), errors, prompt_tokens, completion_tokens)):
+            totals[i] += value
+    lines.append(f"{'total':<18}{totals[0]:>6}{totals[1]:>6}{totals[2]:>5}{'':>{10 * (len(PERCENTILES) + 2)}}"
+                 f"{totals[3]:>12}{totals[4]:>11}")
+    return "\n".join(lines)
+
+
+def load_records(path, run=None):
+    """Records of one run from a JSONL log (the last run if run is None, every run if run == "all")."""
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if run == "all" or not records:
+        return records
+    run = run or records[-1]["run"]
+    return [r for r in records if r["run"] == run]
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the per-call LLM telemetry log")
+    parser.add_argument("path", nargs="?", default=os.environ.get("LLM_TELEMETRY_PATH", DEFAULT_TELEMETRY_PATH))
+    parser.add_argument("--run", help="Run id to summarize, or 'all' (default: the last run in the log)")
+    args = parser.parse_args()
+
+    records = load_records(args.path, args.run)
+    if not records:
+        print(f"No records in {args.path}")
+    else:
+        runs = sorted({r["run"] for r in records})
+        print(f"{args.path}: {len(records)} calls from run{'s' if len(runs) > 1 else ''} {', '.join(runs)}")
+        print(summarize(records))
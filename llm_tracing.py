@@ -0,0 +1,233 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+
+# Written at exit when tracing is on (LLM_TRACE=1); {run} is replaced by the run id
+DEFAULT_TRACE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_telemetry", "trace-{run}.json")
+
+# Identifies this process in the trace file name
+RUN_ID = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+_current = contextvars.ContextVar("llm_span", default=None)
+
+
+def tracing_enabled_from_env():
+    """Tracing is off unless LLM_TRACE is set to 1/on/true/yes."""
+    return os.environ.get("LLM_TRACE", "0").strip().lower() in ("1", "on", "true", "yes")
+
+
+class Span:
+    """One timed operation: a sample, a pipeline stage or an LLM call."""
+
+    __slots__ = ("name", "span_id", "parent_id", "sample", "attributes", "start", "end")
+
+    def __init__(self, name, span_id, parent, attributes):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.sample = attributes.get("sample_id", parent.sample if parent is not None else None)
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Collects finished spans in memory and writes them as a Chrome trace
+    (chrome://tracing, https://ui.perfetto.dev) with one track per sample.
+    Spans that overlap without nesting (concurrent branches of a sample) are
+    moved to extra tracks of the same sample, so the flame chart stays valid.
+    """
+
+    def __init__(self, path=DEFAULT_TRACE_PATH, enabled=False):
+        self.path = path.format(run=RUN_ID)
+        self.enabled = enabled
+        self.spans = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._origin = time.perf_counter()
+
+    def open(self, name, attributes):
+        return Span(name, next(self._ids), _current.get(), attributes)
+
+    def close(self, span):
+        span.end = time.perf_counter()
+        with self._lock:
+            self.spans.append(span)
+
+    def _tracks(self, spans):
+        """Assign every span of one sample to a track: (span_id -> track number within the sample)."""
+        by_id = {s.span_id: s for s in spans}
+        tracks = []
+        track_of = {}
+        for s in sorted(spans, key=lambda s: (s.start, -s.end)):
+            ancestors = set()
+            parent = s.parent_id
+            while parent in by_id:
+                ancestors.add(parent)
+                parent = by_id[parent].parent_id
+            preferred = track_of.get(s.parent_id, 0)
+            candidates = [preferred] + [i for i in range(len(tracks)) if i != preferred]
+            for i in candidates:
+                if i >= len(tracks):
+                    tracks.append([])
+                if all(o.end <= s.start or o.start >= s.end or o.span_id in ancestors for o in tracks[i]):
+                    break
+            else:
+                i = len(tracks)
+                tracks.append([])
+            tracks[i].append(s)
+            track_of[s.span_id] = i
+        return track_of
+
+    def chrome_trace(self):
+        """The collected spans as a Chrome trace event dict."""
+        with self._lock:
+            spans = list(self.spans)
+        by_sample = {}
+        for s in spans:
+            by_sample.setdefault(s.sample, []).append(s)
+
+        events = []
+        tid = 0
+        for sample in sorted(by_sample, key=lambda k: (k is None, not isinstance(k, int), k if isinstance(k, int) else str(k))):
+            track_of = self._tracks(by_sample[sample])
+            label = "no sample" if sample is None else f"sample {sample}"
+            for track in range(max(track_of.values()) + 1):
+                name = label if track == 0 else f"{label} (branch {track + 1})"
+                events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tid + track, "args": {"name": name}})
+                events.append({"ph": "M", "name": "thread_sort_index", "pid": 1, "tid": tid + track,
+                               "args": {"sort_index": tid + track}})
+            for s in by_sample[sample]:
+                events.append({
+                    "name": s.name,
+                    "cat": "llm" if s.name.startswith("llm") else "pipeline",
+                    "ph": "X",
+                    "ts": round((s.start - self._origin) * 1e6, 1),
+                    "dur": round((s.end - s.start) * 1e6, 1),
+                    "pid": 1,
+                    "tid": tid + track_of[s.span_id],
+                    "args": {"span_id": s.span_id, "parent_id": s.parent_id, "sample_id": sample, **s.attributes},
+                })
+            tid += max(track_of.values()) + 1
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"run": RUN_ID}}
+
+    def export(self, path=None):
+        """Write the Chrome trace JSON. Returns the path."""
+        path = path or self.path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f, ensure_ascii=False, default=str)
+        return path
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """Shared process-wide tracer configured from the environment (LLM_TRACE, LLM_TRACE_PATH)."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer(path=os.environ.get("LLM_TRACE_PATH", DEFAULT_TRACE_PATH),
+                             enabled=tracing_enabled_from_env())
+            atexit.register(_export_at_exit)
+        return _tracer
+
+
+def _export_at_exit():
+    if _tracer is not None and _tracer.spans:
+        print(f"Trace of {len(_tracer.spans)} spans written to {_tracer.export()} "
+              f"(open in chrome://tracing or https://ui.perfetto.dev)")
+
+
+class span:
+    """
+    Time a block or function as a span nested under the current one. Works as
+    a context manager (yielding the Span, or None when tracing is off) and as
+    a decorator for plain and async functions.
+    """
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self._entered = []
+
+    def _open(self):
+        tracer = get_tracer()
+        if not tracer.enabled:
+            return None, None
+        s = tracer.open(self.name, dict(self.attributes))
+        return s, _current.set(s)
+
+    def _close(self, state):
+        s, token = state
+        if s is not None:
+            _current.reset(token)
+            get_tracer().close(s)
+
+    def __enter__(self):
+        state = self._open()
+        self._entered.append(state)
+        return state[0]
+
+    def __exit__(self, *exc):
+        self._close(self._entered.pop())
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run_async(*args, **kwargs):
+                state = self._open()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self._close(state)
+            return run_async
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            state = self._open()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._close(state)
+        return run
+
+
+def trace_sample(sample_id):
+    """Root span of one sample: every span and LLM call inside it carries sample_id."""
+    return span("sample", sample_id=sample_id)
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+    from collections import defaultdict
+
+    parser = argparse.ArgumentParser(description="Summarize a Chrome trace written with LLM_TRACE=1")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    with open(args.path, encoding="utf-8") as f:
+        events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+    samples = [e for e in events if e["name"] == "sample"]
+    totals = defaultdict(float)
+    for e in events:
+        if e["name"] != "sample":
+            totals[e["name"]] += e["dur"] / 1000
+    print(f"{args.path}: {len(samples)} samples, {len(events)} spans")
+    if samples:
+        print(f"Mean sample wall time: {sum(e['dur'] for e in samples) / len(samples) / 1000:.0f} ms")
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+        print(f"{name:<28}{total:>12.0f} ms total")
@@ -0,0 +1,198 @@
+import atexit
+import math
+import os
+import threading
+from collections import Counter
+
+# Stopping rules for analyst votes (LLM_VOTE):
+#     fixed     ask every analyst, as before
+#     majority  stop as soon as the remaining analysts cannot change the majority
+#               (same decision as asking every analyst; default)
+#     sprt      sequential probability ratio test: stop when the lead of the top label
+#               is enough for error rate LLM_VOTE_ERROR given analyst accuracy LLM_VOTE_ACCURACY
+#     bayes     stop when the posterior probability that the top label is the analysts'
+#               majority choice reaches LLM_VOTE_CONFIDENCE (uniform Beta prior)
+# sprt and bayes also stop once the majority is decided, and are meant for larger ensembles.
+VOTE_MODES = ("fixed", "majority", "sprt", "bayes")
+
+
+def vote_mode_from_env():
+    mode = os.environ.get("LLM_VOTE", "majority").strip().lower()
+    if mode not in VOTE_MODES:
+        raise ValueError(f"LLM_VOTE must be one of {', '.join(VOTE_MODES)}, got {mode!r}")
+    return mode
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def binomial_tail(n, k):
+    """P(X >= k) for X ~ Binomial(n, 1/2)."""
+    return sum(math.comb(n, i) for i in range(max(k, 0), n + 1)) / 2 ** n
+
+
+class StoppingRule:
+    """
+    Decides when a vote over max_votes analysts can stop. Only the counts of
+    the two leading labels matter; invalid answers count for neither.
+    """
+
+    def __init__(self, mode="majority", accuracy=0.75, error=0.05, confidence=0.95):
+        if mode not in VOTE_MODES:
+            raise ValueError(f"Unknown vote mode: {mode}")
+        self.mode = mode
+        self.confidence = confidence
+        # SPRT with symmetric errors: every vote moves the log-likelihood ratio by
+        # log(accuracy / (1 - accuracy)); the boundary is log((1 - error) / error)
+        self.lead = math.ceil(math.log((1 - error) / error) / math.log(accuracy / (1 - accuracy)) - 1e-9)
+
+    def decided(self, top, second, remaining):
+        if remaining <= 0 or top - second > remaining:
+            return True
+        if self.mode == "sprt":
+            return top - second >= self.lead
+        if self.mode == "bayes":
+            # Posterior of p = P(top label) is Beta(1 + top, 1 + second); P(p > 1/2) in closed form
+            return top > second and 1 - binomial_tail(top + second + 1, top + 1) >= self.confidence
+        return False
+
+    def needed(self, top, second, remaining):
+        """Fewest further votes that could end the vote (0 if it is over)."""
+        if self.decided(top, second, remaining):
+            return 0
+        if self.mode == "fixed":
+            return remaining
+        for k in range(1, remaining):
+            if self.decided(top + k, second, remaining - k):
+                return k
+        return remaining
+
+
+def rule_from_env():
+    return StoppingRule(vote_mode_from_env(),
+                        accuracy=_env_float("LLM_VOTE_ACCURACY", 0.75),
+                        error=_env_float("LLM_VOTE_ERROR", 0.05),
+                        confidence=_env_float("LLM_VOTE_CONFIDENCE", 0.95))
+
+
+class Vote:
+    """One sequential vote: ask for needed() more answers, add() their labels, repeat until needed() is 0."""
+
+    def __init__(self, max_votes, rule):
+        self.max_votes = max_votes
+        self.rule = rule
+        self.labels = []
+
+    def needed(self):
+        counts = Counter(label for label in self.labels if label)
+        top, second = (sorted(counts.values(), reverse=True) + [0, 0])[:2]
+        return self.rule.needed(top, second, self.max_votes - len(self.labels))
+
+    def add(self, labels):
+        self.labels.extend(labels)
+
+
+class VoteStats:
+    """Analysts asked per vote, against the full ensemble size."""
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.votes = 0
+        self.used = 0
+        self.available = 0
+        self._lock = threading.Lock()
+
+    def record(self, used, available):
+        with self._lock:
+            self.votes += 1
+            self.used += used
+            self.available += available
+
+    def report(self):
+        if not self.votes:
+            return f"Analyst votes ({self.rule.mode}): none"
+        return (f"Analyst votes ({self.rule.mode}): {self.votes} votes, {self.used / self.votes:.2f} of "
+                f"{self.available / self.votes:.2f} analysts used on average "
+                f"({self.available - self.used} analyst calls saved)")
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_vote_stats():
+    """Shared process-wide stopping rule and statistics (LLM_VOTE, LLM_VOTE_*)."""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = VoteStats(rule_from_env())
+            atexit.register(_print_report)
+        return _stats
+
+
+def _print_report():
+    if _stats is not None and _stats.votes:
+        print(_stats.report())
+
+
+def run_vote(draw, extract, max_votes):
+    """
+    Ask analysts until the vote is decided. draw(k) returns k more answers,
+    extract(answer) their label ("" if invalid). Returns the answers used.
+    """
+    stats = get_vote_stats()
+    vote = Vote(max_votes, stats.rule)
+    answers = []
+    while (k := vote.needed()):
+        batch = draw(k)
+        answers.extend(batch)
+        vote.add(extract(answer) for answer in batch)
+    stats.record(len(answers), max_votes)
+    return answers
+
+
+async def run_vote_async(draw, extract, max_votes):
+    """Async version of run_vote (draw(k) is awaited)."""
+    stats = get_vote_stats()
+    vote = Vote(max_votes, stats.rule)
+    answers = []
+    while (k := vote.needed()):
+        batch = await draw(k)
+        answers.extend(batch)
+        vote.add(extract(answer) for answer in batch)
+    stats.record(len(answers), max_votes)
+    return answers
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(description="Simulate the stopping rules on analysts of a given accuracy")
+    parser.add_argument("--analysts", type=int, default=3)
+    parser.add_argument("--accuracy", type=float, default=0.8, help="Probability that one analyst gives the true label")
+    parser.add_argument("--trials", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{args.analysts} analysts of accuracy {args.accuracy}, {args.trials} trials")
+    print(f"{'mode':<10}{'analysts used':>15}{'correct':>10}{'same as fixed':>15}")
+    for mode in VOTE_MODES:
+        rule = StoppingRule(mode, accuracy=_env_float("LLM_VOTE_ACCURACY", 0.75),
+                            error=_env_float("LLM_VOTE_ERROR", 0.05),
+                            confidence=_env_float("LLM_VOTE_CONFIDENCE", 0.95))
+        rng.seed(args.seed)
+        used = correct = same = 0
+        for trial in range(args.trials):
+            answers = ["HIGH" if rng.random() < args.accuracy else "LOW" for k in range(args.analysts)]
+            vote = Vote(args.analysts, rule)
+            while (k := vote.needed()):
+                vote.add(answers[len(vote.labels):len(vote.labels) + k])
+            decision = Counter(vote.labels).most_common(1)[0][0]
+            used += len(vote.labels)
+            correct += decision == "HIGH"
+            same += decision == Counter(answers).most_common(1)[0][0]
+        print(f"{mode:<10}{used / args.trials:>15.2f}{correct / args.trials:>10.1%}{same / args.trials:>15.1%}")
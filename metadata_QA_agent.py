@@ -1,15 +1,11 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
+from llm_cache import get_analysis_store
 import pandas as pd
 from scipy.stats import kendalltau
 import re
 model_name = "google/gemma-3-27b-it"
 # model_name = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 df = pd.read_csv("data/Metadata_QA_cleaned.csv")
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
 
 
 def extract_option_index(pred_raw, num_options=10):
@@ -48,10 +44,7 @@ def extract_option_index(pred_raw, num_options=10):
 
 def abc_expert_prompt(input_abc):
     return f"""
-You are an ABC notation expert. Your job is to interpret the following ABC score.
-
-Score:
-{input_abc}
+You are an ABC notation expert. Your job is to interpret the ABC score given below.
 
 Explain the meaning of each ABC component in a structured and concise way.
 Focus on:
@@ -67,6 +60,9 @@ Focus on:
 
 Do NOT answer the user's question.
 ONLY produce an analysis of the ABC score.
+
+Score:
+{input_abc}
 """
 
 def evaluator_prompt(analysis, task_prompt):
@@ -76,37 +72,34 @@ You are the evaluator agent.
 You will receive an analysis of an ABC score from the ABC Expert.
 Your job is to answer the user's question based ONLY on that analysis.
 
-ABC Expert Analysis:
-{analysis}
-
-Task:
-{task_prompt}
-
 Important:
 - Output ONLY the option index (0,1,2,3,...)
 - Do NOT output explanations
 - Do NOT repeat the analysis
 - Your answer must match one of the given options.
+
+ABC Expert Analysis:
+{analysis}
+
+Task:
+{task_prompt}
 """
 
-def abc_expert_agent(input_abc):
+@llm.stage("abc_expert")
+def generate_abc_analysis(input_abc):
     prompt = abc_expert_prompt(input_abc)
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
-    return response.choices[0].message.content
+    return llm.complete(prompt, model_name, temperature=0)
+
+def abc_expert_agent(input_abc):
+    # One analysis per distinct score (and expert model), reused by every question about it
+    return get_analysis_store().get_or_create(input_abc, model_name, generate_abc_analysis)
 
 
+@llm.stage("evaluator")
 def evaluator_agent(analysis, full_prompt, num_options):
     prompt = evaluator_prompt(analysis, full_prompt)
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
-    raw = response.choices[0].message.content
+    # LLM_GUIDED=1: the answer is constrained to one of the option indices
+    raw = llm.complete(prompt, model_name, temperature=0, **llm.guided(choices=range(num_options)))
     return extract_option_index(raw, num_options)
 
 
@@ -143,6 +136,7 @@ accuracy = correct / len(df)
 print("\n===========================")
 print(f"Model: {model_name}")
 print(f"Accuracy: {accuracy:.4f}")
+print(get_analysis_store().report())
 
 
 output_path = "metadata_QA_agent_gemma_results.csv"
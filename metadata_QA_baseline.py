@@ -1,5 +1,4 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
 import pandas as pd
 from scipy.stats import kendalltau
 import re
@@ -9,12 +8,6 @@ model_name = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 df = pd.read_csv("data/Metadata_QA_cleaned.csv")
 
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
-
 def extract_option_index(pred_raw, num_options=10):
 
     if pred_raw is None:
@@ -56,14 +49,10 @@ correct = 0
 for i, row in df.iterrows():
     prompt = row["prompt"] 
 
+    saving = None
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-
-        pred = response.choices[0].message.content
+        # With LLM_STREAM=1 generation stops once the answer starts with a number and a delimiter ("2.", "2)")
+        pred, saving = llm.complete_until(prompt, model_name, llm.leading_number, temperature=0)
         pred = extract_option_index(pred)
 
     except Exception as e:
@@ -77,7 +66,7 @@ for i, row in df.iterrows():
         correct += 1
 
 
-    print(f"[{i}] GT={row['solution']} | Pred={pred}")
+    print(f"[{i}] GT={row['solution']} | Pred={pred}{llm.describe_saving(saving)}")
 
 
 accuracy = correct / len(df)
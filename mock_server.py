@@ -0,0 +1,339 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Canned answers: (regex searched in the prompt, answer). The first match wins;
+# {label} is replaced by a label derived from the prompt (stable across runs).
+CANNED_ANSWERS = [
+    (r"(?s)planning agent.*User input:.*emotional",
+     '{"valid": true, "problem": "", "decision": "EMOTION", "abc_task": "", "emotion_task": ""}'),
+    (r"planning agent",
+     '{"valid": true, "problem": "", "decision": "ABC", "abc_task": "", "emotion_task": ""}'),
+    (r"input validator", "VALID_INPUT"),
+    (r"(?s)Controller Agent.*User prompt:.*emotional", "EMOTION"),
+    (r"Controller Agent", "ABC"),
+    (r"task splitter", "ABC_TASK:\nInput:\nX:1\nK:C\nM:4/4\nCDEF|\n\nTask: What is the key?\n\n"
+                       "EMOTION_TASK:\nInput:\nX:1\nK:C\nM:4/4\nCDEF|\n\nTask: Choose the emotion."),
+    (r"ABC notation expert", "X: reference number. M:4/4 common time. L:1/8 eighth-note unit. K:C major. "
+                             "The melody moves stepwise in a steady rhythm."),
+    (r"Arousal classification", "HIGH\nREASON: fast tempo and driving rhythm"),
+    (r"Valence classification", "LOW\nREASON: minor mode and falling lines"),
+    (r"format checker", "{label}"),
+    (r"meta-judge", "{label}"),
+    (r"emotion classifier", "{label} - steady tempo in a minor key"),
+    (r"Mapping:", "{label}"),
+]
+
+DEFAULT_LABELS = ("0", "1", "2", "3")
+
+
+def parse_latency(spec):
+    """
+    Latency distribution in milliseconds from a spec string:
+    fixed:MS, uniform:LOW,HIGH, normal:MEAN,SD, lognormal:MEDIAN,SIGMA.
+    Returns a function rng -> seconds.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "normal":
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0.0) / 1000
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def count_tokens(text):
+    # Word counts stand in for tokens
+    return len(str(text).split())
+
+
+class MockBackend:
+    """
+    Answers and behaviour of the mock server: canned answers, latency per
+    request and per generated token, injected errors, request counters.
+    """
+
+    def __init__(self, latency="fixed:50", token_ms=0.0, error_rate=0.0, error_status=(429, 503),
+                 answers=CANNED_ANSWERS, labels=DEFAULT_LABELS, seed=0, guided=True):
+        self.latency = parse_latency(latency)
+        # Honour vLLM guided_choice (guided=True) or reject guided requests with a 400 like endpoints without it
+        self.guided = guided
+        self.token_ms = token_ms
+        self.error_rate = error_rate
+        self.error_status = tuple(error_status)
+        self.answers = [(re.compile(pattern), answer) for pattern, answer in answers]
+        self.labels = tuple(labels)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"requests": 0, "chat": 0, "completions": 0, "prompts": 0, "streams": 0,
+                          "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def draw(self):
+        """(delay before the first token in seconds, error status or None) for one request."""
+        with self._lock:
+            delay = self.latency(self._rng)
+            failed = self._rng.random() < self.error_rate
+            status = self._rng.choice(self.error_status) if failed else None
+        return delay, status
+
+    def answer(self, prompt, max_tokens=None, stop=None, choices=None):
+        digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+        text = self.labels[digest % len(self.labels)]
+        for pattern, answer in self.answers:
+            if pattern.search(prompt):
+                text = answer.replace("{label}", self.labels[digest % len(self.labels)])
+                break
+        if choices:
+            # guided_choice: the canned answer if it is (or starts with) a choice, else a choice by hash
+            matching = [c for c in choices if text.strip().startswith(c)]
+            return max(matching, key=len) if matching else choices[digest % len(choices)]
+        for stop_text in ([stop] if isinstance(stop, str) else stop or []):
+            if stop_text and stop_text in text:
+                text = text[:text.index(stop_text)]
+        if max_tokens is not None:
+            words = re.findall(r"\S+\s*", text)
+            if len(words) > max_tokens:
+                text = "".join(words[:max_tokens]).rstrip()
+        return text
+
+    def logprobs(self, prompt, text, top_logprobs):
+        """
+        Chat logprobs of the first answer token: a label answer gets a prompt-derived
+        probability in [0.4, 0.9], the rest is spread over the other labels.
+        """
+        token = (text.split() or [""])[0]
+        if token not in self.labels:
+            candidates = [(token, 0.0)]
+        else:
+            digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+            p = 0.4 + 0.5 * (digest % 1000) / 1000
+            others = [label for label in self.labels if label != token]
+            candidates = [(token, math.log(p))] + [(label, math.log((1 - p) / len(others))) for label in others]
+        top = [{"token": t, "logprob": lp, "bytes": None} for t, lp in candidates[:max(top_logprobs or 0, 1)]]
+        return {"content": [{**top[0], "top_logprobs": top}]}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def backend(self):
+        return self.server.backend
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.backend.stats)
+        elif self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON"}})
+            return
+        path = self.path.rstrip("/")
+        if path == "/stats/reset":
+            self.backend.reset_stats()
+            self._send_json(200, self.backend.stats)
+            return
+        if path not in ("/v1/chat/completions", "/v1/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        backend = self.backend
+        backend.count(requests=1)
+        delay, status = backend.draw()
+        if status is not None:
+            time.sleep(delay / 4)
+            backend.count(errors=1)
+            self._send_json(status, {"error": {"message": f"Injected error {status}", "type": "mock_error", "code": status}})
+            return
+
+        if path == "/v1/chat/completions":
+            self._chat(request, delay)
+        else:
+            self._completions(request, delay)
+
+    def _chat(self, request, delay):
+        backend = self.backend
+        prompt = "\n".join(str(m.get("content", "")) for m in request.get("messages", []))
+        n = request.get("n") or 1
+        if not backend.guided and any(field in request for field in ("guided_choice", "guided_regex", "guided_json")):
+            self._send_json(400, {"error": {"message": "guided decoding is not supported", "type": "BadRequestError"}})
+            return
+        text = backend.answer(prompt, request.get("max_tokens"), request.get("stop"), request.get("guided_choice"))
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(text) * n
+        backend.count(chat=1, prompts=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        base = {"id": f"chatcmpl-mock-{time.time_ns()}", "created": int(time.time()), "model": request.get("model", "mock")}
+
+        if request.get("stream"):
+            backend.count(streams=1)
+            self._stream(request, delay, text, base, usage)
+            return
+
+        time.sleep(delay + backend.token_ms * count_tokens(text) / 1000)
+        self._send_json(200, {
+            **base,
+            "object": "chat.completion",
+            "choices": [{"index": i, "finish_reason": "stop", "message": {"role": "assistant", "content": text},
+                         "logprobs": backend.logprobs(prompt, text, request.get("top_logprobs"))
+                         if request.get("logprobs") else None}
+                        for i in range(n)],
+            "usage": usage,
+        })
+
+    def _stream(self, request, delay, text, base, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(choices, **extra):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": choices, **extra}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        time.sleep(delay)
+        try:
+            send([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for i, word in enumerate(re.findall(r"\s*\S+", text)):
+                if i:
+                    time.sleep(self.backend.token_ms / 1000)
+                send([{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early
+            pass
+
+    def _completions(self, request, delay):
+        backend = self.backend
+        prompts = request.get("prompt")
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        n = request.get("n") or 1
+        texts = [backend.answer(str(p), request.get("max_tokens"), request.get("stop")) for p in prompts]
+        prompt_tokens = sum(count_tokens(p) for p in prompts)
+        completion_tokens = sum(count_tokens(t) for t in texts) * n
+        backend.count(completions=1, prompts=len(prompts), prompt_tokens=prompt_tokens,
+                      completion_tokens=completion_tokens)
+        # A batch is decoded in parallel: pay for the longest answer
+        time.sleep(delay + backend.token_ms * max(count_tokens(t) for t in texts) / 1000)
+        self._send_json(200, {
+            "id": f"cmpl-mock-{time.time_ns()}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": i * n + j, "text": text, "finish_reason": "stop", "logprobs": None}
+                        for i, text in enumerate(texts) for j in range(n)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+class MockServer:
+    """
+    Local OpenAI-compatible stub (/v1/chat/completions, /v1/completions,
+    /v1/models, /stats) for benchmarking without spending endpoint quota.
+    Point the scripts at it with LLM_BACKEND=local LLM_BASE_URL=<base_url>.
+    """
+
+    def __init__(self, backend=None, host="127.0.0.1", port=0):
+        self.backend = backend or MockBackend()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.backend = self.backend
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Serve from a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# If this file is executed as a script ...
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local mock of an OpenAI-compatible LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="fixed:50",
+                        help="Time to first token in ms: fixed:MS, uniform:LOW,HIGH, normal:MEAN,SD, lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Decode time per generated token (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", default="429,503", help="Status codes of injected errors")
+    parser.add_argument("--answers", help="JSON file with [[regex, answer], ...] to use instead of the built-in answers")
+    parser.add_argument("--labels", default=",".join(DEFAULT_LABELS), help="Labels that {label} answers are drawn from")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reject-guided", action="store_true",
+                        help="Answer guided decoding requests with 400, like endpoints without the option")
+    args = parser.parse_args()
+
+    answers = CANNED_ANSWERS
+    if args.answers:
+        with open(args.answers, encoding="utf-8") as f:
+            answers = [tuple(entry) for entry in json.load(f)]
+    backend = MockBackend(latency=args.latency, token_ms=args.token_ms, error_rate=args.error_rate,
+                          error_status=[int(s) for s in args.error_status.split(",")], answers=answers,
+                          labels=args.labels.split(","), seed=args.seed, guided=not args.reject_guided)
+    server = MockServer(backend, args.host, args.port)
+    print(f"Mock LLM server on {server.base_url} (latency {args.latency}, {args.token_ms} ms/token, "
+          f"error rate {args.error_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,25 +1,30 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import llm_client as llm
+from llm_cache import get_analysis_store
+from llm_voting import run_vote, run_vote_async
 import pandas as pd
 import re
+import asyncio
+import contextvars
+import threading
+import time
+import zlib
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 model_name = "google/gemma-3-27b-it"
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
+# Analysts per arousal / valence vote (upper bound: see llm_voting for early stopping)
+num_analysts = 3
 
 
 
+# Prompt layout: static instructions first and variable content (score,
+# analysis, user input) last, so that vLLM's automatic prefix caching reuses
+# the KV blocks of the static part across samples.
 
 def abc_expert_prompt(input_abc):
     return f"""
-You are an ABC notation expert. Your job is to interpret the following ABC score.
-
-Score:
-{input_abc}
+You are an ABC notation expert. Your job is to interpret the ABC score given below.
 
 Explain the meaning of each ABC component in a structured and concise way.
 Focus on:
@@ -35,6 +40,9 @@ Focus on:
 
 Do NOT answer the user's question.
 ONLY produce an analysis of the ABC score.
+
+Score:
+{input_abc}
 """
 
 def evaluator_prompt(analysis, task_prompt):
@@ -44,26 +52,34 @@ You are the evaluator agent.
 You will receive an analysis of an ABC score from the ABC Expert.
 Your job is to answer the user's question based ONLY on that analysis.
 
+Important:
+- If the question asks for a specific option index (0, 1, 2, 3, etc.), output ONLY that number.
+- If the question asks for a general answer, provide a clear and concise answer based on the analysis.
+- Base your answer ONLY on the ABC Expert Analysis provided below.
+
 ABC Expert Analysis:
 {analysis}
 
 Task:
 {task_prompt}
-
-Important:
-- If the question asks for a specific option index (0, 1, 2, 3, etc.), output ONLY that number.
-- If the question asks for a general answer, provide a clear and concise answer based on the analysis.
-- Base your answer ONLY on the ABC Expert Analysis provided above.
 """
 
-def abc_expert_agent(input_abc):
+@llm.stage("abc_expert")
+def generate_abc_analysis(input_abc):
     prompt = abc_expert_prompt(input_abc)
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
-    return response.choices[0].message.content
+    return llm.complete(prompt, model_name, temperature=0)
+
+@llm.stage("abc_expert")
+async def generate_abc_analysis_async(input_abc):
+    prompt = abc_expert_prompt(input_abc)
+    return await llm.complete_async(prompt, model_name, temperature=0)
+
+def abc_expert_agent(input_abc):
+    # One analysis per distinct score (and expert model), reused by every question about it
+    return get_analysis_store().get_or_create(input_abc, model_name, generate_abc_analysis)
+
+async def abc_expert_agent_async(input_abc):
+    return await get_analysis_store().aget_or_create(input_abc, model_name, generate_abc_analysis_async)
 
 
 def extract_option_index(pred_raw, num_options=10):
@@ -104,6 +120,31 @@ def extract_option_index(pred_raw, num_options=10):
     # 5) fallback (not found)
     return ""
 
+def leading_option_index(text, num_options=10):
+    """
+    Option index the answer starts with, once it is followed by a delimiter and
+    is a valid option, else "" (ends the evaluator stream early).
+    """
+    index = llm.leading_number(text)
+    return index if index and int(index) < num_options else ""
+
+# Numbered answer options in a prompt ("0. A  1. B  2. C  3. D")
+OPTION_PATTERN = r'(\d+)\.\s*[^\d\n]+'
+
+def option_answer_regex(num_options):
+    """Guided regex for a full evaluator answer: the option index, optionally followed by the reasoning."""
+    indices = "|".join(str(i) for i in range(num_options))
+    return rf"({indices})(\n[\s\S]{{1,800}})?"
+
+def evaluator_guidance(full_prompt, num_options, return_full):
+    """Guided decoding params for the evaluator ({} if off or the task lists no options)."""
+    if not llm.use_guided_decoding or not re.search(OPTION_PATTERN, full_prompt):
+        return {}
+    if return_full:
+        return llm.guided(regex=option_answer_regex(num_options))
+    return llm.guided(choices=range(num_options))
+
+@llm.stage("evaluator")
 def evaluator_agent(analysis, full_prompt, num_options, return_full=False):
     """
     Evaluator agent that answers questions based on ABC analysis.
@@ -118,65 +159,118 @@ def evaluator_agent(analysis, full_prompt, num_options, return_full=False):
         Option index (string) if return_full=False, or full response if return_full=True
     """
     prompt = evaluator_prompt(analysis, full_prompt)
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
-        max_tokens=200 if return_full else 50
-    )
-    raw = response.choices[0].message.content.strip()
-    
+    guidance = evaluator_guidance(full_prompt, num_options, return_full)
+    if guidance:
+        # The answer starts with the option index by construction, so there is nothing to stream
+        # (extract_option_index still covers endpoints that reject the option)
+        raw = llm.complete(prompt, model_name, temperature=0, max_tokens=200 if return_full else 4, **guidance)
+        return raw if return_full else extract_option_index(raw, num_options)
+    # With LLM_STREAM=1 generation stops at the option index the answer starts with
+    raw, saving = llm.complete_until(prompt, model_name, lambda text: leading_option_index(text, num_options),
+                                     temperature=0, max_tokens=200 if return_full else 50)
+    if saving is not None:
+        print(f"Evaluator answer{llm.describe_saving(saving)}")
+
     if return_full:
         return raw
     else:
         # Extract option index
         return extract_option_index(raw, num_options)
 
+@llm.stage("evaluator")
+async def evaluator_agent_async(analysis, full_prompt, num_options, return_full=False):
+    """Async version of evaluator_agent."""
+    prompt = evaluator_prompt(analysis, full_prompt)
+    guidance = evaluator_guidance(full_prompt, num_options, return_full)
+    if guidance:
+        raw = await llm.complete_async(prompt, model_name, temperature=0, max_tokens=200 if return_full else 4,
+                                       **guidance)
+        return raw if return_full else extract_option_index(raw, num_options)
+    raw, saving = await llm.complete_until_async(prompt, model_name, lambda text: leading_option_index(text, num_options),
+                                                 temperature=0, max_tokens=200 if return_full else 50)
+    if saving is not None:
+        print(f"Evaluator answer{llm.describe_saving(saving)}")
+
+    if return_full:
+        return raw
+    else:
+        return extract_option_index(raw, num_options)
+
+
+def count_options(user_prompt):
+    """Determine number of options from the prompt (e.g., "0. A  1. B  2. C  3. D")."""
+    options_match = re.findall(OPTION_PATTERN, user_prompt)
+    return len(options_match) if options_match else 4  # Default to 4
+
+def format_abc_answer(full_answer, num_options):
+    """Turn the evaluator's full answer into the ABC system response."""
+    # Extract option index from full answer
+    option_index = extract_option_index(full_answer, num_options)
+
+    # If we found an option index and the full answer is just a number, return the full answer
+    # Otherwise, return the full answer which should contain explanation
+    if option_index and len(full_answer.strip()) <= 3:
+        # Just a number, return it
+        return option_index
+    elif option_index and option_index in full_answer:
+        # Full answer contains the option, return it
+        return full_answer
+    elif option_index:
+        # We have an option but full answer doesn't contain it clearly
+        return f"Answer: {option_index}\n\n{full_answer}"
+    else:
+        # No clear option index, return full answer
+        return full_answer if full_answer else "Error: Could not determine answer."
 
+@llm.span("agent_B")
 def agent_B_abc_system(user_prompt):
     """
     ABC expert system: analyzes ABC score and answers questions about it.
     """
     # Extract ABC from user prompt using the unified extraction function
     abc_text = extract_abc_from_prompt(user_prompt)
-    
+
     if not abc_text or len(abc_text) < 5:
         return "Error: Could not extract ABC score from the prompt."
-    
+
     try:
         # Step 1: Expert analysis of ABC score
         analysis = abc_expert_agent(abc_text)
-        
+
         if not analysis:
             return "Error: Failed to analyze ABC score."
-        
+
         # Step 2: Determine number of options from the prompt
-        # Check if prompt contains options (e.g., "0. A  1. B  2. C  3. D")
-        options_match = re.findall(r'(\d+)\.\s*[^\d\n]+', user_prompt)
-        num_options = len(options_match) if options_match else 4  # Default to 4
-        
+        num_options = count_options(user_prompt)
+
         # Step 3: Evaluator answers user question based on analysis
         # Get full response for better context
         full_answer = evaluator_agent(analysis, user_prompt, num_options, return_full=True)
-        
-        # Extract option index from full answer
-        option_index = extract_option_index(full_answer, num_options)
-        
-        # If we found an option index and the full answer is just a number, return the full answer
-        # Otherwise, return the full answer which should contain explanation
-        if option_index and len(full_answer.strip()) <= 3:
-            # Just a number, return it
-            return option_index
-        elif option_index and option_index in full_answer:
-            # Full answer contains the option, return it
-            return full_answer
-        elif option_index:
-            # We have an option but full answer doesn't contain it clearly
-            return f"Answer: {option_index}\n\n{full_answer}"
-        else:
-            # No clear option index, return full answer
-            return full_answer if full_answer else "Error: Could not determine answer."
-        
+
+        return format_abc_answer(full_answer, num_options)
+
+    except Exception as e:
+        return f"Error in ABC system: {str(e)}"
+
+@llm.span("agent_B")
+async def agent_B_abc_system_async(user_prompt):
+    """Async version of agent_B_abc_system."""
+    abc_text = extract_abc_from_prompt(user_prompt)
+
+    if not abc_text or len(abc_text) < 5:
+        return "Error: Could not extract ABC score from the prompt."
+
+    try:
+        analysis = await abc_expert_agent_async(abc_text)
+
+        if not analysis:
+            return "Error: Failed to analyze ABC score."
+
+        num_options = count_options(user_prompt)
+        full_answer = await evaluator_agent_async(analysis, user_prompt, num_options, return_full=True)
+
+        return format_abc_answer(full_answer, num_options)
+
     except Exception as e:
         return f"Error in ABC system: {str(e)}"
 
@@ -188,20 +282,15 @@ category_text = """Categories:
 3: Q4 (relaxed - high valence, low  arousal)
 """
 
-def call_llm(prompt, max_tokens=128, temperature=0.5):
+def call_llm(prompt, max_tokens=128, temperature=0.5, **params):
     """Helper function to call LLM."""
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stop=["\n"] if max_tokens <= 8 else None
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Error calling LLM: {e}")
-        return ""
+    return llm.call_llm(prompt, model_name, temperature=temperature, max_tokens=max_tokens,
+                        stop=["\n"] if max_tokens <= 8 else None, **params)
+
+async def call_llm_async(prompt, max_tokens=128, temperature=0.5, **params):
+    """Async version of call_llm."""
+    return await llm.call_llm_async(prompt, model_name, temperature=temperature, max_tokens=max_tokens,
+                                    stop=["\n"] if max_tokens <= 8 else None, **params)
 
 def extract_abc_from_prompt(user_prompt):
     """Extract ABC score from user prompt."""
@@ -261,9 +350,16 @@ def extract_abc_from_prompt(user_prompt):
     return user_prompt.strip()
 
 # Arousal-Valence based emotion classification functions
+# The arousal, valence and combiner prompts all start with the same header and
+# the score, followed by the role's instructions: the prefix cache then reuses
+# the score's KV blocks for every call about that score, not just the header.
+emotion_score_header = "Musical score (ABC notation):\n"
+
 def build_arousal_classifier_prompt(abc_score):
     """Build prompt for arousal classifier (HIGH or LOW)."""
-    prompt = f"""Arousal classification:
+    prompt = f"""{emotion_score_header}{abc_score}
+
+Arousal classification:
 - HIGH arousal: energetic, intense, driving
 - LOW arousal: calm, peaceful, relaxed
 
@@ -271,14 +367,14 @@ Output format:
 AROUSAL: <HIGH or LOW>
 REASON: <brief explanation>
 
-{abc_score}
-
 AROUSAL:"""
     return prompt
 
 def build_valence_classifier_prompt(abc_score):
     """Build prompt for valence classifier (HIGH or LOW)."""
-    prompt = f"""Valence classification:
+    prompt = f"""{emotion_score_header}{abc_score}
+
+Valence classification:
 - HIGH valence: pleasant, bright, joyful
 - LOW valence: unpleasant, dark, sad
 
@@ -286,23 +382,20 @@ Output format:
 VALENCE: <HIGH or LOW>
 REASON: <brief explanation>
 
-{abc_score}
-
 VALENCE:"""
     return prompt
 
 def build_emotion_combiner_prompt(abc_score, arousal_result, valence_result):
     """Build prompt for combining arousal and valence into final emotion category."""
-    prompt = f"""{category_text}
+    prompt = f"""{emotion_score_header}{abc_score}
 
+{category_text}
 Mapping:
 - High Valence + High Arousal → Label 0
 - Low Valence + High Arousal → Label 1
 - Low Valence + Low Arousal → Label 2
 - High Valence + Low Arousal → Label 3
 
-{abc_score}
-
 Arousal: {arousal_result}
 Valence: {valence_result}
 
@@ -331,6 +424,10 @@ def extract_arousal(text: str) -> str:
                 return "HIGH"
             elif "LOW" in arousal_line[0].upper():
                 return "LOW"
+    # The prompt ends with "AROUSAL:", so the answer usually starts with the level itself
+    first_word = text_upper.split()[0].strip("*.,:") if text_upper.split() else ""
+    if first_word in ("HIGH", "LOW"):
+        return first_word
     # Fallback: search for HIGH or LOW
     if "HIGH" in text_upper and "AROUSAL" in text_upper:
         return "HIGH"
@@ -350,6 +447,10 @@ def extract_valence(text: str) -> str:
                 return "HIGH"
             elif "LOW" in valence_line[0].upper():
                 return "LOW"
+    # The prompt ends with "VALENCE:", so the answer usually starts with the level itself
+    first_word = text_upper.split()[0].strip("*.,:") if text_upper.split() else ""
+    if first_word in ("HIGH", "LOW"):
+        return first_word
     # Fallback: search for HIGH or LOW
     if "HIGH" in text_upper and "VALENCE" in text_upper:
         return "HIGH"
@@ -357,18 +458,57 @@ def extract_valence(text: str) -> str:
         return "LOW"
     return ""
 
+def majority_vote(levels, reasons):
+    """
+    Majority vote over HIGH/LOW analyst predictions.
+    Returns: (final_level, combined_reason, decided) - decided is False when
+    there is no valid vote or HIGH and LOW are tied
+    """
+    valid_levels = [l for l in levels if l in ["HIGH", "LOW"]]
+    counts = Counter(valid_levels).most_common()
+    if valid_levels:
+        final_level = counts[0][0]
+    else:
+        final_level = ""
+    decided = bool(counts) and (len(counts) == 1 or counts[0][1] > counts[1][1])
+
+    # Combine reasons
+    combined_reason = " | ".join([r for r in reasons if r])
+
+    return final_level, combined_reason, decided
+
+# Guided decoding (LLM_GUIDED=1): the level, then the reason on one line
+ANALYST_ANSWER_REGEX = r"(HIGH|LOW)\nREASON: [^\n]{1,400}"
+EMOTION_LABELS = ("0", "1", "2", "3")
+
+def call_analysts(prompt, num_analysts):
+    """
+    Get num_analysts answers to the same analyst prompt.
+    Uses one n-sample request when supported, otherwise parallel separate requests.
+    """
+    return llm.sample(prompt, model_name, num_analysts, max_tokens=128, temperature=0.4,
+                      **llm.guided(regex=ANALYST_ANSWER_REGEX))
+
+async def call_analysts_async(prompt, num_analysts):
+    """Async version of call_analysts."""
+    return await llm.sample_async(prompt, model_name, num_analysts, max_tokens=128, temperature=0.4,
+                                  **llm.guided(regex=ANALYST_ANSWER_REGEX))
+
+@llm.stage("arousal_analysts")
 def classify_arousal(abc_score, num_analysts=3):
     """
     Classify arousal level (HIGH or LOW) using multiple analysts.
-    Returns: (arousal_level, arousal_reason)
+    Returns: (arousal_level, arousal_reason, decided)
     """
     arousal_predictions = []
     arousal_reasons = []
     
-    for k in range(num_analysts):
-        prompt = build_arousal_classifier_prompt(abc_score)
-        answer = call_llm(prompt, max_tokens=128, temperature=0.4)
-        
+    # Analysts are independent, so each round queries them in parallel; the
+    # vote stops as soon as further analysts cannot change the outcome
+    prompt = build_arousal_classifier_prompt(abc_score)
+    answers = run_vote(lambda k: call_analysts(prompt, k), extract_arousal, num_analysts)
+    
+    for answer in answers:
         arousal = extract_arousal(answer)
         reason = extract_reason(answer)
         
@@ -376,29 +516,30 @@ def classify_arousal(abc_score, num_analysts=3):
         arousal_reasons.append(reason)
     
     # Majority vote for arousal
-    valid_arousals = [a for a in arousal_predictions if a in ["HIGH", "LOW"]]
-    if valid_arousals:
-        final_arousal = Counter(valid_arousals).most_common(1)[0][0]
-    else:
-        final_arousal = ""
-    
-    # Combine reasons
-    combined_reason = " | ".join([r for r in arousal_reasons if r])
-    
-    return final_arousal, combined_reason
+    return majority_vote(arousal_predictions, arousal_reasons)
+
+@llm.stage("arousal_analysts")
+async def classify_arousal_async(abc_score, num_analysts=3):
+    """Async version of classify_arousal."""
+    prompt = build_arousal_classifier_prompt(abc_score)
+    answers = await run_vote_async(lambda k: call_analysts_async(prompt, k), extract_arousal, num_analysts)
+    return majority_vote([extract_arousal(a) for a in answers], [extract_reason(a) for a in answers])
 
+@llm.stage("valence_analysts")
 def classify_valence(abc_score, num_analysts=3):
     """
     Classify valence level (HIGH or LOW) using multiple analysts.
-    Returns: (valence_level, valence_reason)
+    Returns: (valence_level, valence_reason, decided)
     """
     valence_predictions = []
     valence_reasons = []
     
-    for k in range(num_analysts):
-        prompt = build_valence_classifier_prompt(abc_score)
-        answer = call_llm(prompt, max_tokens=128, temperature=0.4)
-        
+    # Analysts are independent, so each round queries them in parallel; the
+    # vote stops as soon as further analysts cannot change the outcome
+    prompt = build_valence_classifier_prompt(abc_score)
+    answers = run_vote(lambda k: call_analysts(prompt, k), extract_valence, num_analysts)
+    
+    for answer in answers:
         valence = extract_valence(answer)
         reason = extract_reason(answer)
         
@@ -406,23 +547,19 @@ def classify_valence(abc_score, num_analysts=3):
         valence_reasons.append(reason)
     
     # Majority vote for valence
-    valid_valences = [v for v in valence_predictions if v in ["HIGH", "LOW"]]
-    if valid_valences:
-        final_valence = Counter(valid_valences).most_common(1)[0][0]
-    else:
-        final_valence = ""
-    
-    # Combine reasons
-    combined_reason = " | ".join([r for r in valence_reasons if r])
-    
-    return final_valence, combined_reason
+    return majority_vote(valence_predictions, valence_reasons)
 
-def agent_C_emotion_system(user_prompt):
+@llm.stage("valence_analysts")
+async def classify_valence_async(abc_score, num_analysts=3):
+    """Async version of classify_valence."""
+    prompt = build_valence_classifier_prompt(abc_score)
+    answers = await run_vote_async(lambda k: call_analysts_async(prompt, k), extract_valence, num_analysts)
+    return majority_vote([extract_valence(a) for a in answers], [extract_reason(a) for a in answers])
+
+def check_emotion_abc(user_prompt):
     """
-    Emotion recognition system using arousal-valence approach.
-    Step 1: Classify arousal (HIGH/LOW) using multiple analysts
-    Step 2: Classify valence (HIGH/LOW) using multiple analysts
-    Step 3: Combine arousal and valence to get final emotion category (Q1-Q4)
+    Extract the ABC score for the emotion system.
+    Returns: (abc_score, error_message) - error_message is None on success
     """
     # Extract ABC score from prompt
     abc_score = extract_abc_from_prompt(user_prompt)
@@ -431,41 +568,101 @@ def agent_C_emotion_system(user_prompt):
     if not abc_score or len(abc_score) < 10 or not any(c in abc_score for c in ['X:', 'K:', 'M:', 'L:']):
         # Try to provide helpful error message
         if "Input:" in user_prompt or "Score:" in user_prompt:
-            return f"Error: Could not extract ABC score from the prompt. Extracted content: {abc_score[:100]}..."
+            return abc_score, f"Error: Could not extract ABC score from the prompt. Extracted content: {abc_score[:100]}..."
         else:
-            return "Error: Could not extract ABC score. Please ensure the prompt contains ABC notation after 'Input:' or 'Score:'."
-    
-    num_analysts = 3
-    
-    # Step 1: Classify arousal (HIGH or LOW)
-    arousal_level, arousal_reason = classify_arousal(abc_score, num_analysts)
-    
-    # Step 2: Classify valence (HIGH or LOW)
-    valence_level, valence_reason = classify_valence(abc_score, num_analysts)
-    
-    # Step 3: Combine arousal and valence to get final emotion category
-    arousal_result = f"Arousal: {arousal_level}\nReason: {arousal_reason}"
-    valence_result = f"Valence: {valence_level}\nReason: {valence_reason}"
-    
-    combiner_prompt = build_emotion_combiner_prompt(abc_score, arousal_result, valence_result)
-    combiner_answer = call_llm(combiner_prompt, max_tokens=4, temperature=0.0)
-    
+            return abc_score, "Error: Could not extract ABC score. Please ensure the prompt contains ABC notation after 'Input:' or 'Score:'."
+    return abc_score, None
+
+class DecisionStats:
+    """
+    Counts the decisions made locally instead of by an LLM call (None: deferred
+    to the LLM) and how often the audited ones agree with the LLM.
+    """
+
+    def __init__(self, name, rule, call):
+        self.name = name
+        self.rule = rule
+        self.call = call
+        self.fast = 0
+        self.deferred = 0
+        self.audited = 0
+        self.agreed = 0
+        self.disagreements = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, rule_decision, llm_decision=None):
+        with self._lock:
+            if rule_decision is None:
+                self.deferred += 1
+                return
+            self.fast += 1
+            if llm_decision is not None:
+                self.audited += 1
+                if llm_decision == rule_decision:
+                    self.agreed += 1
+                else:
+                    self.disagreements[(rule_decision, llm_decision)] += 1
+
+    def report(self):
+        total = self.fast + self.deferred
+        line = (f"{self.name}: {self.fast}/{total} decided by {self.rule}, {self.deferred} deferred to the LLM "
+                f"({self.fast - self.audited} {self.call} calls saved)")
+        if self.audited:
+            line += f"; audit agreement {self.agreed}/{self.audited} ({self.agreed / self.audited:.0%})"
+            line += "".join(f"\n  {self.rule} {rule_decision} vs LLM {decision}: {count}"
+                            for (rule_decision, decision), count in self.disagreements.most_common())
+        return line
+
+
+def should_audit(text, rate):
+    """Pick a share `rate` of inputs by hash, so reruns audit the same samples."""
+    return zlib.crc32(text.encode("utf-8")) % 1000 < rate * 1000
+
+
+# Deterministic arousal/valence -> label mapping instead of the combiner call
+# when both votes are decided; the combiner is asked only for missing or tied
+# dimensions (and for an audited share of the mapped samples).
+
+use_quadrant_mapping = True
+combiner_audit_rate = 0.1
+
+QUADRANT_LABELS = {("HIGH", "HIGH"): "0", ("HIGH", "LOW"): "1", ("LOW", "LOW"): "2", ("LOW", "HIGH"): "3"}
+
+combiner_stats = DecisionStats("Emotion combiner", "quadrant", "combiner")
+
+
+def quadrant_label(arousal_level, valence_level):
+    """Label 0-3 for (arousal, valence) levels, or "" if a level is missing."""
+    return QUADRANT_LABELS.get((arousal_level, valence_level), "")
+
+
+def combiner_label(combiner_answer):
+    match = re.search(r'\b([0-3])\b', combiner_answer)
+    return match.group(1) if match else "INVALID"
+
+
+def map_emotion(arousal_vote, valence_vote):
+    """The quadrant label when mapping is on and both votes are decided, else None (ask the combiner)."""
+    (arousal_level, _, arousal_decided), (valence_level, _, valence_decided) = arousal_vote, valence_vote
+    if not use_quadrant_mapping or not (arousal_decided and valence_decided):
+        return None
+    return quadrant_label(arousal_level, valence_level) or None
+
+
+def record_emotion_mapping(mapped, combiner_answer):
+    if use_quadrant_mapping:
+        combiner_stats.record(mapped, None if mapped is None or combiner_answer is None else combiner_label(combiner_answer))
+
+
+def build_emotion_response(combiner_answer, arousal_level, arousal_reason, valence_level, valence_reason):
+    """Turn the combiner answer (or mapped label) and the arousal/valence votes into the emotion system response."""
     # Extract final label
     final_label_match = re.search(r'\b([0-3])\b', combiner_answer)
     if final_label_match:
         final_label = final_label_match.group(1)
     else:
         # Fallback: map arousal+valence directly
-        if arousal_level == "HIGH" and valence_level == "HIGH":
-            final_label = "0"  # Q1
-        elif arousal_level == "HIGH" and valence_level == "LOW":
-            final_label = "1"  # Q2
-        elif arousal_level == "LOW" and valence_level == "LOW":
-            final_label = "2"  # Q3
-        elif arousal_level == "LOW" and valence_level == "HIGH":
-            final_label = "3"  # Q4
-        else:
-            final_label = ""
+        final_label = quadrant_label(arousal_level, valence_level)
     
     # Map label to emotion name
     emotion_map = {"0": "Q1 (happy)", "1": "Q2 (angry)", "2": "Q3 (sad)", "3": "Q4 (relaxed)"}
@@ -481,6 +678,72 @@ def agent_C_emotion_system(user_prompt):
     
     return response
 
+@llm.span("agent_C")
+def agent_C_emotion_system(user_prompt):
+    """
+    Emotion recognition system using arousal-valence approach.
+    Step 1: Classify arousal (HIGH/LOW) using multiple analysts
+    Step 2: Classify valence (HIGH/LOW) using multiple analysts
+    Step 3: Combine arousal and valence to get final emotion category (Q1-Q4)
+    """
+    abc_score, error_message = check_emotion_abc(user_prompt)
+    if error_message:
+        return error_message
+    
+    # Step 1 + 2: Classify arousal and valence (HIGH or LOW) in parallel
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # Run each branch in a copy of this context so its spans stay under this sample
+        arousal_future = pool.submit(contextvars.copy_context().run, classify_arousal, abc_score, num_analysts)
+        valence_future = pool.submit(contextvars.copy_context().run, classify_valence, abc_score, num_analysts)
+        arousal_vote = arousal_future.result()
+        valence_vote = valence_future.result()
+    arousal_level, arousal_reason, _ = arousal_vote
+    valence_level, valence_reason, _ = valence_vote
+    
+    # Step 3: Combine arousal and valence to get final emotion category:
+    # the quadrant mapping when both votes are decided, otherwise the combiner
+    mapped = map_emotion(arousal_vote, valence_vote)
+    combiner_answer = None
+    if mapped is None or should_audit(abc_score, combiner_audit_rate):
+        arousal_result = f"Arousal: {arousal_level}\nReason: {arousal_reason}"
+        valence_result = f"Valence: {valence_level}\nReason: {valence_reason}"
+        
+        combiner_prompt = build_emotion_combiner_prompt(abc_score, arousal_result, valence_result)
+        with llm.stage("combiner"):
+            combiner_answer = call_llm(combiner_prompt, max_tokens=4, temperature=0.0,
+                                       **llm.guided(choices=EMOTION_LABELS))
+    record_emotion_mapping(mapped, combiner_answer)
+    
+    return build_emotion_response(mapped or combiner_answer, arousal_level, arousal_reason, valence_level, valence_reason)
+
+@llm.span("agent_C")
+async def agent_C_emotion_system_async(user_prompt):
+    """Async version of agent_C_emotion_system."""
+    abc_score, error_message = check_emotion_abc(user_prompt)
+    if error_message:
+        return error_message
+
+    arousal_vote, valence_vote = await asyncio.gather(
+        classify_arousal_async(abc_score, num_analysts),
+        classify_valence_async(abc_score, num_analysts)
+    )
+    arousal_level, arousal_reason, _ = arousal_vote
+    valence_level, valence_reason, _ = valence_vote
+
+    mapped = map_emotion(arousal_vote, valence_vote)
+    combiner_answer = None
+    if mapped is None or should_audit(abc_score, combiner_audit_rate):
+        arousal_result = f"Arousal: {arousal_level}\nReason: {arousal_reason}"
+        valence_result = f"Valence: {valence_level}\nReason: {valence_reason}"
+
+        combiner_prompt = build_emotion_combiner_prompt(abc_score, arousal_result, valence_result)
+        with llm.stage("combiner"):
+            combiner_answer = await call_llm_async(combiner_prompt, max_tokens=4, temperature=0.0,
+                                                   **llm.guided(choices=EMOTION_LABELS))
+    record_emotion_mapping(mapped, combiner_answer)
+
+    return build_emotion_response(mapped or combiner_answer, arousal_level, arousal_reason, valence_level, valence_reason)
+
 
 def input_validator_prompt(user_prompt, extracted_abc, has_abc):
     """Build prompt for input validation LLM."""
@@ -490,15 +753,12 @@ def input_validator_prompt(user_prompt, extracted_abc, has_abc):
 
 Your task is to check if the user input contains an ABC notation score.
 
-User input:
-{user_prompt}
-
 ABC notation typically:
 - Starts with headers like X:, K:, M:, L:, R:
 - Contains musical notes (A-G with optional sharps/flats and octaves)
 - May be wrapped in code blocks (```) or after "Input:" or "Score:"
 
-Please analyze the user input and:
+Please analyze the user input below and:
 1. If you find ABC notation, extract it completely and respond with:
    EXTRACTED_ABC:
    [the complete ABC score here]
@@ -509,6 +769,9 @@ Please analyze the user input and:
 3. If the input is unclear or incomplete, respond with:
    UNCLEAR_INPUT
 
+User input:
+{user_prompt}
+
 Your response:"""
     else:
         # ABC score extracted, verify it's complete and check for question
@@ -518,13 +781,7 @@ Your task is to:
 1. Verify that the extracted ABC score is complete and correct
 2. Check if the user has asked a question
 
-User input:
-{user_prompt}
-
-Extracted ABC score:
-{extracted_abc}
-
-Please analyze and respond in one of these formats:
+Please analyze the user input and the extracted ABC score below, and respond in one of these formats:
 
 If the ABC score is complete and correct, AND the user has asked a question:
 VALID_INPUT
@@ -540,9 +797,111 @@ If there are other issues:
 ISSUE:
 [description of the issue]
 
+User input:
+{user_prompt}
+
+Extracted ABC score:
+{extracted_abc}
+
 Your response:"""
 
 
+def parse_extraction_result(validation_result):
+    """
+    Parse the validator response when no ABC score was found by the script.
+    Returns: (verified_abc, error_message) - exactly one of them is None
+    """
+    if "NO_ABC_SCORE" in validation_result.upper():
+        return (None, "No ABC score detected in your input. Please include an ABC notation score and try again.")
+    elif "EXTRACTED_ABC:" in validation_result:
+        # LLM found ABC score, extract it
+        abc_match = re.search(r"EXTRACTED_ABC:\s*\n(.*?)(?=\n\n|\n[A-Z_]+:|$)", validation_result, re.S)
+        if abc_match:
+            return (abc_match.group(1).strip(), None)
+        else:
+            # Try to extract from the rest of the response
+            lines = validation_result.split("EXTRACTED_ABC:")[1].strip().split("\n")
+            verified_abc = "\n".join([l for l in lines if not l.strip().startswith(("NO_", "UNCLEAR", "VALID", "INCOMPLETE", "ISSUE"))]).strip()
+            if verified_abc:
+                return (verified_abc, None)
+            else:
+                return (None, "Could not extract ABC score. Please format your input clearly with ABC notation.")
+    elif "UNCLEAR_INPUT" in validation_result.upper():
+        return (None, "Input is unclear. Please provide a clear ABC notation score and a question.")
+    else:
+        # LLM might have extracted ABC in a different format
+        return (None, "No ABC score detected. Please include an ABC notation score and try again.")
+
+
+# Local structural validation. A score with headers, bar lines, notes and
+# balanced brackets plus an explicit task or question is accepted without the
+# LLM validator; anything else (malformed scores, free-form input) still goes
+# to the LLM.
+
+use_local_validator = True
+
+ABC_HEADER = re.compile(r"^\s*([A-Za-z]):\s*\S", re.M)
+ABC_NOTE = re.compile(r"[=_^]*[A-Ga-g][,']*\d*")
+# Chord symbols / annotations, decorations, inline fields and comments: skipped by the body checks
+ABC_NON_MUSIC = re.compile(r'"[^"\n]*"|![^!\n]*!|\+[^+\n]*\+|\[[A-Za-z]:[^\]\n]*\]|%.*$', re.M)
+# Tuplets "(3", variant endings "[1" and the bar lines "[|" / "|]" use a bracket without its pair
+ABC_OPEN_MARKERS = re.compile(r"\(\d(?::\d*){0,2}|\[\d|\[\||\|\]")
+# A word that cannot be ABC (letters other than notes and rests): prose mixed into the score
+NON_ABC_WORD = re.compile(r"\b(?=[A-Za-z]*[H-Yh-yZ])[A-Za-z]{4,}\b")
+QUESTION = re.compile(r"^Task:\s*\S+(?:\s+\S+){2}|\?\s*$", re.M)
+
+validation_counts = Counter()
+
+
+def check_abc_structure(abc_score):
+    """
+    Structural problems of an ABC score (empty list when it looks complete):
+    K: plus M: or L: headers, a body with bar lines and notes, balanced brackets.
+    """
+    problems = []
+    headers = set(ABC_HEADER.findall(abc_score))
+    if "K" not in headers:
+        problems.append("missing K: header")
+    if not headers & {"M", "L"}:
+        problems.append("missing M:/L: header")
+
+    body = "\n".join(line for line in abc_score.splitlines() if not ABC_HEADER.match(line))
+    music = ABC_OPEN_MARKERS.sub("", ABC_NON_MUSIC.sub(" ", body))
+    if "|" not in music:
+        problems.append("no bar lines")
+    if not ABC_NOTE.search(music):
+        problems.append("no notes")
+    if NON_ABC_WORD.search(music):
+        problems.append("text mixed into the score")
+    for opening, closing in ("[]", "()", "{}"):
+        if music.count(opening) != music.count(closing):
+            problems.append(f"unbalanced {opening}{closing}")
+    if body.count('"') % 2:
+        problems.append('unbalanced "')
+    return problems
+
+
+def validate_locally(user_prompt, abc_score):
+    """
+    (True, None, abc_score) when the score is well formed and the prompt has an
+    explicit task ("Task: ...") or question; None when the LLM validator must decide.
+    """
+    if not use_local_validator or not abc_score or abc_score == user_prompt.strip():
+        return None
+    if check_abc_structure(abc_score):
+        return None
+    if not QUESTION.search(user_prompt.replace(abc_score, " ")):
+        return None
+    return (True, None, abc_score)
+
+
+def validation_report():
+    local = validation_counts["local"]
+    total = local + validation_counts["llm"]
+    return f"Input validation: {local}/{total} inputs validated locally ({local} validator calls saved)"
+
+
+@llm.stage("validator")
 def validate_input(user_prompt):
     """
     Validate user input before processing.
@@ -554,44 +913,29 @@ def validate_input(user_prompt):
     # Step 1: Try to extract ABC score using script
     extracted_abc = extract_abc_from_prompt(user_prompt)
     has_abc = extracted_abc and len(extracted_abc) > 10 and any(c in extracted_abc for c in ['X:', 'K:', 'M:', 'L:'])
-    
-    # Step 2: Call LLM for validation
+
+    # Step 2: Well-formed score with an explicit task: no LLM call needed
+    if has_abc:
+        local_result = validate_locally(user_prompt, extracted_abc)
+        if local_result is not None:
+            validation_counts["local"] += 1
+            return local_result
+    validation_counts["llm"] += 1
+
+    # Step 3: Call LLM for validation
     validation_prompt = input_validator_prompt(user_prompt, extracted_abc, has_abc)
     
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": validation_prompt}],
-            temperature=0,
-            max_tokens=300
-        )
-        validation_result = response.choices[0].message.content.strip()
+        validation_result = llm.complete(validation_prompt, model_name, temperature=0, max_tokens=300)
         
         # Parse validation result
         if not has_abc:
             # Case 1: No ABC detected initially
-            if "NO_ABC_SCORE" in validation_result.upper():
-                return (False, "No ABC score detected in your input. Please include an ABC notation score and try again.", None)
-            elif "EXTRACTED_ABC:" in validation_result:
-                # LLM found ABC score, extract it
-                abc_match = re.search(r"EXTRACTED_ABC:\s*\n(.*?)(?=\n\n|\n[A-Z_]+:|$)", validation_result, re.S)
-                if abc_match:
-                    verified_abc = abc_match.group(1).strip()
-                    # Continue to check for question
-                    return validate_input_with_abc(user_prompt, verified_abc)
-                else:
-                    # Try to extract from the rest of the response
-                    lines = validation_result.split("EXTRACTED_ABC:")[1].strip().split("\n")
-                    verified_abc = "\n".join([l for l in lines if not l.strip().startswith(("NO_", "UNCLEAR", "VALID", "INCOMPLETE", "ISSUE"))]).strip()
-                    if verified_abc:
-                        return validate_input_with_abc(user_prompt, verified_abc)
-                    else:
-                        return (False, "Could not extract ABC score. Please format your input clearly with ABC notation.", None)
-            elif "UNCLEAR_INPUT" in validation_result.upper():
-                return (False, "Input is unclear. Please provide a clear ABC notation score and a question.", None)
-            else:
-                # LLM might have extracted ABC in a different format
-                return (False, "No ABC score detected. Please include an ABC notation score and try again.", None)
+            verified_abc, error_message = parse_extraction_result(validation_result)
+            if error_message:
+                return (False, error_message, None)
+            # Continue to check for question
+            return validate_input_with_abc(user_prompt, verified_abc)
         else:
             # Case 2: ABC extracted, verify completeness and check for question
             return validate_input_with_abc(user_prompt, extracted_abc, validation_result)
@@ -604,26 +948,42 @@ def validate_input(user_prompt):
         else:
             return (False, f"Input validation error: {str(e)}", None)
 
+@llm.stage("validator")
+async def validate_input_async(user_prompt):
+    """Async version of validate_input."""
+    extracted_abc = extract_abc_from_prompt(user_prompt)
+    has_abc = extracted_abc and len(extracted_abc) > 10 and any(c in extracted_abc for c in ['X:', 'K:', 'M:', 'L:'])
 
-def validate_input_with_abc(user_prompt, abc_score, validation_result=None):
-    """Validate input when ABC score is present."""
-    if validation_result is None:
-        # Need to call LLM to validate
-        validation_prompt = input_validator_prompt(user_prompt, abc_score, True)
-        try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": validation_prompt}],
-                temperature=0,
-                max_tokens=200
-            )
-            validation_result = response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"Error in ABC validation: {e}")
-            # Proceed with extracted ABC
-            return (True, None, abc_score)
-    
-    # Parse validation result
+    if has_abc:
+        local_result = validate_locally(user_prompt, extracted_abc)
+        if local_result is not None:
+            validation_counts["local"] += 1
+            return local_result
+    validation_counts["llm"] += 1
+
+    validation_prompt = input_validator_prompt(user_prompt, extracted_abc, has_abc)
+
+    try:
+        validation_result = await llm.complete_async(validation_prompt, model_name, temperature=0, max_tokens=300)
+
+        if not has_abc:
+            verified_abc, error_message = parse_extraction_result(validation_result)
+            if error_message:
+                return (False, error_message, None)
+            return await validate_input_with_abc_async(user_prompt, verified_abc)
+        else:
+            return await validate_input_with_abc_async(user_prompt, extracted_abc, validation_result)
+
+    except Exception as e:
+        print(f"Error in input validation: {e}")
+        if has_abc:
+            return (True, None, extracted_abc)
+        else:
+            return (False, f"Input validation error: {str(e)}", None)
+
+
+def parse_abc_validation(validation_result, abc_score):
+    """Parse the validator response when an ABC score is present."""
     validation_upper = validation_result.upper()
     
     if "VALID_INPUT" in validation_upper:
@@ -642,6 +1002,42 @@ def validate_input_with_abc(user_prompt, abc_score, validation_result=None):
         print(f"Warning: Unclear validation response, proceeding with extracted ABC")
         return (True, None, abc_score)
 
+@llm.stage("validator")
+def validate_input_with_abc(user_prompt, abc_score, validation_result=None):
+    """Validate input when ABC score is present."""
+    if validation_result is None:
+        # Score extracted by the LLM: check it locally before asking again
+        local_result = validate_locally(user_prompt, abc_score)
+        if local_result is not None:
+            return local_result
+        # Need to call LLM to validate
+        validation_prompt = input_validator_prompt(user_prompt, abc_score, True)
+        try:
+            validation_result = llm.complete(validation_prompt, model_name, temperature=0, max_tokens=200)
+        except Exception as e:
+            print(f"Error in ABC validation: {e}")
+            # Proceed with extracted ABC
+            return (True, None, abc_score)
+    
+    # Parse validation result
+    return parse_abc_validation(validation_result, abc_score)
+
+@llm.stage("validator")
+async def validate_input_with_abc_async(user_prompt, abc_score, validation_result=None):
+    """Async version of validate_input_with_abc."""
+    if validation_result is None:
+        local_result = validate_locally(user_prompt, abc_score)
+        if local_result is not None:
+            return local_result
+        validation_prompt = input_validator_prompt(user_prompt, abc_score, True)
+        try:
+            validation_result = await llm.complete_async(validation_prompt, model_name, temperature=0, max_tokens=200)
+        except Exception as e:
+            print(f"Error in ABC validation: {e}")
+            return (True, None, abc_score)
+
+    return parse_abc_validation(validation_result, abc_score)
+
 
 def controller_prompt(user_prompt):
     return f"""
@@ -672,21 +1068,16 @@ User prompt:
 """
 
 
-def agent_A_controller(user_prompt):
-    """
-    LLM-based controller that decides which agents to use.
-    """
-    decision = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": controller_prompt(user_prompt)}],
-        temperature=0
-    ).choices[0].message.content.strip()
+CONTROLLER_DECISIONS = ("ABC", "EMOTION", "BOTH", "NONE")
+
 
+def normalize_decision(decision):
+    """Normalize the controller response to ABC, EMOTION, BOTH or NONE."""
     # Normalize
     decision = decision.upper()
     
     # Ensure valid decision
-    if decision not in ("ABC", "EMOTION", "BOTH", "NONE"):
+    if decision not in CONTROLLER_DECISIONS:
         # Fallback: try to extract from response
         if "BOTH" in decision:
             decision = "BOTH"
@@ -699,17 +1090,93 @@ def agent_A_controller(user_prompt):
 
     return decision
 
+@llm.stage("controller")
+def agent_A_controller(user_prompt):
+    """
+    LLM-based controller that decides which agents to use.
+    """
+    decision = llm.complete(controller_prompt(user_prompt), model_name, temperature=0,
+                            **llm.guided(choices=CONTROLLER_DECISIONS))
 
-def split_tasks_for_agents(user_prompt):
+    return normalize_decision(decision)
+
+@llm.stage("controller")
+async def agent_A_controller_async(user_prompt):
+    """Async version of agent_A_controller."""
+    decision = await llm.complete_async(controller_prompt(user_prompt), model_name, temperature=0,
+                                        **llm.guided(choices=CONTROLLER_DECISIONS))
+    return normalize_decision(decision)
+
+
+# Fast-path router in front of the controller. The dataset prompts are
+# templated, so the task text alone decides the route for almost every sample;
+# the LLM controller is only asked when the keywords are missing or point both
+# ways. The score itself is left out of the match ("K:" headers, bar lines).
+
+use_router = True
+
+# Share of fast-path decisions that are also sent to the LLM controller to
+# measure the agreement rate (chosen by prompt hash, so reruns audit the same samples)
+router_audit_rate = 0.1
+
+EMOTION_KEYWORDS = re.compile(
+    r"\b(emotions?|emotional|mood|valence|arousal|feelings?|happy|angry|sad|relaxed|q[1-4])\b", re.I)
+ABC_KEYWORDS = re.compile(
+    r"\b(abc|notation|keys?|meter|metre|time signature|bars?|measures?|chords?|structure|"
+    r"rhythm|tempo|notes?|pitch(?:es)?|intervals?|durations?|errors?|sequence)\b", re.I)
+
+
+def route_by_rules(user_prompt):
     """
-    When decision is BOTH, split the prompt into ABC-related and Emotion-related tasks.
-    Uses LLM to intelligently extract relevant parts for each agent.
+    Keyword decision on the task text: ABC or EMOTION when exactly one group of
+    keywords matches, None when the LLM controller should decide.
     """
-    split_prompt = f"""
-You are a task splitter. Given a user prompt that contains both ABC notation questions and emotion classification questions, split it into two separate tasks.
+    abc_score = extract_abc_from_prompt(user_prompt)
+    task_text = user_prompt.replace(abc_score, " ") if abc_score != user_prompt.strip() else user_prompt
+    emotion = EMOTION_KEYWORDS.search(task_text) is not None
+    abc = ABC_KEYWORDS.search(task_text) is not None
+    if emotion and not abc:
+        return "EMOTION"
+    if abc and not emotion:
+        return "ABC"
+    return None
 
-Original prompt:
-{user_prompt}
+
+router_stats = DecisionStats("Controller router", "rules", "controller")
+
+
+def route_request(user_prompt):
+    """
+    Decide which agents to use: the keyword rules when they are unambiguous,
+    otherwise the LLM controller.
+    """
+    rule_decision = route_by_rules(user_prompt) if use_router else None
+    if rule_decision is None:
+        decision = agent_A_controller(user_prompt)
+        if use_router:
+            router_stats.record(None)
+        return decision
+    llm_decision = agent_A_controller(user_prompt) if should_audit(user_prompt, router_audit_rate) else None
+    router_stats.record(rule_decision, llm_decision)
+    return rule_decision
+
+
+async def route_request_async(user_prompt):
+    """Async version of route_request."""
+    rule_decision = route_by_rules(user_prompt) if use_router else None
+    if rule_decision is None:
+        decision = await agent_A_controller_async(user_prompt)
+        if use_router:
+            router_stats.record(None)
+        return decision
+    llm_decision = await agent_A_controller_async(user_prompt) if should_audit(user_prompt, router_audit_rate) else None
+    router_stats.record(rule_decision, llm_decision)
+    return rule_decision
+
+
+def task_splitter_prompt(user_prompt):
+    return f"""
+You are a task splitter. Given a user prompt that contains both ABC notation questions and emotion classification questions, split it into two separate tasks.
 
 Extract and format:
 1. ABC Task: The part of the prompt related to ABC notation, music structure, keys, meters, bars, chords, etc.
@@ -723,43 +1190,240 @@ EMOTION_TASK:
 [the emotion-related task here, including the ABC score if present]
 
 If the original prompt contains an ABC score, include it in BOTH tasks.
+
+Original prompt:
+{user_prompt}
 """
+
+def parse_split_tasks(split_text, user_prompt):
+    """Parse the task splitter response into (abc_task, emotion_task)."""
+    abc_task = None
+    emotion_task = None
+    
+    if "ABC_TASK:" in split_text:
+        parts = split_text.split("ABC_TASK:")
+        if len(parts) > 1:
+            remaining = parts[1]
+            if "EMOTION_TASK:" in remaining:
+                abc_task = remaining.split("EMOTION_TASK:")[0].strip()
+                emotion_task = remaining.split("EMOTION_TASK:")[1].strip()
+            else:
+                abc_task = remaining.strip()
+    
+    if not abc_task or not emotion_task:
+        # Fallback: use original prompt for both, but this shouldn't happen
+        abc_task = user_prompt
+        emotion_task = user_prompt
+    
+    return abc_task, emotion_task
+
+@llm.stage("splitter")
+def split_tasks_for_agents(user_prompt):
+    """
+    When decision is BOTH, split the prompt into ABC-related and Emotion-related tasks.
+    Uses LLM to intelligently extract relevant parts for each agent.
+    """
+    split_prompt = task_splitter_prompt(user_prompt)
     
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": split_prompt}],
-            temperature=0,
-            max_tokens=500
-        )
-        split_text = response.choices[0].message.content.strip()
+        split_text = llm.complete(split_prompt, model_name, temperature=0, max_tokens=500)
         
         # Parse the response
-        abc_task = None
-        emotion_task = None
-        
-        if "ABC_TASK:" in split_text:
-            parts = split_text.split("ABC_TASK:")
-            if len(parts) > 1:
-                remaining = parts[1]
-                if "EMOTION_TASK:" in remaining:
-                    abc_task = remaining.split("EMOTION_TASK:")[0].strip()
-                    emotion_task = remaining.split("EMOTION_TASK:")[1].strip()
-                else:
-                    abc_task = remaining.strip()
-        
-        if not abc_task or not emotion_task:
-            # Fallback: use original prompt for both, but this shouldn't happen
-            abc_task = user_prompt
-            emotion_task = user_prompt
-        
-        return abc_task, emotion_task
+        return parse_split_tasks(split_text, user_prompt)
         
     except Exception as e:
         print(f"Error splitting tasks: {e}")
         # Fallback: return original prompt for both
         return user_prompt, user_prompt
 
+@llm.stage("splitter")
+async def split_tasks_for_agents_async(user_prompt):
+    """Async version of split_tasks_for_agents."""
+    split_prompt = task_splitter_prompt(user_prompt)
+
+    try:
+        split_text = await llm.complete_async(split_prompt, model_name, temperature=0, max_tokens=500)
+        return parse_split_tasks(split_text, user_prompt)
+
+    except Exception as e:
+        print(f"Error splitting tasks: {e}")
+        return user_prompt, user_prompt
+
+# Fused planner: when the input cannot be validated or routed locally, one
+# JSON call does the validator, controller and splitter work instead of up to
+# four sequential calls. An answer that does not parse falls back to the
+# separate calls.
+
+use_planner = True
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "valid": {"type": "boolean"},
+        "problem": {"type": "string"},
+        "decision": {"type": "string", "enum": ["ABC", "EMOTION", "BOTH", "NONE"]},
+        "abc_task": {"type": "string"},
+        "emotion_task": {"type": "string"},
+    },
+    "required": ["valid", "problem", "decision", "abc_task", "emotion_task"],
+    "additionalProperties": False,
+}
+
+planner_counts = Counter()
+
+
+def planner_prompt(user_prompt):
+    return f"""
+You are the planning agent of a music analysis system. Read the user input and plan how to answer it.
+
+1. Validation: the input is valid if it contains a complete ABC notation score (headers such as X:, K:, M:, L:
+   followed by notes and bar lines) AND the user asks a question or gives a task about it.
+   If the input is not valid, set "valid" to false and describe what is missing in "problem"
+   (otherwise "problem" is "").
+
+2. Routing ("decision"):
+- ABC notation, music score structure, bars, keys, time signature, meter, chord symbols -> "ABC"
+- Emotion, emotional label, valence/arousal, mood, Q1/Q2/Q3/Q4, happy/angry/sad/relaxed -> "EMOTION"
+- Both topics -> "BOTH"
+- Neither -> "NONE"
+
+3. Sub-tasks: if the decision is "BOTH", write the ABC-related question in "abc_task" and the
+   emotion-related question in "emotion_task". Write only the question text: do NOT copy the ABC score,
+   it is added to each sub-task automatically. Otherwise both are "".
+
+Respond with ONLY a JSON object with the keys "valid", "problem", "decision", "abc_task" and "emotion_task".
+
+User input:
+{user_prompt}
+"""
+
+
+def needs_planner(user_prompt):
+    """True when validation or routing would need the LLM (the fused planner call is then cheaper)."""
+    if not use_planner:
+        return False
+    abc_score = extract_abc_from_prompt(user_prompt)
+    return validate_locally(user_prompt, abc_score) is None or not use_router or route_by_rules(user_prompt) is None
+
+
+def parse_plan(plan, user_prompt):
+    """
+    Turn the planner's JSON into (is_valid, error_message, verified_abc, decision, abc_task, emotion_task),
+    or None if the answer is not a usable plan.
+    """
+    if not isinstance(plan, dict) or not isinstance(plan.get("valid"), bool) or not isinstance(plan.get("decision"), str):
+        return None
+    extracted_abc = extract_abc_from_prompt(user_prompt)
+    local_result = validate_locally(user_prompt, extracted_abc)
+    if local_result is not None:
+        # A locally verified score stays valid whatever the planner says
+        is_valid, error_message, verified_abc = local_result
+    else:
+        # The planner does not copy the score (that would be slow and get truncated); it comes from the prompt
+        has_abc = extracted_abc and len(extracted_abc) > 10 and any(c in extracted_abc for c in ['X:', 'K:', 'M:', 'L:'])
+        verified_abc = extracted_abc if has_abc else None
+        is_valid = plan["valid"] and verified_abc is not None
+        problem = str(plan.get("problem") or "").strip()
+        if is_valid:
+            error_message = None
+        elif verified_abc is None:
+            error_message = "No ABC score detected in your input. Please include an ABC notation score and try again."
+        else:
+            error_message = f"Input issue detected: {problem or 'the input could not be validated'}"
+
+    decision = normalize_decision(plan["decision"])
+    abc_task = emotion_task = None
+    if decision == "BOTH":
+        abc_task = str(plan.get("abc_task") or "").strip() or user_prompt
+        emotion_task = str(plan.get("emotion_task") or "").strip() or user_prompt
+        # The sub-tasks hold only the questions; each agent needs the score itself
+        if verified_abc:
+            abc_task, emotion_task = (task if verified_abc in task else f"Input:\n{verified_abc}\n\nTask:\n{task}"
+                                      for task in (abc_task, emotion_task))
+    return is_valid, error_message, verified_abc, decision, abc_task, emotion_task
+
+
+def record_plan(plan):
+    planner_counts["fused" if plan is not None else "fallback"] += 1
+    if plan is not None:
+        validation_counts["llm"] += 1
+        if use_router:
+            router_stats.record(None)
+
+
+@llm.stage("planner")
+def plan_request(user_prompt):
+    """
+    One planning call: (is_valid, error_message, verified_abc, decision, abc_task, emotion_task),
+    or None when the separate validator / controller / splitter calls have to be used.
+    """
+    try:
+        plan = llm.complete_json(planner_prompt(user_prompt), model_name, PLAN_SCHEMA, name="plan",
+                                 temperature=0, max_tokens=400)
+    except Exception as e:
+        print(f"Error in planner: {e}")
+        plan = None
+    plan = parse_plan(plan, user_prompt)
+    record_plan(plan)
+    return plan
+
+
+@llm.stage("planner")
+async def plan_request_async(user_prompt):
+    """Async version of plan_request."""
+    try:
+        plan = await llm.complete_json_async(planner_prompt(user_prompt), model_name, PLAN_SCHEMA, name="plan",
+                                             temperature=0, max_tokens=400)
+    except Exception as e:
+        print(f"Error in planner: {e}")
+        plan = None
+    plan = parse_plan(plan, user_prompt)
+    record_plan(plan)
+    return plan
+
+
+def planner_report():
+    fused = planner_counts["fused"]
+    return (f"Planner: {fused} inputs planned with one fused call, "
+            f"{planner_counts['fallback']} fell back to separate validator / controller / splitter calls")
+
+
+def run_both_agents(abc_task, emotion_task):
+    """
+    Run agent B and agent C at the same time (they are independent).
+    Returns (answer_B, answer_C, timings) with the seconds each branch took and the total.
+    """
+    def timed(agent, task):
+        start = time.perf_counter()
+        answer = agent(task)
+        return answer, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # Each branch runs in a copy of this context so its spans stay under this sample
+        future_B = pool.submit(contextvars.copy_context().run, timed, agent_B_abc_system, abc_task)
+        future_C = pool.submit(contextvars.copy_context().run, timed, agent_C_emotion_system, emotion_task)
+        answer_B, seconds_B = future_B.result()
+        answer_C, seconds_C = future_C.result()
+    return answer_B, answer_C, {"ABC": seconds_B, "Emotion": seconds_C, "total": time.perf_counter() - start}
+
+
+async def run_both_agents_async(abc_task, emotion_task):
+    """Async version of run_both_agents."""
+    async def timed(agent, task):
+        start = time.perf_counter()
+        answer = await agent(task)
+        return answer, time.perf_counter() - start
+
+    start = time.perf_counter()
+    (answer_B, seconds_B), (answer_C, seconds_C) = await asyncio.gather(
+        timed(agent_B_abc_system_async, abc_task),
+        timed(agent_C_emotion_system_async, emotion_task)
+    )
+    return answer_B, answer_C, {"ABC": seconds_B, "Emotion": seconds_C, "total": time.perf_counter() - start}
+
+
+@llm.span("aggregator")
 def agent_D_aggregator(answer_B=None, answer_C=None):
     text = ""
 
@@ -775,14 +1439,27 @@ def agent_D_aggregator(answer_B=None, answer_C=None):
     return text
 
 
+def describe_timings(timings):
+    """Branch timings of a BOTH request, kept out of the answer text ("" for other requests)."""
+    if not timings:
+        return ""
+    return (f"ABC branch {timings['ABC']:.1f}s, Emotion branch {timings['Emotion']:.1f}s "
+            f"(run in parallel: {timings['total']:.1f}s in total)")
+
+
 def run_agent_system(user_prompt):
     """
     Main entry point for the multi-agent system.
     First validates input, then routes to appropriate agents.
     """
-    # Step 0: Validate input (check ABC score and question)
-    print("Validating input...")
-    is_valid, error_message, verified_abc = validate_input(user_prompt)
+    # Inputs that cannot be validated and routed locally: one fused planning call
+    plan = plan_request(user_prompt) if needs_planner(user_prompt) else None
+    if plan is not None:
+        is_valid, error_message, verified_abc, decision, abc_task, emotion_task = plan
+    else:
+        # Step 0: Validate input (check ABC score and question)
+        print("Validating input...")
+        is_valid, error_message, verified_abc = validate_input(user_prompt)
     
     if not is_valid:
         return f"❌ Input Validation Error:\n{error_message}\n\nPlease correct your input and try again."
@@ -790,8 +1467,9 @@ def run_agent_system(user_prompt):
     if verified_abc:
         print(f"✓ ABC score validated ({len(verified_abc)} characters)")
     
-    # Step 1: Controller decides which agents to use
-    decision = agent_A_controller(user_prompt)
+    # Step 1: Router (or the controller, for unclear prompts) decides which agents to use
+    if plan is None:
+        decision = route_request(user_prompt)
     print("Controller decision:", decision)
 
     answer_B = None
@@ -799,14 +1477,15 @@ def run_agent_system(user_prompt):
 
     if decision == "BOTH":
         # Split the task into ABC-related and Emotion-related parts
-        print("Splitting task for both agents...")
-        abc_task, emotion_task = split_tasks_for_agents(user_prompt)
+        if plan is None:
+            print("Splitting task for both agents...")
+            abc_task, emotion_task = split_tasks_for_agents(user_prompt)
         print(f"ABC Task: {abc_task[:100]}...")
         print(f"Emotion Task: {emotion_task[:100]}...")
         
-        # Give each agent their specific task
-        answer_B = agent_B_abc_system(abc_task)
-        answer_C = agent_C_emotion_system(emotion_task)
+        # Give each agent their specific task; the two branches run in parallel
+        answer_B, answer_C, timings = run_both_agents(abc_task, emotion_task)
+        print(f"⏱ {describe_timings(timings)}")
         
     elif decision == "ABC":
         answer_B = agent_B_abc_system(user_prompt)
@@ -820,14 +1499,104 @@ def run_agent_system(user_prompt):
     return final_answer
 
 
+async def run_agent_system_async(user_prompt, timings=None):
+    """
+    Async version of run_agent_system, used by the concurrent batch driver.
+    Progress printing is left to the caller since many samples run at once;
+    the branch timings of a BOTH request are added to the timings dict if given.
+    """
+    plan = await plan_request_async(user_prompt) if needs_planner(user_prompt) else None
+    if plan is not None:
+        is_valid, error_message, verified_abc, decision, abc_task, emotion_task = plan
+    else:
+        is_valid, error_message, verified_abc = await validate_input_async(user_prompt)
+
+    if not is_valid:
+        return f"❌ Input Validation Error:\n{error_message}\n\nPlease correct your input and try again."
+
+    if plan is None:
+        decision = await route_request_async(user_prompt)
+
+    answer_B = None
+    answer_C = None
+
+    if decision == "BOTH":
+        if plan is None:
+            abc_task, emotion_task = await split_tasks_for_agents_async(user_prompt)
+        answer_B, answer_C, branch_timings = await run_both_agents_async(abc_task, emotion_task)
+        if timings is not None:
+            timings.update(branch_timings)
+
+    elif decision == "ABC":
+        answer_B = await agent_B_abc_system_async(user_prompt)
+
+    elif decision == "EMOTION":
+        answer_C = await agent_C_emotion_system_async(user_prompt)
+
+    return agent_D_aggregator(answer_B, answer_C)
+
+
+async def run_batch_async(prompts, concurrency=8, timings=None):
+    """
+    Run the agent pipeline over many prompts at once.
+    At most `concurrency` samples are in flight; answers are returned in input order.
+    If timings is a list, timings[i] is set to the branch timings dict of prompt i ({} unless BOTH).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(prompts)
+
+    async def process_sample(i, user_prompt):
+        sample_timings = {}
+        if timings is not None:
+            timings[i] = sample_timings
+        async with semaphore:
+            try:
+                with llm.trace_sample(i):
+                    answer = await run_agent_system_async(user_prompt, sample_timings)
+                print(f"[{i+1}/{len(prompts)}] Answer: {answer[:100]}...")
+            except Exception as e:
+                print(f"Error processing sample {i+1}: {e}")
+                answer = f"Error: {str(e)}"
+        results[i] = answer
+
+    await asyncio.gather(*(process_sample(i, p) for i, p in enumerate(prompts)))
+    return results
+
+
 # Main program entry point
 if __name__ == "__main__":
+    import argparse
     import sys
+
+    parser = argparse.ArgumentParser(description="Multi-Agent System for Symbolic Music Understanding")
+    parser.add_argument("csv_path", nargs="?", help="CSV file with a 'prompt' column (batch mode); omit for interactive mode")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of samples processed concurrently in batch mode")
+    parser.add_argument("--llm-validation", action="store_true",
+                        help="Always validate the input with the LLM instead of the local structural check")
+    parser.add_argument("--analysts", type=int, default=num_analysts,
+                        help="Analysts per arousal / valence vote (LLM_VOTE picks the early-stopping rule)")
+    parser.add_argument("--combiner", action="store_true",
+                        help="Always ask the LLM combiner instead of mapping decided arousal / valence votes to a label")
+    parser.add_argument("--combiner-audit", type=float, default=combiner_audit_rate,
+                        help="Share of mapped labels also checked against the LLM combiner (0-1)")
+    parser.add_argument("--no-planner", action="store_true",
+                        help="Use separate validator / controller / splitter calls instead of one fused planning call")
+    parser.add_argument("--no-router", action="store_true", help="Always ask the LLM controller instead of the keyword router")
+    parser.add_argument("--router-audit", type=float, default=router_audit_rate,
+                        help="Share of router decisions also checked against the LLM controller (0-1)")
+    args = parser.parse_args()
+    use_local_validator = not args.llm_validation
+    use_router = not args.no_router
+    use_planner = not args.no_planner
+    num_analysts = max(1, args.analysts)
+    use_quadrant_mapping = not args.combiner
+    combiner_audit_rate = args.combiner_audit
+    router_audit_rate = args.router_audit
     
     # Check if running in batch mode (with CSV file) or interactive mode
-    if len(sys.argv) > 1:
+    if args.csv_path:
         # Batch mode: process CSV file
-        csv_path = sys.argv[1]
+        csv_path = args.csv_path
         print(f"Processing CSV file: {csv_path}")
         
         df = pd.read_csv(csv_path)
@@ -837,24 +1606,25 @@ if __name__ == "__main__":
             print("Error: CSV file must have a 'prompt' column")
             sys.exit(1)
         
-        results = []
-        for i, row in df.iterrows():
-            print(f"\nProcessing sample {i+1}/{len(df)}...")
-            user_prompt = row["prompt"]
-            
-            try:
-                answer = run_agent_system(user_prompt)
-                results.append(answer)
-                print(f"Answer: {answer[:100]}...")  # Print first 100 chars
-            except Exception as e:
-                print(f"Error processing sample {i+1}: {e}")
-                results.append(f"Error: {str(e)}")
+        print(f"Running {len(df)} samples with concurrency {args.concurrency}")
+        branch_timings = [None] * len(df)
+        results = asyncio.run(run_batch_async(df["prompt"].tolist(), concurrency=max(1, args.concurrency),
+                                              timings=branch_timings))
         
-        # Save results
+        # Save results (branch timings of BOTH requests in their own column, not in the answer)
         df["agent_answer"] = results
+        df["branch_timings"] = [describe_timings(t) for t in branch_timings]
         output_path = csv_path.replace(".csv", "_multi_agent_results.csv")
         df.to_csv(output_path, index=False)
         print(f"\nResults saved to: {output_path}")
+        print(get_analysis_store().report())
+        print(validation_report())
+        if planner_counts:
+            print(planner_report())
+        if use_router:
+            print(router_stats.report())
+        if use_quadrant_mapping:
+            print(combiner_stats.report())
         
     else:
         # Interactive mode
@@ -864,6 +1634,7 @@ if __name__ == "__main__":
         print("\nEnter your question about ABC notation or emotion classification.")
         print("Type 'quit' or 'exit' to stop.\n")
         
+        sample_id = 0
         while True:
             user_input = input("You: ").strip()
             
@@ -875,7 +1646,9 @@ if __name__ == "__main__":
                 continue
             
             try:
-                answer = run_agent_system(user_input)
+                with llm.trace_sample(sample_id):
+                    answer = run_agent_system(user_input)
+                sample_id += 1
                 print(f"\nSystem: {answer}\n")
             except Exception as e:
                 print(f"\nError: {e}\n")
@@ -1,18 +1,15 @@
-from openai import OpenAI, APIConnectionError, APITimeoutError
-from inference_auth_token import get_access_token
+import contextvars
+import llm_client as llm
+from llm_voting import run_vote
 import pandas as pd
 import re
 import sys
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 #model_name = "google/gemma-3-27b-it"
 model_name = "meta-llama/Meta-Llama-3.1-70B-Instruct"
 
-client = OpenAI(
-    api_key=get_access_token(),
-    base_url="https://inference-api.alcf.anl.gov/resource_server/sophia/vllm/v1"
-)
-
 # Emotion recognition system components
 category_text = """Categories:
 0: Q1 (happy   - high valence, high arousal)
@@ -21,24 +18,10 @@ category_text = """Categories:
 3: Q4 (relaxed - high valence, low  arousal)
 """
 
-def call_llm(prompt, max_tokens=128, temperature=0.5):
+def call_llm(prompt, max_tokens=128, temperature=0.5, **params):
     """Helper function to call LLM."""
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stop=["\n"] if max_tokens <= 8 else None
-        )
-        content = response.choices[0].message.content
-        if content is None:
-            print(f"Warning: LLM returned None content")
-            return ""
-        return content.strip()
-    except Exception as e:
-        print(f"Error calling LLM: {e}")
-        return ""
+    return llm.call_llm(prompt, model_name, temperature=temperature, max_tokens=max_tokens,
+                        stop=["\n"] if max_tokens <= 8 else None, **params)
 
 def extract_abc_from_prompt(user_prompt):
     """Extract ABC score from user prompt."""
@@ -90,6 +73,7 @@ def extract_abc_from_prompt(user_prompt):
     # Last fallback: return the whole prompt if no pattern matches
     return user_prompt.strip()
 
+@llm.stage("validator")
 def validate_input_simple(user_prompt):
     """
     Simplified input validation for emotion classification only.
@@ -105,15 +89,12 @@ def validate_input_simple(user_prompt):
 
 Your task is to check if the user input contains an ABC notation score.
 
-User input:
-{user_prompt}
-
 ABC notation typically:
 - Starts with headers like X:, K:, M:, L:, R:
 - Contains musical notes (A-G with optional sharps/flats and octaves)
 - May be wrapped in code blocks (```) or after "Input:" or "Score:"
 
-Please analyze the user input and:
+Please analyze the user input below and:
 1. If you find ABC notation, extract it completely and respond with:
    EXTRACTED_ABC:
    [the complete ABC score here]
@@ -121,16 +102,13 @@ Please analyze the user input and:
 2. If you confirm there is NO ABC notation, respond with:
    NO_ABC_SCORE
 
+User input:
+{user_prompt}
+
 Your response:"""
         
         try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "user", "content": validation_prompt}],
-                temperature=0,
-                max_tokens=300
-            )
-            validation_result = response.choices[0].message.content.strip()
+            validation_result = llm.complete(validation_prompt, model_name, temperature=0, max_tokens=300)
             
             if "NO_ABC_SCORE" in validation_result.upper():
                 return (False, "No ABC score detected in your input. Please include an ABC notation score and try again.", None)
@@ -154,9 +132,16 @@ Your response:"""
     
     return (True, None, extracted_abc if has_abc else None)
 
+# The arousal, valence and combiner prompts all start with the same header and
+# the score, followed by the role's instructions: the prefix cache then reuses
+# the score's KV blocks for every call about that score, not just the header.
+emotion_score_header = "Musical score (ABC notation):\n"
+
 def build_arousal_classifier_prompt(abc_score):
     """Build prompt for arousal classifier (HIGH or LOW)."""
-    prompt = f"""Arousal classification:
+    prompt = f"""{emotion_score_header}{abc_score}
+
+Arousal classification:
 - HIGH arousal: energetic, intense, driving
 - LOW arousal: calm, peaceful, relaxed
 
@@ -164,14 +149,14 @@ Output format:
 AROUSAL: <HIGH or LOW>
 REASON: <brief explanation>
 
-{abc_score}
-
 AROUSAL:"""
     return prompt
 
 def build_valence_classifier_prompt(abc_score):
     """Build prompt for valence classifier (HIGH or LOW)."""
-    prompt = f"""Valence classification:
+    prompt = f"""{emotion_score_header}{abc_score}
+
+Valence classification:
 - HIGH valence: pleasant, bright, joyful
 - LOW valence: unpleasant, dark, sad
 
@@ -179,23 +164,20 @@ Output format:
 VALENCE: <HIGH or LOW>
 REASON: <brief explanation>
 
-{abc_score}
-
 VALENCE:"""
     return prompt
 
 def build_emotion_combiner_prompt(abc_score, arousal_result, valence_result):
     """Build prompt for combining arousal and valence into final emotion category."""
-    prompt = f"""{category_text}
+    prompt = f"""{emotion_score_header}{abc_score}
 
+{category_text}
 Mapping:
 - High Valence + High Arousal → Label 0
 - Low Valence + High Arousal → Label 1
 - Low Valence + Low Arousal → Label 2
 - High Valence + Low Arousal → Label 3
 
-{abc_score}
-
 Arousal: {arousal_result}
 Valence: {valence_result}
 
@@ -224,6 +206,10 @@ def extract_arousal(text: str) -> str:
                 return "HIGH"
             elif "LOW" in arousal_line[0].upper():
                 return "LOW"
+    # The prompt ends with "AROUSAL:", so the answer usually starts with the level itself
+    first_word = text_upper.split()[0].strip("*.,:") if text_upper.split() else ""
+    if first_word in ("HIGH", "LOW"):
+        return first_word
     # Fallback: search for HIGH or LOW
     if "HIGH" in text_upper and "AROUSAL" in text_upper:
         return "HIGH"
@@ -243,6 +229,10 @@ def extract_valence(text: str) -> str:
                 return "HIGH"
             elif "LOW" in valence_line[0].upper():
                 return "LOW"
+    # The prompt ends with "VALENCE:", so the answer usually starts with the level itself
+    first_word = text_upper.split()[0].strip("*.,:") if text_upper.split() else ""
+    if first_word in ("HIGH", "LOW"):
+        return first_word
     # Fallback: search for HIGH or LOW
     if "HIGH" in text_upper and "VALENCE" in text_upper:
         return "HIGH"
@@ -250,6 +240,19 @@ def extract_valence(text: str) -> str:
         return "LOW"
     return ""
 
+# Guided decoding (LLM_GUIDED=1): the level, then the reason on one line
+ANALYST_ANSWER_REGEX = r"(HIGH|LOW)\nREASON: [^\n]{1,400}"
+EMOTION_LABELS = ("0", "1", "2", "3")
+
+def call_analysts(prompt, num_analysts):
+    """
+    Get num_analysts answers to the same analyst prompt.
+    Uses one n-sample request when supported, otherwise parallel separate requests.
+    """
+    return llm.sample(prompt, model_name, num_analysts, max_tokens=128, temperature=0.4,
+                      **llm.guided(regex=ANALYST_ANSWER_REGEX))
+
+@llm.stage("arousal_analysts")
 def classify_arousal(abc_score, num_analysts=3):
     """
     Classify arousal level (HIGH or LOW) using multiple analysts.
@@ -259,10 +262,12 @@ def classify_arousal(abc_score, num_analysts=3):
     arousal_reasons = []
     
     print("  Classifying arousal level...")
-    for k in range(num_analysts):
-        prompt = build_arousal_classifier_prompt(abc_score)
-        answer = call_llm(prompt, max_tokens=128, temperature=0.4)
-        
+    # Analysts are independent, so each round queries them in parallel; the
+    # vote stops as soon as further analysts cannot change the outcome
+    prompt = build_arousal_classifier_prompt(abc_score)
+    answers = run_vote(lambda k: call_analysts(prompt, k), extract_arousal, num_analysts)
+    
+    for k, answer in enumerate(answers):
         arousal = extract_arousal(answer)
         reason = extract_reason(answer)
         
@@ -282,6 +287,7 @@ def classify_arousal(abc_score, num_analysts=3):
     
     return final_arousal, combined_reason
 
+@llm.stage("valence_analysts")
 def classify_valence(abc_score, num_analysts=3):
     """
     Classify valence level (HIGH or LOW) using multiple analysts.
@@ -291,10 +297,12 @@ def classify_valence(abc_score, num_analysts=3):
     valence_reasons = []
     
     print("  Classifying valence level...")
-    for k in range(num_analysts):
-        prompt = build_valence_classifier_prompt(abc_score)
-        answer = call_llm(prompt, max_tokens=128, temperature=0.4)
-        
+    # Analysts are independent, so each round queries them in parallel; the
+    # vote stops as soon as further analysts cannot change the outcome
+    prompt = build_valence_classifier_prompt(abc_score)
+    answers = run_vote(lambda k: call_analysts(prompt, k), extract_valence, num_analysts)
+    
+    for k, answer in enumerate(answers):
         valence = extract_valence(answer)
         reason = extract_reason(answer)
         
@@ -333,11 +341,13 @@ def emotion_classification_system(user_prompt):
     
     num_analysts = 3
     
-    # Step 1: Classify arousal (HIGH or LOW)
-    arousal_level, arousal_reason = classify_arousal(abc_score, num_analysts)
-    
-    # Step 2: Classify valence (HIGH or LOW)
-    valence_level, valence_reason = classify_valence(abc_score, num_analysts)
+    # Step 1 + 2: Classify arousal and valence (HIGH or LOW) in parallel
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # Run each branch in a copy of this context so its spans stay under this sample
+        arousal_future = pool.submit(contextvars.copy_context().run, classify_arousal, abc_score, num_analysts)
+        valence_future = pool.submit(contextvars.copy_context().run, classify_valence, abc_score, num_analysts)
+        arousal_level, arousal_reason = arousal_future.result()
+        valence_level, valence_reason = valence_future.result()
     
     # Step 3: Combine arousal and valence to get final emotion category
     print("  Combining arousal and valence...")
@@ -345,7 +355,8 @@ def emotion_classification_system(user_prompt):
     valence_result = f"Valence: {valence_level}\nReason: {valence_reason}"
     
     combiner_prompt = build_emotion_combiner_prompt(abc_score, arousal_result, valence_result)
-    combiner_answer = call_llm(combiner_prompt, max_tokens=4, temperature=0.0)
+    with llm.stage("combiner"):
+        combiner_answer = call_llm(combiner_prompt, max_tokens=4, temperature=0.0, **llm.guided(choices=EMOTION_LABELS))
     
     # Extract final label
     final_label_match = re.search(r'\b([0-3])\b', combiner_answer)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The scripts import each other as top-level modules and read their LLM
+# settings at import time, so the repo root and the offline settings must be
+# in place before any test module is collected.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ["LLM_CACHE"] = "0"
+os.environ["LLM_TELEMETRY"] = "0"
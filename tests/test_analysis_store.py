@@ -0,0 +1,121 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import llm_cache
+from llm_cache import AnalysisStore, ResponseCache, normalize_score
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(path=str(tmp_path / "responses.sqlite"))
+
+
+def test_normalize_score_ignores_line_endings_and_blank_lines():
+    assert normalize_score("X:1\r\n  K:C  \r\n\r\nCDEF|\r") == "X:1\nK:C\nCDEF|"
+    assert normalize_score("X:1\nK:C") == normalize_score("\nX:1\r\n\nK:C\n")
+
+
+def test_key_depends_on_score_and_model(cache):
+    store = AnalysisStore(cache)
+    assert store.key("X:1\nK:C", "m") == store.key("X:1\r\n\nK:C ", "m")
+    assert store.key("X:1\nK:C", "m") != store.key("X:1\nK:C", "other")
+    assert store.key("X:1\nK:C", "m") != store.key("X:1\nK:G", "m")
+
+
+def test_analysis_is_produced_once_and_persisted(cache):
+    produced = []
+
+    def produce(score):
+        produced.append(score)
+        return f"analysis of {score}"
+
+    store = AnalysisStore(cache)
+    assert store.get_or_create("X:1\nK:C", "m", produce) == "analysis of X:1\nK:C"
+    assert store.get_or_create("X:1\r\nK:C\n", "m", produce) == "analysis of X:1\nK:C"
+    assert (store.generated, store.reused) == (1, 1)
+    assert not store._key_locks
+
+    rerun = AnalysisStore(ResponseCache(path=cache.path))
+    assert rerun.get_or_create("X:1\nK:C", "m", produce) == "analysis of X:1\nK:C"
+    assert len(produced) == 1
+
+
+def test_empty_analysis_is_not_stored(cache):
+    store = AnalysisStore(cache)
+    assert store.get_or_create("X:1", "m", lambda score: "") == ""
+    assert store.get_or_create("X:1", "m", lambda score: "retry") == "retry"
+    assert store.generated == 2
+
+
+def test_concurrent_requests_share_one_analysis(cache):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def produce(score):
+        calls.append(score)
+        started.set()
+        release.wait(5)
+        return "analysis"
+
+    store = AnalysisStore(cache)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_create("X:1", "m", produce)))
+               for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["analysis"] * 4
+    assert len(calls) == 1
+
+
+def test_async_requests_share_one_analysis(cache):
+    calls = []
+
+    async def produce(score):
+        calls.append(score)
+        await asyncio.sleep(0.01)
+        return "analysis"
+
+    store = AnalysisStore(cache)
+
+    async def run():
+        return await asyncio.gather(*(store.aget_or_create("X:1", "m", produce) for _ in range(4)))
+
+    assert asyncio.run(run()) == ["analysis"] * 4
+    assert len(calls) == 1
+    assert not store._async_locks
+
+
+def test_evict_keeps_most_recently_used_analyses(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    cache.max_age_seconds = float("inf")
+    store = AnalysisStore(cache, max_entries=2)
+    for score in ("A", "B", "C"):
+        now[0] += 1
+        store.get_or_create(score, "m", str.lower)
+    now[0] += 1
+    AnalysisStore(cache, max_entries=10)._lookup(store.key("A", "m"))
+    assert store.evict() == 1
+    rerun = AnalysisStore(ResponseCache(path=cache.path), max_entries=2)
+    assert rerun._lookup(store.key("A", "m")) == "a"
+    assert rerun._lookup(store.key("B", "m")) is None
+    assert "1 evicted" in store.report()
+
+
+def test_old_analyses_table_gets_last_used_column(cache):
+    conn = sqlite3.connect(cache.path)
+    conn.execute("CREATE TABLE analyses (key TEXT PRIMARY KEY, model TEXT, analysis TEXT NOT NULL, created_at REAL NOT NULL)")
+    conn.commit()
+    conn.close()
+    AnalysisStore(cache)
+    columns = [row[1] for row in cache._conn().execute("PRAGMA table_info(analyses)")]
+    assert "last_used" in columns
@@ -0,0 +1,62 @@
+import pytest
+
+import llm_client as llm
+from bar_counts import extract_bar_count, stated_bar_count
+
+
+@pytest.fixture
+def answer(monkeypatch):
+    """Set the fake backend's answer; complete_until streams it word by word."""
+    monkeypatch.setattr(llm, "STREAM_EARLY_STOP", True)
+    yield lambda text: llm.set_fake_responder(lambda request: text)
+    llm.set_fake_responder(None)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("2. C major", "2"),
+    ("**2**. C major", "2"),
+    ("Answer: 1\nbecause", "1"),
+    ("4/4 time, 16 bars", ""),
+    ("2.5 beats per bar", ""),
+    ("3 beats per bar, so the answer is 1.", ""),
+    ("2", ""),
+])
+def test_leading_number_needs_a_delimiter(text, expected):
+    assert llm.leading_number(text) == expected
+
+
+@pytest.mark.parametrize("text", ["2.5 beats per bar, so option 1.", "3 beats per bar, so the answer is 1."])
+def test_option_baseline_stream_is_not_cut_at_a_bare_number(answer, text):
+    answer(text)
+    streamed, saving = llm.complete_until("Which option?", "m", llm.leading_number, max_tokens=50)
+    assert streamed == text and not saving.stopped_early
+
+
+def test_option_baseline_stream_stops_after_the_option(answer):
+    answer("2. C major, because the key signature has no accidentals")
+    streamed, saving = llm.complete_until("Which option?", "m", llm.leading_number, max_tokens=50)
+    assert streamed == "2. C" and saving.stopped_early
+
+
+@pytest.mark.parametrize("text, count", [
+    ("4/4 time, 16 bars in total", "16"),
+    ("16 bars", "16"),
+    ("There are 12 bars; the repeat makes it 24 bars", "12"),
+])
+def test_bar_count_stream_gives_the_full_answer_count(answer, text, count):
+    answer(text)
+    streamed, _ = llm.complete_until("How many bars?", "m", stated_bar_count, max_tokens=50)
+    assert extract_bar_count(streamed) == extract_bar_count(text) == count
+
+
+def test_bar_count_without_stated_bars_is_read_to_the_end(answer):
+    answer("The count is 8.")
+    streamed, saving = llm.complete_until("How many bars?", "m", stated_bar_count, max_tokens=50)
+    assert streamed == "The count is 8." and not saving.stopped_early
+    assert extract_bar_count(streamed) == "8"
+
+
+def test_stated_bar_count():
+    assert stated_bar_count("4/4 time, 16 bars") == "16"
+    assert stated_bar_count("4/4 time, 16 ba") == ""
+    assert stated_bar_count("4/4 time") == ""
@@ -0,0 +1,77 @@
+import os
+import runpy
+import sys
+
+import openai
+import pandas as pd
+import pytest
+
+import llm_client as llm
+from llm_scheduler import RetriesExhaustedError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = 3
+
+
+class BadRequest:
+    status_code = 400
+    headers = {}
+    request = None
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run a script in tmp_path on the first samples of the emotion dataset (results CSVs stay out of the repo)."""
+    (tmp_path / "data").mkdir()
+    source = os.path.join(ROOT, "data", "Emotion_Recognition_cleaned.csv")
+    pd.read_csv(source).head(SAMPLES).to_csv(tmp_path / "data" / "Emotion_Recognition_cleaned.csv", index=False)
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    llm.set_fake_responder(None)
+
+
+@pytest.mark.parametrize("script", ["emotion_recognition_agent.py", "emotion_recognition_agent_2.py"])
+def test_failed_judge_keeps_result_columns_aligned(workdir, monkeypatch, capsys, script):
+    judge_calls = []
+
+    def responder(request):
+        if "meta-judge" in request["messages"][-1]["content"]:
+            judge_calls.append(1)
+            if len(judge_calls) == 2:
+                raise RetriesExhaustedError(7, "judge unavailable")
+        return "REASON: bright and fast\nLABEL: 1"
+
+    llm.set_fake_responder(responder)
+    monkeypatch.setattr(sys, "argv", [script, f"--{SAMPLES}"])
+    runpy.run_path(os.path.join(ROOT, script), run_name="__main__")
+
+    assert "Error at sample 1" in capsys.readouterr().out
+    results = pd.read_csv(workdir / "emotion_recognition_agent_results.csv", dtype=str, keep_default_na=False)
+    assert len(results) == SAMPLES
+    # The failed sample is empty in every column, the others keep their predictions
+    failed = results.iloc[1]
+    assert (failed["prediction_single"], failed["prediction_majority"], failed["prediction_agent"]) == ("", "", "")
+    assert failed["raw_analyst_answers"] == "[]" and failed["raw_judge_answer"] == ""
+    assert list(results["prediction_agent"]) == ["1", "", "1"]
+
+
+def test_compare_counts_sent_requests_and_asks_unguided_logprobs(workdir, monkeypatch, capsys):
+    monkeypatch.setattr(llm, "use_n_sampling", True)
+    monkeypatch.setattr(llm, "use_guided_decoding", True)
+    logprob_requests = []
+
+    def responder(request):
+        if (request.get("n") or 1) > 1:
+            raise openai.BadRequestError("'n' must be 1", response=BadRequest(), body={"param": "n"})
+        if request.get("logprobs"):
+            logprob_requests.append(request)
+        return "REASON: bright and fast\nLABEL: 1"
+
+    llm.set_fake_responder(responder)
+    monkeypatch.setattr(sys, "argv", ["emotion_recognition_agent_2.py", "--compare", f"--{SAMPLES}"])
+    runpy.run_path(os.path.join(ROOT, "emotion_recognition_agent_2.py"), run_name="__main__")
+
+    assert len(logprob_requests) == SAMPLES
+    assert not any(llm._is_guided(request) for request in logprob_requests)
+    # The rejected n=3 request, then 3 analysts and the judge per sample
+    assert f"voting pipeline {(1 + SAMPLES * 4) / SAMPLES:.2f}" in capsys.readouterr().out
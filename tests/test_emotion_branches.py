@@ -0,0 +1,35 @@
+import pytest
+
+import llm_client as llm
+import llm_tracing as tracing
+import multi_agent_test_emotion as emotion
+from llm_tracing import Tracer
+
+PROMPT = """Input:
+X:1
+M:4/4
+L:1/8
+K:C
+CDEF GABc|
+
+Task:
+Choose the most probable emotional label of the provided score.
+"""
+
+
+@pytest.fixture
+def tracer(monkeypatch, tmp_path):
+    tracer = Tracer(path=str(tmp_path / "trace-{run}.json"), enabled=True)
+    monkeypatch.setattr(tracing, "_tracer", tracer)
+    yield tracer
+    llm.set_fake_responder(None)
+
+
+def test_parallel_branches_stay_under_the_sample(tracer):
+    llm.set_fake_responder(lambda request: "HIGH")
+    with tracing.trace_sample(0):
+        emotion.emotion_classification_system(PROMPT)
+    spans = {s.name: s for s in tracer.spans}
+    assert spans["arousal_analysts"].parent_id == spans["sample"].span_id
+    assert spans["valence_analysts"].parent_id == spans["sample"].span_id
+    assert {s.sample for s in tracer.spans} == {0}
@@ -0,0 +1,35 @@
+import pytest
+
+from emotion_labels import parse_label
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("LABEL: 2", "2"),
+    ("**Label** = 2", "2"),
+    ("Label: Q3", "2"),
+    ("label is 0", "0"),
+    ("REASON: bright major tonality\nLABEL: 1", "1"),
+    ("Q3 (sad)", "2"),
+    ("2", "2"),
+    ("(1) angry", "1"),
+    ("3 - calm, low arousal", "3"),
+])
+def test_parse_label_reads_label(text, expected):
+    assert parse_label(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    None,
+    "",
+    "The piece sounds happy.",
+    "Either 1 or 2",
+    "It is probably Q2, maybe 3",
+    "Label: 4",
+    "Q5",
+])
+def test_parse_label_rejects_missing_or_ambiguous(text):
+    assert parse_label(text) == ""
+
+
+def test_parse_label_prefers_explicit_label_over_other_numbers():
+    assert parse_label("Between 1 and 3 the mood shifts. Label: 0") == "0"
@@ -0,0 +1,42 @@
+import pytest
+
+import multi_agent_system as mas
+
+
+@pytest.mark.parametrize("arousal, valence, label", [
+    ("HIGH", "HIGH", "0"), ("HIGH", "LOW", "1"), ("LOW", "LOW", "2"), ("LOW", "HIGH", "3"),
+    ("HIGH", "INVALID", ""), ("", "LOW", ""),
+])
+def test_quadrant_label(arousal, valence, label):
+    assert mas.quadrant_label(arousal, valence) == label
+
+
+def test_map_emotion_needs_both_votes_decided(monkeypatch):
+    monkeypatch.setattr(mas, "use_quadrant_mapping", True)
+    assert mas.map_emotion(("HIGH", "r", True), ("LOW", "r", True)) == "1"
+    assert mas.map_emotion(("HIGH", "r", True), ("LOW", "r", False)) is None
+    assert mas.map_emotion(("INVALID", "r", True), ("LOW", "r", True)) is None
+    monkeypatch.setattr(mas, "use_quadrant_mapping", False)
+    assert mas.map_emotion(("HIGH", "r", True), ("LOW", "r", True)) is None
+
+
+@pytest.mark.parametrize("answer, label", [("2", "2"), ("Label: 3", "3"), ("Q2", "INVALID"), ("", "INVALID")])
+def test_combiner_label(answer, label):
+    assert mas.combiner_label(answer) == label
+
+
+def test_mapping_statistics(monkeypatch):
+    monkeypatch.setattr(mas, "use_quadrant_mapping", True)
+    monkeypatch.setattr(mas, "combiner_stats", mas.DecisionStats("Emotion combiner", "quadrant", "combiner"))
+    mas.record_emotion_mapping("1", None)
+    mas.record_emotion_mapping("0", "0")
+    mas.record_emotion_mapping(None, "2")
+    stats = mas.combiner_stats
+    assert (stats.fast, stats.deferred, stats.audited, stats.agreed) == (2, 1, 1, 1)
+    assert "(1 combiner calls saved)" in stats.report()
+
+
+def test_mapped_label_builds_the_response():
+    response = mas.build_emotion_response("2", "LOW", "slow tempo", "LOW", "minor key")
+    assert response.startswith("Emotion Classification: Q3 (sad) (Label: 2)")
+    assert "LOW arousal + LOW valence → Q3 (sad)" in response
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import llm_client as llm
+import multi_agent_system as mas
+
+ANSWER = "2. C major, because the key signature has no accidentals"
+
+
+@pytest.mark.parametrize("text, num_options, expected", [
+    ("2", 4, ""),
+    ("2.", 4, ""),
+    ("2. C major", 4, "2"),
+    ("2) C major", 4, "2"),
+    ("2: C major", 4, "2"),
+    ("  2.\nbecause", 4, "2"),
+    ("**2**. C major", 4, "2"),
+    ("Answer: 1\nbecause", 4, "1"),
+    ("answer 3. x", 4, "3"),
+    ("3/4 time", 4, ""),
+    ("2 beats per bar", 4, ""),
+    ("2.5 beats", 4, ""),
+    ("7. x", 4, ""),
+    ("10. x", 11, "10"),
+    ("The answer is 2. C major", 4, ""),
+])
+def test_leading_option_index(text, num_options, expected):
+    assert mas.leading_option_index(text, num_options) == expected
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setattr(llm, "STREAM_EARLY_STOP", True)
+    yield
+    llm.set_fake_responder(None)
+
+
+def done(text):
+    return mas.leading_option_index(text, 4)
+
+
+def test_complete_until_stops_at_the_option(streaming):
+    llm.set_fake_responder(lambda request: ANSWER)
+    text, saving = llm.complete_until("Which key?", "m", done, max_tokens=50)
+    assert text == "2. C"
+    assert saving.stopped_early and saving.tokens == 2 and saving.tokens_saved == 48
+    assert "saved <=48 tok" in llm.describe_saving(saving)
+
+
+def test_complete_until_async_stops_at_the_option(streaming):
+    llm.set_fake_responder(lambda request: ANSWER)
+    text, saving = asyncio.run(llm.complete_until_async("Which key?", "m", done, max_tokens=50))
+    assert text == "2. C" and saving.stopped_early
+
+
+def test_complete_until_reads_invalid_option_to_the_end(streaming):
+    llm.set_fake_responder(lambda request: "7. none of these")
+    text, saving = llm.complete_until("Which key?", "m", done, max_tokens=50)
+    assert text == "7. none of these"
+    assert not saving.stopped_early
+    assert llm.describe_saving(saving) == " | stream: 4 tok, not stopped early"
+
+
+def test_complete_until_without_streaming_returns_full_answer(monkeypatch):
+    monkeypatch.setattr(llm, "STREAM_EARLY_STOP", False)
+    llm.set_fake_responder(lambda request: ANSWER)
+    try:
+        assert llm.complete_until("Which key?", "m", done, max_tokens=50) == (ANSWER, None)
+    finally:
+        llm.set_fake_responder(None)
+    assert llm.describe_saving(None) == ""
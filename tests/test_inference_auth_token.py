@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+pytest.importorskip("globus_sdk")
+
+import inference_auth_token as auth_token
+from inference_auth_token import TokenManager
+
+
+class Authorizer:
+    """Stands in for the Globus refresh token authorizer built from tokens.json."""
+
+    issued = 0
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.access_token = stored["access_token"]
+        self.expires_at = stored["expires_at"]
+
+    def handle_missing_authorization(self):
+        self.access_token = None
+
+    def ensure_valid_token(self):
+        if self.access_token is None or self.expires_at <= time.time():
+            Authorizer.issued += 1
+            self.access_token = f"token-{Authorizer.issued}"
+            self.expires_at = time.time() + 3600
+            # The app stores refreshed tokens back in tokens.json
+            self.stored.update(access_token=self.access_token, expires_at=self.expires_at)
+
+
+@pytest.fixture
+def stored(monkeypatch, tmp_path):
+    """Contents of tokens.json: a token that is valid for another hour."""
+    stored = {"access_token": "token-0", "expires_at": time.time() + 3600}
+    monkeypatch.setattr(auth_token, "TOKENS_LOCK_PATH", str(tmp_path / "tokens.json.lock"))
+    monkeypatch.setattr(auth_token, "get_auth_object", lambda force=False: Authorizer(stored))
+    return stored
+
+
+def test_valid_stored_token_is_reused(stored):
+    manager = TokenManager()
+    assert manager.get_token() == "token-0"
+    assert manager.get_token() == "token-0"
+
+
+def test_token_close_to_expiry_is_refreshed(stored):
+    stored["expires_at"] = time.time() + 60
+    manager = TokenManager()
+    assert manager.get_token() not in ("token-0", None)
+
+
+def test_forced_refresh_replaces_an_unexpired_token(stored):
+    manager = TokenManager()
+    rejected = manager.get_token()
+    notified = []
+    manager._listeners.append(notified.append)
+
+    token = manager.force_refresh()
+    assert token != rejected
+    assert manager.get_token() == token == stored["access_token"]
+    assert notified == [token]
@@ -0,0 +1,30 @@
+import pytest
+
+import multi_agent_system as mas
+
+
+@pytest.mark.parametrize("score", [
+    "X:1\nM:4/4\nL:1/8\nK:C\nCDEF GABc|cBAG FEDC|]",
+    "X:1\nM:4/4\nK:G\n[|: GABc dedB |1 dBAG FGAB :|2 dBAG G4 |]",
+    "X:1\nL:1/8\nK:D\n\"D\" (3DEF [DF]A |[1 d4 :|[2 d4 ||",
+])
+def test_well_formed_scores_have_no_problems(score):
+    assert mas.check_abc_structure(score) == []
+
+
+@pytest.mark.parametrize("score, problem", [
+    ("X:1\nM:4/4\nCDEF|", "missing K: header"),
+    ("X:1\nK:C\nCDEF|", "missing M:/L: header"),
+    ("X:1\nM:4/4\nK:C\nCDEF GABc", "no bar lines"),
+    ("X:1\nM:4/4\nK:C\n[CEG|cBAG|", "unbalanced []"),
+    ("X:1\nM:4/4\nK:C\nCDEF | what key is this in |", "text mixed into the score"),
+])
+def test_structural_problems_are_reported(score, problem):
+    assert problem in mas.check_abc_structure(score)
+
+
+def test_validate_locally_needs_a_task():
+    score = "X:1\nM:4/4\nL:1/8\nK:C\nCDEF GABc|cBAG FEDC|]"
+    assert mas.validate_locally(f"Input:\n{score}\n\nTask:\nWhat is the key?", score) == (True, None, score)
+    assert mas.validate_locally(f"Input:\n{score}\n\nTask:\nkey", score) is None
+    assert mas.validate_locally(score, score) is None
@@ -0,0 +1,195 @@
+import asyncio
+import threading
+
+import openai
+import pytest
+from openai.types import Completion
+from openai.types.chat import ChatCompletion
+
+import llm_batching
+from llm_batching import BatchingClient, MicroBatcher, apportion, batch_key, split_usage
+from llm_scheduler import RequestScheduler
+
+MODEL = "google/gemma-3-27b-it"
+
+
+def chat(content, **params):
+    return {"model": MODEL, "messages": [{"role": "user", "content": content}], "temperature": 0,
+            "max_tokens": 4, **params}
+
+
+class Completions:
+    """/v1/completions stub: answers each prompt with its length, usage counted in characters."""
+
+    def __init__(self, error=None):
+        self.requests = []
+        self.error = error
+
+    def create(self, prompt, **params):
+        self.requests.append(prompt)
+        if self.error:
+            raise self.error
+        answers = [str(len(p)) for p in prompt]
+        return Completion.model_validate({
+            "id": "batch", "object": "text_completion", "created": 0, "model": params["model"],
+            "choices": [{"index": i, "finish_reason": "stop", "logprobs": None, "text": answer}
+                        for i, answer in enumerate(answers)],
+            "usage": {"prompt_tokens": sum(map(len, prompt)), "completion_tokens": sum(map(len, answers)),
+                      "total_tokens": sum(map(len, prompt)) + sum(map(len, answers))},
+        })
+
+
+class ChatCompletions:
+    def __init__(self):
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        return ChatCompletion.model_validate({
+            "id": "chat", "object": "chat.completion", "created": 0, "model": request["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "single"}}],
+        })
+
+
+class AsyncCompletions(Completions):
+    async def create(self, prompt, **params):
+        return Completions.create(self, prompt, **params)
+
+
+class AsyncChatCompletions(ChatCompletions):
+    async def create(self, **request):
+        return ChatCompletions.create(self, **request)
+
+
+class Backend:
+    completions_cls = Completions
+    chat_completions_cls = ChatCompletions
+
+    def __init__(self, error=None):
+        self.completions = self.completions_cls(error)
+        self.chat = type("Chat", (), {"completions": self.chat_completions_cls()})()
+
+
+class AsyncBackend(Backend):
+    completions_cls = AsyncCompletions
+    chat_completions_cls = AsyncChatCompletions
+
+
+def test_apportion():
+    assert apportion(10, [1, 1]) == [5, 5]
+    assert apportion(10, [1, 2]) == [4, 6]
+    assert apportion(7, [0, 0, 0]) == [3, 2, 2]
+    assert apportion(5, []) == []
+    assert sum(apportion(101, [3, 5, 7])) == 101
+
+
+def test_split_usage_follows_prompt_and_answer_length():
+    usage = type("Usage", (), {"prompt_tokens": 30, "completion_tokens": 4})()
+    choices = [type("Choice", (), {"text": text})() for text in ("1", "234")]
+    assert split_usage(usage, ["a" * 10, "b" * 20], choices) == [
+        {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+        {"prompt_tokens": 20, "completion_tokens": 3, "total_tokens": 23},
+    ]
+    assert split_usage(None, ["a"], choices[:1]) == [None]
+
+
+def test_batch_key_groups_only_compatible_requests():
+    key, prompt = batch_key(chat(" Which key? "))
+    assert prompt == "<start_of_turn>user\nWhich key?<end_of_turn>\n<start_of_turn>model\n"
+    assert batch_key(chat("Another question"))[0] == key
+    assert batch_key(chat("Which key?", max_tokens=5))[0] != key
+    assert batch_key(chat("Which key?", stop=["\n"]))[0] is not None
+
+
+@pytest.mark.parametrize("request_", [
+    chat("Which key?", stream=True),
+    chat("Which key?", n=3),
+    dict(chat("Which key?"), model="unknown-model"),
+    dict(chat("Which key?"), messages=[{"role": "system", "content": "x"}, {"role": "user", "content": "y"}]),
+])
+def test_batch_key_rejects_unbatchable_requests(request_):
+    assert batch_key(request_) == (None, None)
+
+
+def test_concurrent_calls_share_one_batch():
+    backend = Backend()
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=50))
+    results = {}
+
+    def ask(question):
+        results[question] = client.chat.completions.create(**chat(question))
+
+    threads = [threading.Thread(target=ask, args=(question,)) for question in ("a", "bb", "ccc")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(backend.completions.requests) == 1
+    assert client.batcher.batched_calls == 3 and client.batcher.batches == 1
+    prompt_length = len(batch_key(chat("a"))[1])
+    for question, response in results.items():
+        assert response.choices[0].message.content == str(prompt_length + len(question) - 1)
+        assert response.usage.prompt_tokens == prompt_length + len(question) - 1
+    assert sum(response.usage.completion_tokens for response in results.values()) == 6
+
+
+def test_full_batch_is_sent_at_once():
+    backend = Backend()
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=60000, max_batch=1))
+    assert client.chat.completions.create(**chat("a")).choices[0].message.content.isdigit()
+    assert len(backend.completions.requests) == 1
+
+
+def test_unbatchable_calls_go_alone():
+    backend = Backend()
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=0))
+    assert client.chat.completions.create(**chat("a", n=2)).choices[0].message.content == "single"
+    assert client.batcher.single_calls == 1 and backend.completions.requests == []
+
+
+def test_rejected_batch_switches_to_chat_requests(capsys):
+    response = type("Response", (), {"status_code": 404, "headers": {}, "request": None})()
+    backend = Backend(error=openai.NotFoundError("no completions", response=response, body=None))
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=0))
+    assert client.chat.completions.create(**chat("a")).choices[0].message.content == "single"
+    assert not client.batcher.enabled
+    client.chat.completions.create(**chat("b"))
+    assert len(backend.completions.requests) == 1 and len(backend.chat.completions.requests) == 2
+    assert "sending chat requests instead" in capsys.readouterr().out
+
+
+def test_async_calls_share_one_batch():
+    backend = AsyncBackend()
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=20), is_async=True)
+
+    async def main():
+        return await asyncio.gather(*(client.chat.completions.create(**chat(q)) for q in ("a", "bb")))
+
+    responses = asyncio.run(main())
+    assert len(backend.completions.requests) == 1
+    assert [r.usage.completion_tokens for r in responses] == [2, 2]
+
+
+def test_cancelled_async_leader_releases_the_followers():
+    backend = AsyncBackend()
+    client = BatchingClient(backend, RequestScheduler(), MicroBatcher(window_ms=200), is_async=True)
+
+    async def main():
+        leader = asyncio.ensure_future(client.chat.completions.create(**chat("a")))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(client.chat.completions.create(**chat("b")))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.wait_for(follower, 5)
+
+    assert asyncio.run(main()).choices[0].message.content == "single"
+    assert backend.completions.requests == []
+
+
+def test_micro_batching_from_env(monkeypatch):
+    monkeypatch.delenv("LLM_MICRO_BATCH", raising=False)
+    assert not llm_batching.micro_batching_from_env()
+    monkeypatch.setenv("LLM_MICRO_BATCH", "on")
+    assert llm_batching.micro_batching_from_env()
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+import llm_cache
+from llm_cache import CachedClient, ResponseCache, is_deterministic, request_key
+
+
+def completion(text):
+    return ChatCompletion.model_validate({
+        "id": "test", "object": "chat.completion", "created": 0, "model": "m",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+    })
+
+
+class CountingCompletions:
+    """Backend stub that numbers its answers so replays are visible."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def create(self, **request):
+        self.calls += 1
+        return completion(f"answer {self.calls}")
+
+
+class AsyncCountingCompletions(CountingCompletions):
+    async def create(self, **request):
+        return CountingCompletions.create(self, **request)
+
+
+class Backend:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(path=str(tmp_path / "responses.sqlite"))
+
+
+def request(**params):
+    return {"model": "m", "messages": [{"role": "user", "content": "Which key?"}], **params}
+
+
+def test_request_key_ignores_transport_fields():
+    base = request(temperature=0)
+    assert request_key(base) == request_key(request(temperature=0, stream=True, timeout=30, extra_headers={"a": "b"}))
+    assert request_key(base) == request_key(request(temperature=0, seed=None))
+    assert request_key(base) != request_key(request(temperature=0, max_tokens=5))
+    assert request_key(base) != request_key(request(temperature=0.7))
+
+
+def test_request_key_ignores_field_order():
+    assert request_key({"model": "m", "temperature": 0}) == request_key({"temperature": 0, "model": "m"})
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({}, True),
+    ({"temperature": 0}, True),
+    ({"temperature": None}, True),
+    ({"temperature": 0.7}, False),
+    ({"temperature": 0.7, "seed": 1}, True),
+    ({"temperature": 0.7, "seed": 0}, True),
+])
+def test_is_deterministic(params, expected):
+    assert is_deterministic(request(**params)) is expected
+
+
+def test_slot_key_reuses_key_for_deterministic_requests(cache):
+    first = cache.slot_key(request(temperature=0))
+    assert cache.slot_key(request(temperature=0)) == first == request_key(request(temperature=0))
+
+
+def test_slot_key_numbers_repeated_sampled_requests(cache):
+    key = request_key(request(temperature=0.7))
+    slots = [cache.slot_key(request(temperature=0.7)) for _ in range(3)]
+    assert slots == [f"{key}:0", f"{key}:1", f"{key}:2"]
+    # Slots are counted per request, and restart with a new run (a new cache object)
+    other = request_key(request(temperature=0.9))
+    assert cache.slot_key(request(temperature=0.9)) == f"{other}:0"
+    assert ResponseCache(path=cache.path).slot_key(request(temperature=0.7)) == f"{key}:0"
+
+
+def test_put_get_and_counters(cache):
+    assert cache.get("k") is None
+    cache.put("k", "value", "m")
+    assert cache.get("k") == "value"
+    assert cache.get("other", count_miss=False) is None
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+    assert tuple(cache.summary()) == (1, len("value"))
+
+
+def test_expired_entries_are_misses_and_evicted(cache):
+    cache.put("k", "value")
+    cache.max_age_seconds = -1
+    assert cache.get("k") is None
+    assert cache.evict() == 1
+    assert tuple(cache.summary()) == (0, 0)
+
+
+def test_evict_drops_least_recently_used_beyond_max_size(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    cache.max_age_seconds = float("inf")
+    for key in "abc":
+        now[0] += 1
+        cache.put(key, "x" * 10)
+    now[0] += 1
+    cache.get("a")
+    cache.max_bytes = 20
+    assert cache.evict() == 1
+    assert cache.get("b", count_miss=False) is None
+    assert cache.get("a") == cache.get("c") == "x" * 10
+
+
+def test_cached_client_replays_sampled_answers_per_slot(cache):
+    completions = CountingCompletions()
+    client = CachedClient(Backend(completions), cache)
+    first_run = [client.chat.completions.create(**request(temperature=0.7)).choices[0].message.content
+                 for _ in range(2)]
+    assert first_run == ["answer 1", "answer 2"]
+
+    rerun = CachedClient(Backend(completions), ResponseCache(path=cache.path))
+    replay = [rerun.chat.completions.create(**request(temperature=0.7)).choices[0].message.content
+              for _ in range(3)]
+    assert replay == ["answer 1", "answer 2", "answer 3"]
+    assert completions.calls == 3
+
+
+def test_cached_client_skips_streams_and_disabled_cache(tmp_path, cache):
+    completions = CountingCompletions()
+    CachedClient(Backend(completions), cache).chat.completions.create(**request(stream=True))
+    disabled = ResponseCache(path=str(tmp_path / "unused" / "responses.sqlite"), enabled=False)
+    for _ in range(2):
+        CachedClient(Backend(completions), disabled).chat.completions.create(**request())
+    assert completions.calls == 3
+    assert cache.stores == 0
+    assert not (tmp_path / "unused").exists()
+
+
+def test_async_cached_client_serves_repeats_from_cache(cache):
+    completions = AsyncCountingCompletions()
+    client = CachedClient(Backend(completions), cache, is_async=True)
+
+    async def ask():
+        return [(await client.chat.completions.create(**request(temperature=0))).choices[0].message.content
+                for _ in range(2)]
+
+    assert asyncio.run(ask()) == ["answer 1", "answer 1"]
+    assert completions.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+
+import openai
+import pytest
+
+import llm_client as llm
+
+
+class Response:
+    status_code = 400
+    headers = {}
+    request = None
+
+
+def bad_request(message, param=None):
+    return openai.BadRequestError(message, response=Response(), body={"message": message, "param": param})
+
+
+CONTEXT_OVERFLOW = ("This model's maximum context length is 8192 tokens. However, you requested "
+                    "9000 tokens (8996 in the messages, 4 in the completion).")
+
+
+@pytest.fixture
+def responder(monkeypatch):
+    """Answer fake backend requests with responder(request); features start switched on."""
+    monkeypatch.setattr(llm, "use_n_sampling", True)
+    monkeypatch.setattr(llm, "use_json_schema", True)
+    monkeypatch.setattr(llm, "use_guided_decoding", True)
+    monkeypatch.setattr(llm, "use_logprobs", True)
+    yield llm.set_fake_responder
+    llm.set_fake_responder(None)
+
+
+@pytest.mark.parametrize("error, names, expected", [
+    (bad_request("'n' must be 1", param="n"), ("n",), True),
+    (bad_request("n > 1 is not supported"), ("n",), True),
+    (bad_request(CONTEXT_OVERFLOW), ("n",), False),
+    (bad_request("top_logprobs must be at most 5"), ("logprobs",), False),
+    (bad_request("top_logprobs must be at most 5"), ("logprobs", "top_logprobs"), True),
+    (ValueError("n"), ("n",), False),
+])
+def test_rejects_param(error, names, expected):
+    assert llm._rejects_param(error, *names) is expected
+
+
+def test_rejected_n_switches_n_sampling_off(responder):
+    def answer(request):
+        if (request.get("n") or 1) > 1:
+            raise bad_request("'n' must be 1", param="n")
+        return "1"
+
+    responder(answer)
+    answers = llm.sample("Which label?", "m", 3, temperature=0.7)
+    assert answers == ["1", "1", "1"]
+    assert not llm.use_n_sampling
+    # The rejected n=3 request and the 3 separate ones
+    assert answers.requests == 4
+    assert llm.sample("Which label?", "m", 3, temperature=0.7).requests == 3
+
+
+def test_other_bad_request_keeps_n_sampling_on(responder):
+    calls = []
+
+    def answer(request):
+        calls.append(request.get("n") or 1)
+        if len(calls) == 1:
+            raise bad_request(CONTEXT_OVERFLOW)
+        return "1"
+
+    responder(answer)
+    assert llm.sample("Which label?", "m", 3, temperature=0.7) == ["1", "1", "1"]
+    assert llm.use_n_sampling
+    # Only this call fell back to separate requests
+    assert calls == [3, 1, 1, 1]
+    assert llm.sample("Which label?", "m", 3, temperature=0.7) == ["1", "1", "1"]
+    assert calls[4:] == [3]
+
+
+def test_n_sample_request_counts_once(responder):
+    responder(lambda request: "1")
+    assert llm.sample("Which label?", "m", 3, temperature=0.7).requests == 1
+
+
+@pytest.mark.parametrize("n", [0, -1])
+def test_no_samples_sends_no_request(responder, n):
+    calls = []
+    responder(lambda request: calls.append(request) or "1")
+    assert llm.sample("Which label?", "m", n, temperature=0.7) == []
+    assert asyncio.run(llm.sample_async("Which label?", "m", n, temperature=0.7)) == []
+    assert calls == []
+
+
+def test_separate_samples_use_at_most_max_sample_workers(responder, monkeypatch):
+    monkeypatch.setattr(llm, "use_n_sampling", False)
+    monkeypatch.setattr(llm, "MAX_SAMPLE_WORKERS", 2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def answer(request):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+        return "1"
+
+    responder(answer)
+    answers = llm.sample("Which label?", "m", 6, temperature=0.7)
+    assert answers == ["1"] * 6 and answers.requests == 6
+    assert max(peak) <= 2
+
+
+def test_rejected_response_format_switches_json_schema_off(responder):
+    def answer(request):
+        if "response_format" in request:
+            raise bad_request("response_format json_schema is not supported", param="response_format")
+        return '{"task": "key"}'
+
+    responder(answer)
+    assert llm.complete_json("Plan", "m", {"type": "object"}) == {"task": "key"}
+    assert not llm.use_json_schema
+
+
+def test_other_bad_request_keeps_json_schema_on(responder):
+    def answer(request):
+        raise bad_request(CONTEXT_OVERFLOW)
+
+    responder(answer)
+    with pytest.raises(openai.BadRequestError):
+        llm.complete_json("Plan", "m", {"type": "object"})
+    assert llm.use_json_schema
+
+
+def test_rejected_guided_choice_switches_guided_decoding_off(responder):
+    def answer(request):
+        if "guided_choice" in (request.get("extra_body") or {}):
+            raise bad_request("Unrecognized request argument supplied: guided_choice")
+        return "Q2"
+
+    responder(answer)
+    assert llm.complete("Which label?", "m", **llm.guided(choices=["Q1", "Q2"])) == "Q2"
+    assert not llm.use_guided_decoding
+
+
+def test_other_bad_request_keeps_guided_decoding_on(responder):
+    def answer(request):
+        raise bad_request(CONTEXT_OVERFLOW)
+
+    responder(answer)
+    with pytest.raises(openai.BadRequestError):
+        llm.complete("Which label?", "m", **llm.guided(choices=["Q1", "Q2"]))
+    assert llm.use_guided_decoding
+
+
+def test_rejected_logprobs_switches_logprobs_off(responder):
+    def answer(request):
+        if request.get("logprobs"):
+            raise bad_request("logprobs is not supported", param="logprobs")
+        return "2"
+
+    responder(answer)
+    assert llm.label_distribution("Which label?", "m", ["0", "1", "2", "3"]) == ("2", None)
+    assert not llm.use_logprobs
+
+
+def test_other_bad_request_keeps_logprobs_on(responder):
+    def answer(request):
+        raise bad_request(CONTEXT_OVERFLOW)
+
+    responder(answer)
+    with pytest.raises(openai.BadRequestError):
+        llm.label_distribution("Which label?", "m", ["0", "1", "2", "3"])
+    assert llm.use_logprobs
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from llm_coalescing import CoalescingClient, RequestCoalescer, coalesce_key
+
+
+def completion(text):
+    return ChatCompletion.model_validate({
+        "id": "test", "object": "chat.completion", "created": 0, "model": "m",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+    })
+
+
+def request(**params):
+    return {"model": "m", "messages": [{"role": "user", "content": "Which key?"}], **params}
+
+
+class SlowCompletions:
+    """Backend stub that holds every call until released."""
+
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.release = threading.Event()
+
+    def create(self, **request):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return completion(f"answer {self.calls}")
+
+
+class AsyncSlowCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **request):
+        self.calls += 1
+        await asyncio.sleep(0.02)
+        return completion(f"answer {self.calls}")
+
+
+class Backend:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+@pytest.mark.parametrize("params, coalesced", [
+    ({"temperature": 0}, True),
+    ({"temperature": 0.7, "seed": 1}, True),
+    ({"temperature": 0.7}, False),
+    ({"temperature": 0, "stream": True}, False),
+])
+def test_coalesce_key_only_for_deterministic_requests(params, coalesced):
+    assert (coalesce_key(request(**params)) is not None) is coalesced
+
+
+def ask_concurrently(client, count, **params):
+    results = []
+    errors = []
+
+    def ask():
+        try:
+            results.append(client.chat.completions.create(**request(**params)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ask) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def wait_for_waiters(coalescer, count):
+    for _ in range(500):
+        if coalescer.sent + coalescer.coalesced >= count:
+            return
+        time.sleep(0.01)
+
+
+def test_identical_calls_in_flight_are_sent_once():
+    backend = SlowCompletions()
+    client = CoalescingClient(Backend(backend), RequestCoalescer())
+    threads, results, _ = ask_concurrently(client, 3, temperature=0)
+    wait_for_waiters(client.coalescer, 3)
+    backend.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert backend.calls == 1
+    assert [r.choices[0].message.content for r in results] == ["answer 1"] * 3
+    # Every caller gets its own copy of the response
+    assert len({id(r) for r in results}) == 3
+    assert (client.coalescer.sent, client.coalescer.coalesced) == (1, 2)
+    assert not client.coalescer._in_flight
+
+
+def test_sampled_calls_are_sent_separately():
+    backend = SlowCompletions()
+    backend.release.set()
+    client = CoalescingClient(Backend(backend), RequestCoalescer())
+    threads, results, _ = ask_concurrently(client, 3, temperature=0.7)
+    for thread in threads:
+        thread.join(5)
+    assert backend.calls == 3 and client.coalescer.sent == 0
+
+
+def test_error_reaches_every_waiting_caller():
+    backend = SlowCompletions(error=ValueError("boom"))
+    client = CoalescingClient(Backend(backend), RequestCoalescer())
+    threads, results, errors = ask_concurrently(client, 2, temperature=0)
+    wait_for_waiters(client.coalescer, 2)
+    backend.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert backend.calls == 1 and results == []
+    assert [type(e) for e in errors] == [ValueError, ValueError]
+    assert not client.coalescer._in_flight
+
+
+def test_async_calls_survive_a_cancelled_leader():
+    backend = AsyncSlowCompletions()
+    client = CoalescingClient(Backend(backend), RequestCoalescer(), is_async=True)
+
+    async def main():
+        leader = asyncio.ensure_future(client.chat.completions.create(**request(temperature=0)))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(client.chat.completions.create(**request(temperature=0)))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()).choices[0].message.content == "answer 1"
+    assert backend.calls == 1 and client.coalescer.coalesced == 1
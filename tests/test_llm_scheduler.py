@@ -0,0 +1,207 @@
+import asyncio
+import threading
+
+import openai
+import pytest
+
+import llm_scheduler
+from llm_scheduler import RequestScheduler, RetriesExhaustedError
+
+
+class Response:
+    """Just enough of an HTTP response to build openai's status errors."""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.request = None
+
+
+def status_error(cls, status_code, headers=None):
+    return cls(f"status {status_code}", response=Response(status_code, headers), body=None)
+
+
+def failing(*errors, result="ok"):
+    """request() that raises the given errors in turn, then returns result."""
+    pending = list(errors)
+    calls = []
+
+    def request():
+        calls.append(len(calls))
+        if pending:
+            raise pending.pop(0)
+        return result
+
+    request.calls = calls
+    return request
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Backoff delays the scheduler sleeps, with the jitter at its upper bound."""
+    slept = []
+    monkeypatch.setattr(llm_scheduler.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(llm_scheduler.time, "sleep", slept.append)
+    return slept
+
+
+def test_success_raises_limit_by_one_request_per_round_trip():
+    scheduler = RequestScheduler(initial_limit=4)
+    for _ in range(4):
+        scheduler.run(lambda: "ok")
+    assert scheduler.limit == pytest.approx(5, abs=0.1)
+    assert scheduler.requests == 4 and scheduler._in_flight == 0
+
+
+def test_limit_is_clamped():
+    assert RequestScheduler(initial_limit=100, max_limit=8).limit == 8
+    scheduler = RequestScheduler(initial_limit=2, min_limit=2)
+    scheduler._on_failure(status_error(openai.RateLimitError, 429), 0, False)
+    assert scheduler.limit == 2
+
+
+def test_throttling_and_timeouts_halve_the_limit():
+    scheduler = RequestScheduler(initial_limit=16)
+    scheduler._on_failure(status_error(openai.RateLimitError, 429), 0, False)
+    scheduler._on_failure(status_error(openai.InternalServerError, 503), 0, False)
+    scheduler._on_failure(openai.APITimeoutError(request=None), 0, False)
+    assert scheduler.limit == 2
+    assert (scheduler.throttle_events, scheduler.timeouts) == (2, 1)
+    assert scheduler.lowest_limit == 2 and scheduler.highest_limit == 16
+
+
+def test_slow_request_shrinks_the_limit():
+    scheduler = RequestScheduler(initial_limit=10, latency_target=1.0)
+    scheduler._on_success(2.0)
+    assert scheduler.limit == pytest.approx(9)
+    assert scheduler.slow_requests == 1
+
+
+def test_transient_errors_are_retried_with_backoff(delays):
+    scheduler = RequestScheduler()
+    request = failing(status_error(openai.InternalServerError, 500), openai.APITimeoutError(request=None))
+    assert scheduler.run(request) == "ok"
+    assert delays == [1.0, 2.0]
+    assert scheduler.retries == 2 and scheduler.requests == 1 and scheduler._in_flight == 0
+
+
+def test_retry_after_is_honored(delays):
+    scheduler = RequestScheduler()
+    scheduler.run(failing(status_error(openai.RateLimitError, 429, {"retry-after": "7"})))
+    assert delays == [7.0]
+
+
+def test_retries_run_out(delays):
+    scheduler = RequestScheduler(max_retries=2)
+    request = failing(*[status_error(openai.InternalServerError, 502)] * 5)
+    with pytest.raises(RetriesExhaustedError) as error:
+        scheduler.run(request)
+    assert error.value.attempts == 3 and len(request.calls) == 3
+    assert scheduler.failures == 1 and scheduler._in_flight == 0
+
+
+def test_other_errors_are_raised_at_once(delays):
+    scheduler = RequestScheduler()
+    request = failing(status_error(openai.BadRequestError, 400))
+    with pytest.raises(openai.BadRequestError):
+        scheduler.run(request)
+    assert len(request.calls) == 1 and delays == []
+
+
+def test_unauthorized_refreshes_the_token_once(delays):
+    refreshed = []
+    scheduler = RequestScheduler(on_unauthorized=lambda: refreshed.append(True))
+    assert scheduler.run(failing(status_error(openai.AuthenticationError, 401))) == "ok"
+    assert refreshed == [True] and delays == [0.0]
+
+    request = failing(*[status_error(openai.AuthenticationError, 401)] * 2)
+    with pytest.raises(openai.AuthenticationError):
+        scheduler.run(request)
+    assert len(refreshed) == 2 and len(request.calls) == 2
+
+
+def test_unauthorized_without_refresh_is_raised(delays):
+    with pytest.raises(openai.AuthenticationError):
+        RequestScheduler().run(failing(status_error(openai.AuthenticationError, 401)))
+
+
+def test_arun_retries_and_refreshes_off_the_loop(monkeypatch):
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(llm_scheduler.asyncio, "sleep", no_sleep)
+    refreshed = []
+    scheduler = RequestScheduler(on_unauthorized=lambda: refreshed.append(threading.current_thread()))
+    errors = [status_error(openai.AuthenticationError, 401), status_error(openai.InternalServerError, 500)]
+
+    async def request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert asyncio.run(scheduler.arun(request)) == "ok"
+    # The refresh ran in a worker thread, not on the event loop's thread
+    assert len(refreshed) == 1 and refreshed[0] is not threading.main_thread()
+    assert scheduler.retries == 2 and scheduler._in_flight == 0
+
+
+def test_arun_keeps_requests_under_the_limit():
+    scheduler = RequestScheduler(initial_limit=2, max_limit=2)
+    running = []
+    peak = []
+
+    async def request():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return "ok"
+
+    async def main():
+        return await asyncio.gather(*(scheduler.arun(request) for _ in range(6)))
+
+    assert asyncio.run(main()) == ["ok"] * 6
+    assert max(peak) == 2 and scheduler._in_flight == 0
+
+
+class Stream:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.closed = False
+
+    def __iter__(self):
+        yield from self.chunks
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_holds_its_slot_until_read_to_the_end():
+    scheduler = RequestScheduler()
+    stream = scheduler.run(lambda: Stream(["a", "b"]), stream=True)
+    assert scheduler._in_flight == 1 and scheduler.requests == 0
+    assert list(stream) == ["a", "b"]
+    assert scheduler._in_flight == 0 and scheduler.requests == 1
+
+
+def test_closed_stream_releases_its_slot_once():
+    scheduler = RequestScheduler()
+    backend = Stream(["a", "b"])
+    with scheduler.run(lambda: backend, stream=True) as stream:
+        for chunk in stream:
+            break
+    assert backend.closed
+    stream.close()
+    del stream
+    assert scheduler._in_flight == 0 and scheduler.requests == 1
+
+
+def test_failed_stream_is_not_counted_as_a_success():
+    scheduler = RequestScheduler()
+    stream = scheduler.run(lambda: Stream(["a"], error=ValueError("dropped")), stream=True)
+    with pytest.raises(ValueError):
+        list(stream)
+    assert scheduler._in_flight == 0 and scheduler.requests == 0
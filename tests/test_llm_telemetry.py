@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+import llm_telemetry as telemetry
+from llm_telemetry import Telemetry, load_records, percentile, summarize
+
+
+@pytest.fixture
+def log(tmp_path):
+    return Telemetry(path=str(tmp_path / "calls.jsonl"))
+
+
+def test_record_of_a_non_streamed_call(log):
+    with telemetry.stage("controller"):
+        with log.track("m") as record:
+            telemetry.note(cache="miss")
+            telemetry.add_queue_time(0.25)
+            telemetry.add_retry()
+            record.set_usage(type("Response", (), {"usage": type("Usage", (), {
+                "prompt_tokens": 12, "completion_tokens": 3})()})())
+    fields = log.records[0]
+    assert fields["stage"] == "controller" and fields["cache"] == "miss"
+    assert (fields["queue_ms"], fields["retries"]) == (250.0, 1)
+    assert (fields["prompt_tokens"], fields["completion_tokens"]) == (12, 3)
+    # Without a stream, the first token arrives with the whole response
+    assert fields["ttft_source"] == "response" and fields["ttft_ms"] == fields["latency_ms"]
+
+
+def test_streamed_call_keeps_its_first_token_time(log):
+    with log.track("m", streamed=True) as record:
+        record.first_token()
+        first = record.ttft_ms
+        record.first_token()
+    assert log.records[0]["ttft_source"] == "stream"
+    assert record.ttft_ms == first <= record.latency_ms
+
+
+def test_streamed_gateway_call_records_its_first_token_time(log, monkeypatch):
+    import llm_client as llm
+
+    monkeypatch.setattr(telemetry, "_telemetry", log)
+    monkeypatch.setattr(llm, "STREAM_EARLY_STOP", True)
+    monkeypatch.setenv("LLM_FAKE_TOKEN_MS", "5")
+    llm.set_fake_responder(lambda request: "one two three four")
+    try:
+        llm.complete_until("Which label?", "m", lambda text: False)
+    finally:
+        llm.set_fake_responder(None)
+    fields = log.records[0]
+    assert fields["streamed"] and fields["ttft_source"] == "stream"
+    # The later tokens arrive after the first one
+    assert fields["ttft_ms"] < fields["latency_ms"]
+
+
+def test_failed_call_is_recorded_and_raised(log):
+    with pytest.raises(ValueError):
+        with log.track("m"):
+            raise ValueError("boom")
+    fields = log.records[0]
+    assert (fields["status"], fields["error"], fields["ttft_ms"]) == ("error", "ValueError", None)
+
+
+def test_note_outside_a_call_is_ignored():
+    telemetry.note(cache="hit")
+    telemetry.add_queue_time(1)
+    telemetry.add_retry()
+    assert telemetry.current_stage() == telemetry.DEFAULT_STAGE
+
+
+def test_stage_decorator_labels_calls_and_innermost_stage_wins(log):
+    @telemetry.stage("evaluator")
+    def evaluate():
+        with log.track("m"):
+            pass
+        with telemetry.stage("format_checker"), log.track("m"):
+            pass
+
+    evaluate()
+    assert [r["stage"] for r in log.records] == ["evaluator", "format_checker"]
+    assert telemetry.current_stage() == telemetry.DEFAULT_STAGE
+
+
+def test_disabled_telemetry_writes_nothing(tmp_path):
+    log = Telemetry(path=str(tmp_path / "off" / "calls.jsonl"), enabled=False)
+    with log.track("m"):
+        pass
+    assert log.records == [] and not (tmp_path / "off").exists()
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 95, 99)] == [50, 95, 99]
+    assert percentile([7], 99) == 7
+    assert percentile([3, 1, 2], 50) == 2
+
+
+def record(stage, latency, cache="miss", prompt=10, completion=2, status="ok"):
+    return {"run": "r", "stage": stage, "cache": cache, "latency_ms": latency, "queue_ms": 0.0,
+            "ttft_ms": latency, "prompt_tokens": prompt, "completion_tokens": completion, "status": status}
+
+
+def test_summary_counts_tokens_of_sent_calls_only():
+    lines = summarize([record("evaluator", 100), record("evaluator", 300, cache="hit"),
+                       record("combiner", 50, cache="coalesced", status="error")]).splitlines()
+    evaluator = lines[2].split()
+    assert evaluator[:4] == ["evaluator", "2", "1", "0"]
+    assert evaluator[-2:] == ["10", "2"]
+    assert lines[3].split()[:4] == ["combiner", "1", "0", "1"]
+    assert lines[-1].split() == ["total", "3", "1", "1", "10", "2"]
+
+
+def test_load_records_picks_the_last_run(tmp_path):
+    path = tmp_path / "calls.jsonl"
+    path.write_text("".join(json.dumps(dict(record("s", 1), run=run)) + "\n" for run in ("a", "a", "b")) + "\n")
+    assert [r["run"] for r in load_records(str(path))] == ["b"]
+    assert len(load_records(str(path), "a")) == 2
+    assert len(load_records(str(path), "all")) == 3
+
+
+def test_records_are_appended_as_jsonl(log):
+    for _ in range(2):
+        with log.track("m"):
+            pass
+    with open(log.path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2 and lines[0]["run"] == telemetry.RUN_ID
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import pytest
+
+import llm_telemetry as telemetry
+import llm_tracing as tracing
+from llm_tracing import Tracer
+
+
+@pytest.fixture
+def tracer(monkeypatch, tmp_path):
+    tracer = Tracer(path=str(tmp_path / "trace-{run}.json"), enabled=True)
+    monkeypatch.setattr(tracing, "_tracer", tracer)
+    return tracer
+
+
+def spans_by_name(tracer):
+    return {s.name: s for s in tracer.spans}
+
+
+def test_spans_nest_and_carry_the_sample_id(tracer):
+    with tracing.trace_sample(3):
+        with telemetry.stage("abc_expert"):
+            with tracing.span("llm:abc_expert", model="m") as call:
+                call.set(tokens=5)
+    spans = spans_by_name(tracer)
+    assert spans["abc_expert"].parent_id == spans["sample"].span_id
+    assert spans["llm:abc_expert"].parent_id == spans["abc_expert"].span_id
+    assert {s.sample for s in tracer.spans} == {3}
+    assert spans["llm:abc_expert"].attributes == {"model": "m", "tokens": 5}
+
+
+def test_disabled_tracing_records_nothing(monkeypatch):
+    monkeypatch.setattr(tracing, "_tracer", Tracer(enabled=False))
+    with tracing.trace_sample(1) as root:
+        assert root is None
+    assert tracing._tracer.spans == []
+
+
+def test_decorated_functions_are_traced(tracer):
+    @tracing.span("combine")
+    def combine():
+        return "sync"
+
+    @tracing.span("classify")
+    async def classify():
+        return "async"
+
+    async def sample():
+        with tracing.trace_sample(0):
+            return combine(), await classify()
+
+    assert asyncio.run(sample()) == ("sync", "async")
+    spans = spans_by_name(tracer)
+    assert spans["combine"].parent_id == spans["classify"].parent_id == spans["sample"].span_id
+
+
+def test_concurrent_branches_get_their_own_track(tracer):
+    async def branch(name):
+        with tracing.span(name):
+            await asyncio.sleep(0.02)
+
+    async def sample():
+        with tracing.trace_sample(0):
+            await asyncio.gather(branch("agent_B"), branch("agent_C"))
+
+    asyncio.run(sample())
+    events = [e for e in tracer.chrome_trace()["traceEvents"] if e["ph"] == "X"]
+    tid = {e["name"]: e["tid"] for e in events}
+    assert tid["sample"] == tid["agent_B"] != tid["agent_C"]
+    names = [e["args"]["name"] for e in tracer.chrome_trace()["traceEvents"] if e["name"] == "thread_name"]
+    assert names == ["sample 0", "sample 0 (branch 2)"]
+
+
+def test_samples_are_ordered_and_get_separate_tracks(tracer):
+    for sample_id in (10, 2):
+        with tracing.trace_sample(sample_id):
+            pass
+    with tracing.span("setup"):
+        pass
+    names = [e["args"]["name"] for e in tracer.chrome_trace()["traceEvents"] if e["name"] == "thread_name"]
+    assert names == ["sample 2", "sample 10", "no sample"]
+
+
+def test_export_writes_chrome_trace(tracer):
+    with tracing.trace_sample(1), tracing.span("llm:evaluator"):
+        pass
+    with open(tracer.export(), encoding="utf-8") as f:
+        trace = json.load(f)
+    assert tracer.path.endswith(f"trace-{tracing.RUN_ID}.json")
+    events = {e["name"]: e for e in trace["traceEvents"] if e["ph"] == "X"}
+    assert events["llm:evaluator"]["cat"] == "llm" and events["sample"]["cat"] == "pipeline"
+    assert events["sample"]["dur"] >= events["llm:evaluator"]["dur"]
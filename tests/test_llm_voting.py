@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+import llm_voting
+from llm_voting import StoppingRule, Vote, VoteStats, binomial_tail
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    """Fresh process-wide vote statistics with the majority rule."""
+    stats = VoteStats(StoppingRule("majority"))
+    monkeypatch.setattr(llm_voting, "_stats", stats)
+    return stats
+
+
+def test_binomial_tail():
+    assert binomial_tail(3, 0) == 1
+    assert binomial_tail(3, 3) == 1 / 8
+    assert binomial_tail(4, 2) == 11 / 16
+    assert binomial_tail(3, 4) == 0
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        StoppingRule("unanimous")
+
+
+def test_vote_mode_from_env(monkeypatch):
+    monkeypatch.setenv("LLM_VOTE", " SPRT ")
+    assert llm_voting.vote_mode_from_env() == "sprt"
+    monkeypatch.setenv("LLM_VOTE", "first")
+    with pytest.raises(ValueError):
+        llm_voting.vote_mode_from_env()
+
+
+@pytest.mark.parametrize("mode", llm_voting.VOTE_MODES)
+def test_every_mode_stops_when_no_votes_remain_or_majority_is_certain(mode):
+    rule = StoppingRule(mode)
+    assert rule.decided(1, 1, 0)
+    assert rule.decided(2, 0, 1)
+    assert rule.needed(2, 0, 1) == 0
+
+
+def test_fixed_asks_every_remaining_analyst():
+    rule = StoppingRule("fixed")
+    assert not rule.decided(0, 0, 3)
+    assert rule.needed(0, 0, 3) == 3
+    assert rule.needed(1, 1, 1) == 1
+
+
+def test_majority_asks_only_for_votes_that_can_settle_it():
+    rule = StoppingRule("majority")
+    assert rule.needed(0, 0, 3) == 2
+    assert not rule.decided(1, 1, 1)
+    assert rule.needed(1, 1, 1) == 1
+    assert rule.needed(0, 0, 5) == 3
+
+
+def test_sprt_lead_follows_accuracy_and_error():
+    # log(19) / log(3) = 2.68 -> a lead of 3 votes
+    assert StoppingRule("sprt").lead == 3
+    # log(9) / log(9) = 1 exactly; the tolerance keeps it from rounding up to 2
+    assert StoppingRule("sprt", accuracy=0.9, error=0.1).lead == 1
+    rule = StoppingRule("sprt")
+    assert rule.decided(3, 0, 6)
+    assert not rule.decided(3, 1, 6)
+    assert rule.needed(0, 0, 9) == 3
+
+
+def test_bayes_stops_at_confidence():
+    rule = StoppingRule("bayes")
+    # P(p > 1/2 | 3 votes for, 0 against) = 15/16 < 0.95; 4 votes give 31/32
+    assert not rule.decided(3, 0, 10)
+    assert rule.decided(4, 0, 10)
+    assert not rule.decided(4, 4, 10)
+    assert rule.needed(0, 0, 10) == 4
+
+
+def test_vote_ignores_invalid_labels():
+    vote = Vote(3, StoppingRule("majority"))
+    assert vote.needed() == 2
+    vote.add(["1", ""])
+    assert vote.needed() == 1
+    vote.add(["1"])
+    assert vote.needed() == 0
+
+
+def test_vote_stops_early_when_first_two_agree():
+    vote = Vote(3, StoppingRule("majority"))
+    vote.add(["2", "2"])
+    assert vote.needed() == 0
+
+
+def test_run_vote_stops_after_two_agreeing_analysts(stats):
+    asked = []
+
+    def draw(k):
+        asked.append(k)
+        return ["LABEL: 1"] * k
+
+    answers = llm_voting.run_vote(draw, lambda answer: answer[-1], 3)
+    assert asked == [2]
+    assert answers == ["LABEL: 1", "LABEL: 1"]
+    assert (stats.votes, stats.used, stats.available) == (1, 2, 3)
+    assert "1 analyst calls saved" in stats.report()
+
+
+def test_run_vote_asks_third_analyst_on_disagreement(stats):
+    pending = ["0", "1", "1"]
+
+    def draw(k):
+        return [pending.pop(0) for _ in range(k)]
+
+    assert llm_voting.run_vote(draw, str, 3) == ["0", "1", "1"]
+    assert stats.used == 3
+
+
+def test_run_vote_async_matches_sync(stats):
+    async def draw(k):
+        return ["3"] * k
+
+    assert asyncio.run(llm_voting.run_vote_async(draw, str, 5)) == ["3"] * 3
+    assert (stats.used, stats.available) == (3, 5)
@@ -0,0 +1,82 @@
+import pytest
+
+import multi_agent_system as mas
+
+SCORE = "X:1\nM:4/4\nL:1/8\nK:C\nCDEF GABc|cBAG FEDC|]"
+TEMPLATED = f"Input:\n{SCORE}\n\nTask:\nWhat is the key, and which emotion does the piece convey?"
+UNTEMPLATED = f"{SCORE}\nkey and emotion please"
+
+BOTH = {"valid": True, "problem": "", "decision": "BOTH",
+        "abc_task": "What is the key?", "emotion_task": "Which emotion does it convey?"}
+
+
+@pytest.mark.parametrize("plan", [
+    None,
+    "BOTH",
+    ["BOTH"],
+    {},
+    {"valid": "yes", "decision": "BOTH"},
+    {"valid": True},
+    {"valid": True, "decision": None},
+])
+def test_unusable_plan_falls_back(plan):
+    assert mas.parse_plan(plan, TEMPLATED) is None
+
+
+def test_both_adds_the_score_to_each_sub_task():
+    is_valid, error, abc, decision, abc_task, emotion_task = mas.parse_plan(BOTH, TEMPLATED)
+    assert (is_valid, error, abc, decision) == (True, None, SCORE, "BOTH")
+    assert abc_task == f"Input:\n{SCORE}\n\nTask:\nWhat is the key?"
+    assert emotion_task == f"Input:\n{SCORE}\n\nTask:\nWhich emotion does it convey?"
+
+
+def test_sub_task_that_already_holds_the_score_is_kept():
+    plan = dict(BOTH, abc_task=f"{SCORE}\nWhat is the key?")
+    assert mas.parse_plan(plan, TEMPLATED)[4] == f"{SCORE}\nWhat is the key?"
+
+
+def test_missing_sub_tasks_use_the_whole_prompt():
+    plan = dict(BOTH, abc_task="", emotion_task=None)
+    assert mas.parse_plan(plan, TEMPLATED)[4:] == (TEMPLATED, TEMPLATED)
+
+
+def test_sub_tasks_only_for_both():
+    plan = dict(BOTH, decision="emotion")
+    assert mas.parse_plan(plan, TEMPLATED)[3:] == ("EMOTION", None, None)
+
+
+def test_locally_verified_score_stays_valid():
+    plan = dict(BOTH, valid=False, problem="no question")
+    assert mas.parse_plan(plan, TEMPLATED)[:3] == (True, None, SCORE)
+
+
+def test_planner_validity_needs_a_score_in_the_prompt():
+    assert mas.parse_plan(BOTH, UNTEMPLATED)[:2] == (True, None)
+    is_valid, error, abc = mas.parse_plan(dict(BOTH, valid=False, problem="no question"), UNTEMPLATED)[:3]
+    assert not is_valid and error == "Input issue detected: no question"
+
+    is_valid, error, abc, decision, abc_task, emotion_task = mas.parse_plan(BOTH, "What key is this piece in?")
+    assert (is_valid, abc) == (False, None)
+    assert error.startswith("No ABC score detected")
+    assert (abc_task, emotion_task) == ("What is the key?", "Which emotion does it convey?")
+
+
+@pytest.mark.parametrize("answer", [ValueError("bad json"), "not a plan", {"decision": "ABC"}])
+def test_plan_request_falls_back_on_bad_answers(monkeypatch, answer):
+    def complete_json(*args, **kwargs):
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(mas.llm, "complete_json", complete_json)
+    monkeypatch.setattr(mas, "planner_counts", mas.Counter())
+    assert mas.plan_request(TEMPLATED) is None
+    assert mas.planner_counts == {"fallback": 1}
+
+
+def test_plan_request_uses_a_parsed_plan(monkeypatch):
+    monkeypatch.setattr(mas.llm, "complete_json", lambda *args, **kwargs: dict(BOTH))
+    monkeypatch.setattr(mas, "planner_counts", mas.Counter())
+    monkeypatch.setattr(mas, "validation_counts", mas.Counter())
+    assert mas.plan_request(TEMPLATED)[3] == "BOTH"
+    assert mas.planner_counts == {"fused": 1}
@@ -0,0 +1,83 @@
+import pytest
+
+import multi_agent_system as mas
+
+SCORE = "X:1\nM:4/4\nL:1/8\nK:C\nCDEF GABc|cBAG FEDC|]"
+
+
+def prompt(task):
+    return f"Input:\n{SCORE}\n\nTask:\n{task}"
+
+
+@pytest.mark.parametrize("task, expected", [
+    ("How many bars does this score have?", "ABC"),
+    ("What is the time signature?", "ABC"),
+    ("Which emotion does this piece convey?", "EMOTION"),
+    ("Classify the piece as Q1, Q2, Q3 or Q4.", "EMOTION"),
+    ("What is the key, and which mood does it convey?", None),
+    ("Tell me about this piece.", None),
+])
+def test_route_by_rules(task, expected):
+    assert mas.route_by_rules(prompt(task)) == expected
+
+
+def test_score_headers_do_not_count_as_keywords():
+    # "K:" and "M:" lines must not make every prompt look like an ABC question
+    assert mas.route_by_rules(prompt("Is it happy or sad?")) == "EMOTION"
+
+
+@pytest.mark.parametrize("decision, expected", [
+    ("abc", "ABC"), ("EMOTION\n", "EMOTION"), ("The answer is BOTH", "BOTH"), ("emotion analysis", "EMOTION"),
+    ("I am not sure", "NONE"),
+])
+def test_normalize_decision(decision, expected):
+    assert mas.normalize_decision(decision) == expected
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    """LLM controller stub that answers BOTH and records the prompts it was asked about."""
+    asked = []
+
+    def agent_A_controller(user_prompt):
+        asked.append(user_prompt)
+        return "BOTH"
+
+    monkeypatch.setattr(mas, "agent_A_controller", agent_A_controller)
+    monkeypatch.setattr(mas, "router_stats", mas.DecisionStats("Controller router", "rules", "controller"))
+    monkeypatch.setattr(mas, "use_router", True)
+    return asked
+
+
+def test_route_request_uses_rules_without_the_controller(controller, monkeypatch):
+    monkeypatch.setattr(mas, "router_audit_rate", 0)
+    assert mas.route_request(prompt("How many bars are there?")) == "ABC"
+    assert controller == []
+    assert mas.router_stats.report().startswith("Controller router: 1/1 decided by rules, 0 deferred")
+
+
+def test_route_request_defers_unclear_prompts(controller):
+    assert mas.route_request(prompt("Tell me about this piece.")) == "BOTH"
+    assert len(controller) == 1 and mas.router_stats.deferred == 1
+
+
+def test_audited_decisions_are_compared_with_the_controller(controller, monkeypatch):
+    monkeypatch.setattr(mas, "router_audit_rate", 1)
+    assert mas.route_request(prompt("How many bars are there?")) == "ABC"
+    assert len(controller) == 1
+    report = mas.router_stats.report()
+    assert "audit agreement 0/1 (0%)" in report and "rules ABC vs LLM BOTH: 1" in report
+
+
+def test_router_off_always_asks_the_controller(controller, monkeypatch):
+    monkeypatch.setattr(mas, "use_router", False)
+    assert mas.route_request(prompt("How many bars are there?")) == "BOTH"
+    assert mas.router_stats.deferred == 0
+
+
+def test_should_audit_is_stable_per_input():
+    texts = [f"sample {i}" for i in range(1000)]
+    picked = [text for text in texts if mas.should_audit(text, 0.1)]
+    assert 50 < len(picked) < 150
+    assert picked == [text for text in texts if mas.should_audit(text, 0.1)]
+    assert not any(mas.should_audit(text, 0) for text in texts)